@@ -0,0 +1,307 @@
+"""Достижения за набранные очки и уведомления о них в Telegram.
+
+Пороги лежат в отсортированном массиве, поэтому при каждом начислении
+проверяются только пороги между старым и новым балансом: два bisect по
+массиву, O(log порогов), без запросов к базе, если ничего не пересечено.
+Проверка идёт внутри транзакции начисления, так что награда в
+achievement_awards и уведомление в achievement_notifications записываются
+атомарно с балансом; повторное пересечение порога (после списания) награду
+не дублирует.
+
+Уведомления отправляет фоновый AchievementNotifier: забирает порцию
+pending-строк под аренду (несколько процессов не отправят одно сообщение
+дважды), шлёт через sendMessage с ограничением скорости и ведёт статусы как
+рассылки: 403 помечает пользователя заблокировавшим бота, временные ошибки
+повторяются до MAX_ATTEMPTS.
+
+Список достижений - JSON-файл (ACHIEVEMENTS_FILE):
+
+    [{"id": "points_10k", "threshold": 10000, "title": "10 000 поинтов"}]
+
+Замер стоимости проверки:
+
+    python achievements.py bench
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import bisect
+import random
+import argparse
+import threading
+import logging
+
+import requests
+
+from broadcast import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_BATCH = 50
+MAX_ATTEMPTS = 3
+LEASE_SECONDS = 60
+DEFAULT_ACHIEVEMENTS = [
+    {"id": "points_100", "threshold": 100, "title": "Первая сотня"},
+    {"id": "points_1k", "threshold": 1000, "title": "1 000 поинтов"},
+    {"id": "points_10k", "threshold": 10000, "title": "10 000 поинтов"},
+    {"id": "points_100k", "threshold": 100000, "title": "100 000 поинтов"},
+    {"id": "points_1m", "threshold": 1000000, "title": "Миллионер"},
+]
+
+
+def init_tables(cursor):
+    """Создать таблицы наград и очереди уведомлений"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS achievement_awards (
+            telegram_id INTEGER NOT NULL,
+            achievement_id TEXT NOT NULL,
+            balance INTEGER NOT NULL,
+            awarded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (telegram_id, achievement_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS achievement_notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            achievement_id TEXT NOT NULL,
+            balance INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            lease_owner TEXT,
+            lease_until REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_achievement_notifications_status
+        ON achievement_notifications (status, id)
+    ''')
+
+
+def load_definitions(path):
+    """Достижения из файла; без файла - встроенный список"""
+    if not path or not os.path.exists(path):
+        return DEFAULT_ACHIEVEMENTS
+    with open(path) as f:
+        return json.load(f)
+
+
+class AchievementEngine:
+    """Пороги достижений в отсортированных массивах"""
+
+    def __init__(self, definitions):
+        ordered = sorted(definitions, key=lambda item: item["threshold"])
+        ids = [item["id"] for item in ordered]
+        if len(set(ids)) != len(ids):
+            raise ValueError("Achievement ids must be unique")
+        self.thresholds = [int(item["threshold"]) for item in ordered]
+        self.ids = ids
+        self.titles = [item.get("title", item["id"]) for item in ordered]
+        self.by_id = {achievement_id: i for i, achievement_id in enumerate(ids)}
+
+    def title(self, achievement_id):
+        """Название достижения (id, если его убрали из файла после выдачи)"""
+        i = self.by_id.get(achievement_id)
+        return achievement_id if i is None else self.titles[i]
+
+    def crossed(self, old_balance, new_balance):
+        """Номера порогов, пройденных вверх: old_balance < порог <= new_balance"""
+        if new_balance <= old_balance:
+            return range(0)
+        thresholds = self.thresholds
+        return range(bisect.bisect_right(thresholds, old_balance), bisect.bisect_right(thresholds, new_balance))
+
+    def evaluate(self, cursor, telegram_id, old_balance, new_balance, now=None):
+        """Выдать достижения за пройденные пороги в транзакции начисления; id новых наград.
+        now - время начисления в секундах эпохи (события журнала), по умолчанию текущее"""
+        awarded = []
+        for i in self.crossed(old_balance, new_balance):
+            cursor.execute('''
+                INSERT OR IGNORE INTO achievement_awards (telegram_id, achievement_id, balance, awarded_at)
+                VALUES (?, ?, ?, COALESCE(datetime(?, 'unixepoch'), CURRENT_TIMESTAMP))
+            ''', (telegram_id, self.ids[i], new_balance, now))
+            if cursor.rowcount:
+                cursor.execute('''
+                    INSERT INTO achievement_notifications (telegram_id, achievement_id, balance)
+                    VALUES (?, ?, ?)
+                ''', (telegram_id, self.ids[i], new_balance))
+                awarded.append(self.ids[i])
+        return awarded
+
+    def describe(self, conn, telegram_id, balance):
+        """Полученные достижения игрока и следующее"""
+        earned = {achievement_id: awarded_at for achievement_id, awarded_at in conn.execute(
+            'SELECT achievement_id, awarded_at FROM achievement_awards WHERE telegram_id = ?', (telegram_id,))}
+        achievements = [{
+            "id": achievement_id,
+            "title": self.titles[i],
+            "threshold": self.thresholds[i],
+            "unlocked": achievement_id in earned,
+            "awarded_at": earned.get(achievement_id)
+        } for i, achievement_id in enumerate(self.ids)]
+        i = bisect.bisect_right(self.thresholds, balance)
+        following = None
+        if i < len(self.ids):
+            following = {"id": self.ids[i], "title": self.titles[i], "threshold": self.thresholds[i],
+                         "remaining": self.thresholds[i] - balance}
+        return {"achievements": achievements, "next": following}
+
+
+class AchievementNotifier:
+    """Фоновая отправка уведомлений о достижениях"""
+
+    def __init__(self, connect, bot_token, render, api_url='https://api.telegram.org', rate=10,
+                 poll_interval=5):
+        self.connect = connect
+        self.send_url = f"{api_url}/bot{bot_token}/sendMessage"
+        # render(telegram_id, achievement_id, balance) -> (text, reply_markup)
+        self.render = render
+        self.limiter = RateLimiter(rate)
+        self.poll_interval = poll_interval
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.wakeup = threading.Event()
+        self.session = None
+        self.thread = None
+
+    def start(self):
+        if self.thread:
+            return
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.thread = threading.Thread(target=self._loop, daemon=True, name='achievement-notifier')
+        self.thread.start()
+
+    def wake(self):
+        """Отправить новые уведомления сейчас, не дожидаясь опроса (после коммита начисления)"""
+        self.wakeup.set()
+
+    def backlog(self):
+        conn = self.connect()
+        try:
+            pending, oldest = conn.execute('''
+                SELECT COUNT(*), MIN(CAST(strftime('%s', created_at) AS REAL))
+                FROM achievement_notifications WHERE status IN ('pending', 'sending')
+            ''').fetchone()
+        finally:
+            conn.close()
+        return {"pending": pending, "oldest_age_seconds": round(time.time() - oldest) if oldest else 0}
+
+    def _loop(self):
+        while True:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            try:
+                while self._send_batch():
+                    pass
+            except Exception as e:
+                logger.error("Achievement notifier error: %s", e)
+
+    def _claim(self, conn):
+        now = time.time()
+        conn.execute('''
+            UPDATE achievement_notifications SET status = 'sending', lease_owner = ?, lease_until = ?
+            WHERE id IN (
+                SELECT id FROM achievement_notifications
+                WHERE status = 'pending' OR (status = 'sending' AND lease_until < ?)
+                ORDER BY id LIMIT ?
+            )
+        ''', (self.owner, now + LEASE_SECONDS, now, NOTIFY_BATCH))
+        conn.commit()
+        return conn.execute('''
+            SELECT id, telegram_id, achievement_id, balance, attempts FROM achievement_notifications
+            WHERE status = 'sending' AND lease_owner = ? ORDER BY id
+        ''', (self.owner,)).fetchall()
+
+    def _send_batch(self):
+        """Отправить одну порцию; False - отправлять нечего"""
+        conn = self.connect()
+        try:
+            batch = self._claim(conn)
+            if not batch:
+                return False
+            updates, blocked_users = [], []
+            for notification_id, telegram_id, achievement_id, balance, attempts in batch:
+                text, reply_markup = self.render(telegram_id, achievement_id, balance)
+                status, error = self._send(telegram_id, text, reply_markup)
+                if status == 'throttled':
+                    # Ограничение Telegram - не вина получателя, попытку не засчитываем
+                    status = 'pending'
+                elif status == 'retry':
+                    attempts += 1
+                    status = 'failed' if attempts >= MAX_ATTEMPTS else 'pending'
+                elif status == 'blocked':
+                    blocked_users.append((telegram_id,))
+                updates.append((status, attempts, error, status, notification_id))
+            conn.executemany('''
+                UPDATE achievement_notifications
+                SET status = ?, attempts = ?, error = ?, lease_owner = NULL,
+                    sent_at = CASE WHEN ? = 'sent' THEN CURRENT_TIMESTAMP END
+                WHERE id = ?
+            ''', updates)
+            conn.executemany('UPDATE users SET is_blocked = 1 WHERE telegram_id = ?', blocked_users)
+            conn.commit()
+        finally:
+            conn.close()
+        sent = sum(1 for update in updates if update[0] == 'sent')
+        logger.info("Achievement notifications: %s sent of %s", sent, len(batch))
+        # Если вся порция вернулась в pending (429, сеть), не крутим цикл вхолостую
+        return any(update[0] != 'pending' for update in updates)
+
+    def _send(self, chat_id, text, reply_markup):
+        """Отправить одно сообщение; вернуть (статус, ошибка)"""
+        self.limiter.acquire()
+        if self.session is None:
+            self.session = requests.Session()
+        try:
+            payload = {'chat_id': chat_id, 'text': text, 'parse_mode': 'HTML'}
+            if reply_markup:
+                payload['reply_markup'] = reply_markup
+            response = self.session.post(self.send_url, data=payload, timeout=10)
+            data = response.json()
+        except Exception as e:
+            return 'retry', str(e)[:200]
+
+        if data.get('ok'):
+            return 'sent', None
+        error = data.get('description', '')[:200]
+        code = data.get('error_code')
+        if code == 429:
+            self.limiter.pause(data.get('parameters', {}).get('retry_after', 1))
+            return 'throttled', error
+        if code == 403:
+            return 'blocked', error
+        if code == 400:
+            return 'failed', error
+        return 'retry', error
+
+
+def bench(writes):
+    """Стоимость проверки порогов на одно начисление при разном числе достижений"""
+    rng = random.Random(7)
+    balances = [rng.randrange(10 ** 7) for _ in range(writes)]
+    deltas = [rng.randrange(1, 100) for _ in range(writes)]
+    print(f"{'thresholds':>10}{'us/write':>10}")
+    for count in (10, 1000, 100000):
+        engine = AchievementEngine([{"id": f"a{i}", "threshold": t}
+                                    for i, t in enumerate(sorted(rng.sample(range(1, 10 ** 7), count)))])
+        start = time.perf_counter()
+        for balance, delta in zip(balances, deltas):
+            engine.crossed(balance, balance + delta)
+        print(f"{count:>10}{(time.perf_counter() - start) / writes * 1e6:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Движок достижений')
+    parser.add_argument('command', choices=['bench'])
+    parser.add_argument('--writes', type=int, default=200000)
+    args = parser.parse_args(argv)
+    bench(args.writes)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,321 @@
+"""Временные ряды активности игроков: события, очки, DAU и сессии.
+
+Начисления (/add_points, /v1/sync) и обновления бота копятся в памяти как
+счётчики по минутам и раз в flush_interval секунд одной транзакцией
+добавляются в activity_minutes, activity_hours и activity_days (UPSERT с
+прибавлением). Минутные строки живут minute_retention секунд, часовые и
+дневные - всегда: за год это около 9 тысяч часовых строк, поэтому запросы
+за месяцы - выборка по первичному ключу, без transactions.
+
+DAU считается по activity_user_days (день, игрок) - одна строка на активного
+игрока в день, старые дни удаляются после переноса числа в activity_days.
+Сессия - серия событий игрока с паузами не длиннее session_gap; открытые
+сессии лежат в activity_sessions, закрытые учитываются в дне начала.
+"""
+import time
+import threading
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# resolution -> (таблица, колонка, шаг в секундах, окно по умолчанию)
+RESOLUTIONS = {
+    'minute': ('activity_minutes', 'minute', 60, 3600),
+    'hour': ('activity_hours', 'hour', 3600, 2 * 86400),
+    'day': ('activity_days', 'day', 86400, 30 * 86400),
+}
+MAX_POINTS = 2000
+
+
+def init_tables(cursor):
+    """Создать таблицы рядов активности"""
+    for table, column in (('activity_minutes', 'minute'), ('activity_hours', 'hour')):
+        cursor.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                {column} INTEGER PRIMARY KEY,
+                events INTEGER NOT NULL DEFAULT 0,
+                bot_events INTEGER NOT NULL DEFAULT 0,
+                points INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS activity_days (
+            day INTEGER PRIMARY KEY,
+            events INTEGER NOT NULL DEFAULT 0,
+            bot_events INTEGER NOT NULL DEFAULT 0,
+            points INTEGER NOT NULL DEFAULT 0,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            sessions INTEGER NOT NULL DEFAULT 0,
+            session_seconds INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS activity_user_days (
+            day INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            PRIMARY KEY (day, telegram_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS activity_sessions (
+            telegram_id INTEGER PRIMARY KEY,
+            started INTEGER NOT NULL,
+            last_seen INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_activity_sessions_last_seen ON activity_sessions (last_seen)')
+
+
+def _upsert_sql(table, column):
+    return f'''
+        INSERT INTO {table} ({column}, events, bot_events, points) VALUES (?, ?, ?, ?)
+        ON CONFLICT({column}) DO UPDATE SET
+            events = events + excluded.events,
+            bot_events = bot_events + excluded.bot_events,
+            points = points + excluded.points
+    '''
+
+
+UPSERT_MINUTE = _upsert_sql('activity_minutes', 'minute')
+UPSERT_HOUR = _upsert_sql('activity_hours', 'hour')
+UPSERT_DAY = _upsert_sql('activity_days', 'day')
+
+
+def _iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class ActivityStore:
+    """Буфер событий в памяти и его периодический сброс в таблицы рядов"""
+
+    def __init__(self, connect, flush_interval=10, session_gap=1800,
+                 minute_retention=2 * 86400, user_day_retention=35 * 86400):
+        self.connect = connect
+        self.flush_interval = flush_interval
+        self.session_gap = session_gap
+        self.minute_retention = minute_retention
+        self.user_day_retention = user_day_retention
+        # минута -> [events, bot_events, points]
+        self.minutes = {}
+        # игрок -> [первое, последнее событие]
+        self.users = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.last_flush = None
+        self.thread = None
+
+    @property
+    def enabled(self):
+        return self.flush_interval > 0
+
+    def start(self):
+        """Запустить периодический сброс в фоне"""
+        if not self.enabled or self.thread:
+            return
+        self.thread = threading.Thread(target=self._loop, daemon=True, name='activity')
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Activity flush error: %s", e)
+
+    def record(self, telegram_id, points=0, bot=False, ts=None):
+        """Учесть событие игрока: начисление очков или обновление бота"""
+        if not self.enabled:
+            return
+        ts = int(ts or time.time())
+        with self.lock:
+            counters = self.minutes.get(ts // 60)
+            if counters is None:
+                counters = self.minutes[ts // 60] = [0, 0, 0]
+            counters[0] += 1
+            counters[1] += 1 if bot else 0
+            counters[2] += points
+            seen = self.users.get(telegram_id)
+            if seen is None:
+                self.users[telegram_id] = [ts, ts]
+            else:
+                seen[0] = min(seen[0], ts)
+                seen[1] = max(seen[1], ts)
+
+    def flush(self, now=None):
+        """Перенести накопленное в базу одной транзакцией"""
+        now = int(now or time.time())
+        with self.flush_lock:
+            with self.lock:
+                minutes, self.minutes = self.minutes, {}
+                users, self.users = self.users, {}
+            try:
+                self._write(minutes, users, now)
+            except Exception:
+                self._restore(minutes, users)
+                raise
+            self.last_flush = now
+
+    def _restore(self, minutes, users):
+        """Вернуть несохранённое в буфер, чтобы попробовать при следующем сбросе"""
+        with self.lock:
+            for minute, (events, bot_events, points) in minutes.items():
+                counters = self.minutes.setdefault(minute, [0, 0, 0])
+                counters[0] += events
+                counters[1] += bot_events
+                counters[2] += points
+            for telegram_id, (first, last) in users.items():
+                seen = self.users.setdefault(telegram_id, [first, last])
+                seen[0] = min(seen[0], first)
+                seen[1] = max(seen[1], last)
+
+    def _write(self, minutes, users, now):
+        hours, days = {}, {}
+        for minute, counters in minutes.items():
+            for buckets, key in ((hours, minute // 60), (days, minute // 1440)):
+                total = buckets.setdefault(key, [0, 0, 0])
+                for i in range(3):
+                    total[i] += counters[i]
+
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.executemany(UPSERT_MINUTE, [(k, *v) for k, v in minutes.items()])
+            cursor.executemany(UPSERT_HOUR, [(k, *v) for k, v in hours.items()])
+            cursor.executemany(UPSERT_DAY, [(k, *v) for k, v in days.items()])
+
+            touched_days = set(days)
+            user_days = set()
+            for telegram_id, (first, last) in users.items():
+                user_days.add((first // 86400, telegram_id))
+                user_days.add((last // 86400, telegram_id))
+            cursor.executemany('INSERT OR IGNORE INTO activity_user_days (day, telegram_id) VALUES (?, ?)',
+                               list(user_days))
+            touched_days.update(day for day, _ in user_days)
+
+            for telegram_id, (first, last) in users.items():
+                cursor.execute('SELECT started, last_seen FROM activity_sessions WHERE telegram_id = ?',
+                               (telegram_id,))
+                row = cursor.fetchone()
+                if row and first - row[1] <= self.session_gap:
+                    cursor.execute('UPDATE activity_sessions SET last_seen = ? WHERE telegram_id = ?',
+                                   (max(last, row[1]), telegram_id))
+                    continue
+                if row:
+                    touched_days.add(self._close_session(cursor, *row))
+                cursor.execute('INSERT OR REPLACE INTO activity_sessions (telegram_id, started, last_seen) '
+                               'VALUES (?, ?, ?)', (telegram_id, first, last))
+
+            # Сессии без событий дольше session_gap закончились
+            cursor.execute('SELECT telegram_id, started, last_seen FROM activity_sessions WHERE last_seen < ?',
+                           (now - self.session_gap,))
+            expired = cursor.fetchall()
+            for telegram_id, started, last_seen in expired:
+                touched_days.add(self._close_session(cursor, started, last_seen))
+            cursor.executemany('DELETE FROM activity_sessions WHERE telegram_id = ?',
+                               [(row[0],) for row in expired])
+
+            for day in touched_days:
+                cursor.execute('''
+                    UPDATE activity_days
+                    SET active_users = (SELECT COUNT(*) FROM activity_user_days WHERE day = ?)
+                    WHERE day = ?
+                ''', (day, day))
+
+            cursor.execute('DELETE FROM activity_minutes WHERE minute < ?', ((now - self.minute_retention) // 60,))
+            cursor.execute('DELETE FROM activity_user_days WHERE day < ?',
+                           ((now - self.user_day_retention) // 86400,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def _close_session(self, cursor, started, last_seen):
+        """Учесть закрытую сессию в дне её начала; возвращает этот день"""
+        day = started // 86400
+        cursor.execute('''
+            INSERT INTO activity_days (day, sessions, session_seconds) VALUES (?, 1, ?)
+            ON CONFLICT(day) DO UPDATE SET
+                sessions = sessions + 1,
+                session_seconds = session_seconds + excluded.session_seconds
+        ''', (day, last_seen - started))
+        return day
+
+    def series(self, resolution, start=None, end=None, now=None):
+        """Ряд за [start, end] с нулями в пустых интервалах и сводка по нему"""
+        table, column, step, default_window = RESOLUTIONS[resolution]
+        now = int(now or time.time())
+        end = int(end if end is not None else now)
+        start = int(start if start is not None else end - default_window + step)
+        first, last = start // step, end // step
+        if last < first:
+            raise ValueError("from must not be after to")
+        if last - first + 1 > MAX_POINTS:
+            raise ValueError(f"Range too large: at most {MAX_POINTS} {resolution} points")
+
+        extra = ', active_users, sessions, session_seconds' if resolution == 'day' else ''
+        conn = self.connect()
+        try:
+            rows = conn.execute(
+                f'SELECT {column}, events, bot_events, points{extra} FROM {table} '
+                f'WHERE {column} BETWEEN ? AND ? ORDER BY {column}',
+                (first, last)
+            ).fetchall()
+            open_sessions = conn.execute('SELECT COUNT(*) FROM activity_sessions WHERE last_seen >= ?',
+                                         (now - self.session_gap,)).fetchone()[0]
+        finally:
+            conn.close()
+
+        by_bucket = {row[0]: row for row in rows}
+        minutes_per_step = step / 60
+        series = []
+        totals = {"events": 0, "bot_events": 0, "points": 0, "sessions": 0, "session_seconds": 0}
+        active_days = []
+        for bucket in range(first, last + 1):
+            row = by_bucket.get(bucket) or (bucket, 0, 0, 0, 0, 0, 0)
+            point = {
+                "ts": bucket * step,
+                "time": _iso(bucket * step),
+                "events": row[1],
+                "bot_events": row[2],
+                "points": row[3],
+                "points_per_minute": round(row[3] / minutes_per_step, 2)
+            }
+            totals["events"] += row[1]
+            totals["bot_events"] += row[2]
+            totals["points"] += row[3]
+            if resolution == 'day':
+                point["active_users"] = row[4]
+                point["sessions"] = row[5]
+                point["avg_session_seconds"] = round(row[6] / row[5], 1) if row[5] else 0
+                totals["sessions"] += row[5]
+                totals["session_seconds"] += row[6]
+                active_days.append(row[4])
+            series.append(point)
+
+        summary = {
+            "events": totals["events"],
+            "bot_events": totals["bot_events"],
+            "points": totals["points"],
+            "points_per_minute": round(totals["points"] / (len(series) * minutes_per_step), 2),
+            "open_sessions": open_sessions
+        }
+        if resolution == 'day':
+            summary["avg_daily_active_users"] = round(sum(active_days) / len(active_days), 1)
+            summary["sessions"] = totals["sessions"]
+            summary["avg_session_seconds"] = (
+                round(totals["session_seconds"] / totals["sessions"], 1) if totals["sessions"] else 0
+            )
+        return {
+            "resolution": resolution,
+            "from": first * step,
+            "to": (last + 1) * step - 1,
+            "series": series,
+            "summary": summary,
+            "flush_interval_seconds": self.flush_interval,
+            "last_flush": _iso(self.last_flush) if self.last_flush else None
+        }
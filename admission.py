@@ -0,0 +1,139 @@
+"""Адмиссия запросов и сброс нагрузки при перегрузке базы.
+
+Общий лимит запросов процесса подстраивается по AIMD: пока время в SQLite
+(сумма db.* спанов запроса) и ожидание в очереди держатся ниже целей, лимит
+растёт на 1/limit за запрос, то есть примерно на единицу за "окно"; когда
+среднее одного из них превышает цель, лимит умножается на BACKOFF, не чаще
+раза в окно. Каждому
+классу маршрутов доступна только своя доля лимита, поэтому при сжатии лимита
+первыми получают 503 опросы лидерборда, затем чтения, затем записи. Критичные
+маршруты (/add_points, /webhook) не отклоняются никогда, но учитываются.
+
+Лимит - на процесс и считает запросы в системе: выполняющиеся плюс ждущие
+свободного потока. Воркер gthread выполняет не больше threads запросов сразу,
+остальные ждут в его очереди, где их не видно; поэтому число ждущих
+оценивается по закону Литтла: ждущих на занятый поток столько, во сколько
+ожидание в очереди (заголовок X-Request-Start от прокси) дольше обслуживания.
+Без заголовка ожидание не видно, в системе не бывает больше threads запросов,
+и лимиты имеют смысл только в пределах threads (доли классов берутся от них).
+Для сервиса в целом ёмкость - workers x limit.
+"""
+import math
+import threading
+
+# Доля общего лимита, которую может занять класс
+CLASS_SHARES = {
+    'critical': None,
+    'write': 0.9,
+    'read': 0.75,
+    'poll': 0.5,
+}
+# Через сколько секунд клиенту стоит повторить запрос
+RETRY_AFTER = {'write': 1, 'read': 2, 'poll': 5}
+BACKOFF = 0.9
+EWMA_ALPHA = 0.2
+
+
+class RouteClassStats:
+    """Счётчики одного класса маршрутов"""
+
+    __slots__ = ('inflight', 'admitted', 'shed', 'db_ms', 'queue_ms')
+
+    def __init__(self):
+        self.inflight = 0
+        self.admitted = 0
+        self.shed = 0
+        self.db_ms = 0.0
+        self.queue_ms = 0.0
+
+    def to_dict(self):
+        return {
+            "inflight": self.inflight,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "db_ms_avg": round(self.db_ms, 2),
+            "queue_ms_avg": round(self.queue_ms, 2)
+        }
+
+
+class AdmissionController:
+    """AIMD-лимит параллельности с приоритетами классов маршрутов"""
+
+    def __init__(self, initial_limit=32, min_limit=4, max_limit=256, target_db_ms=50.0, target_queue_ms=100.0):
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_db_ms = target_db_ms
+        self.target_queue_ms = target_queue_ms
+        self.inflight = 0
+        self.db_ms = 0.0
+        self.queue_ms = 0.0
+        self.service_ms = 0.0
+        self.queue_samples = 0
+        self.samples_since_decrease = 0
+        self.classes = {name: RouteClassStats() for name in CLASS_SHARES}
+        self.lock = threading.Lock()
+
+    def queued(self):
+        """Оценка запросов, ждущих потока: ожидание / обслуживание на каждый занятый поток (закон Литтла)"""
+        if self.service_ms <= 0:
+            return 0.0
+        return self.inflight * self.queue_ms / self.service_ms
+
+    def try_acquire(self, route_class, queue_ms=None):
+        """Занять слот; queue_ms - сколько запрос ждал потока; False - запрос нужно отклонить"""
+        share = CLASS_SHARES[route_class]
+        stats = self.classes[route_class]
+        with self.lock:
+            if queue_ms is not None:
+                self.queue_samples += 1
+                stats.queue_ms += EWMA_ALPHA * (queue_ms - stats.queue_ms)
+                self.queue_ms += EWMA_ALPHA * (queue_ms - self.queue_ms)
+            load = self.inflight + self.queued()
+            # Пустой процесс принимает всё: сбрасывать нечего
+            if share is not None and self.inflight > 0 and load >= self.limit * share:
+                stats.shed += 1
+                return False
+            self.inflight += 1
+            stats.inflight += 1
+            stats.admitted += 1
+            return True
+
+    def release(self, route_class, db_ms, service_ms=0.0):
+        """Освободить слот и учесть время запроса в базе и в обработчике"""
+        stats = self.classes[route_class]
+        with self.lock:
+            self.inflight -= 1
+            stats.inflight -= 1
+            if service_ms > 0:
+                self.service_ms += EWMA_ALPHA * (service_ms - self.service_ms)
+            if db_ms > 0:
+                stats.db_ms += EWMA_ALPHA * (db_ms - stats.db_ms)
+                self.db_ms += EWMA_ALPHA * (db_ms - self.db_ms)
+            elif not self.queue_samples:
+                return
+            self.samples_since_decrease += 1
+            if self.db_ms > self.target_db_ms or self.queue_ms > self.target_queue_ms:
+                if self.samples_since_decrease >= self.limit:
+                    self.limit = max(self.min_limit, self.limit * BACKOFF)
+                    self.samples_since_decrease = 0
+            elif self.inflight + self.queued() + 1 >= self.limit * 0.5:
+                # Растём, только если лимит действительно используется
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def retry_after(self, route_class):
+        return RETRY_AFTER.get(route_class, 1)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "limit": math.floor(self.limit * 100) / 100,
+                "inflight": self.inflight,
+                "queued_estimate": round(self.queued(), 2),
+                "db_ms_avg": round(self.db_ms, 2),
+                "queue_ms_avg": round(self.queue_ms, 2),
+                "service_ms_avg": round(self.service_ms, 2),
+                "target_db_ms": self.target_db_ms,
+                "target_queue_ms": self.target_queue_ms,
+                "classes": {name: stats.to_dict() for name, stats in self.classes.items()}
+            }
@@ -0,0 +1,349 @@
+"""Холодный архив неактивных игроков в отдельном файле SQLite.
+
+Большинство зарегистрировавшихся играют один раз и не возвращаются, но
+остаются в каждом проходе по users, в гистограмме мест и в прогреве кешей.
+Archiver обходит users порциями по id (как сверка балансов) и переносит
+игроков без активности дольше inactive_days вместе с их transactions и
+sync_state в архивную базу; горячие таблицы и кеши остаются размером с
+активную аудиторию.
+
+Перенос идёт двумя транзакциями: сначала строки копируются в архив (через
+ATTACH), потом удаляются из горячей базы - с повторной проверкой, что игрок
+всё ещё неактивен. В WAL коммит нескольких файлов не атомарен, поэтому
+порядок выбран так, что после сбоя игрок может оказаться в обеих базах
+(горячая копия главнее), но не пропасть. Возвращение - тот же путь в
+обратную сторону: restore() вызывается, когда игрока не нашли в горячей базе.
+
+Новые колонки горячих таблиц (ALTER TABLE в init_tables модулей) добавляются
+в архив перед каждым проходом.
+"""
+import os
+import time
+import uuid
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 60
+# (таблица, колонка отбора); ключи, по которым архив заменяет повторно перенесённые строки
+ARCHIVED_TABLES = (('users', 'id'), ('transactions', 'user_id'), ('sync_state', 'telegram_id'))
+ARCHIVE_INDEXES = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_archive_users_telegram ON users (telegram_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_archive_users_id ON users (id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_archive_transactions_id ON transactions (id)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_archive_transactions_user ON transactions (user_id)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_archive_sync_state ON sync_state (telegram_id, client_id)',
+)
+
+
+def init_tables(cursor):
+    """Создать состояние прохода архивации в горячей базе"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archive_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            watermark INTEGER NOT NULL DEFAULT 0,
+            pass_started_at REAL,
+            last_pass_finished_at REAL NOT NULL DEFAULT 0,
+            archived_total INTEGER NOT NULL DEFAULT 0,
+            restored_total INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_until REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO archive_state (id) VALUES (1)')
+
+
+def _columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f'PRAGMA {schema}.table_info({table})')]
+
+
+class Archiver:
+    """Фоновый перенос неактивных игроков в архив и их возврат по требованию"""
+
+    def __init__(self, connect, archive_path, inactive_days=90, chunk_size=500, duty_cycle=0.1,
+                 pass_interval=86400, on_archived=None, poll_interval=30):
+        self.connect = connect
+        self.archive_path = archive_path
+        self.inactive_days = inactive_days
+        self.chunk_size = chunk_size
+        self.duty_cycle = duty_cycle
+        self.pass_interval = pass_interval
+        # on_archived([(telegram_id, points), ...]) - после удаления порции из горячей базы
+        self.on_archived = on_archived
+        self.poll_interval = poll_interval
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.schema_ready = False
+        self.thread = None
+
+    def start(self):
+        if self.thread or self.pass_interval <= 0 or self.inactive_days <= 0:
+            return
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.thread = threading.Thread(target=self._loop, daemon=True, name='archiver')
+        self.thread.start()
+
+    def _attach(self, conn):
+        conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+        if not self.schema_ready:
+            self._sync_schema(conn)
+
+    def _sync_schema(self, conn):
+        """Создать архивные таблицы по образцу горячих и догнать новые колонки"""
+        for table, _ in ARCHIVED_TABLES:
+            hot = _columns(conn, 'main', table)
+            archived = _columns(conn, 'archive', table)
+            if not archived:
+                conn.execute(f'CREATE TABLE archive.{table} AS SELECT * FROM main.{table} WHERE 0')
+            for column in hot:
+                if column not in archived and archived:
+                    conn.execute(f'ALTER TABLE archive.{table} ADD COLUMN {column}')
+        if 'archived_at' not in _columns(conn, 'archive', 'users'):
+            conn.execute('ALTER TABLE archive.users ADD COLUMN archived_at REAL')
+        for statement in ARCHIVE_INDEXES:
+            conn.execute(statement)
+        conn.commit()
+        self.schema_ready = True
+
+    def request_pass(self):
+        """Начать проход при следующей проверке, не дожидаясь интервала"""
+        conn = self.connect()
+        try:
+            conn.execute('UPDATE archive_state SET last_pass_finished_at = 0 WHERE id = 1')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def progress(self):
+        conn = self.connect()
+        try:
+            row = conn.execute('''
+                SELECT watermark, pass_started_at, last_pass_finished_at, archived_total, restored_total
+                FROM archive_state WHERE id = 1
+            ''').fetchone()
+            hot_users = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        finally:
+            conn.close()
+        state = dict(zip(('watermark', 'pass_started_at', 'last_pass_finished_at',
+                          'archived_total', 'restored_total'), row))
+        state['running'] = state['watermark'] > 0
+        state['hot_users'] = hot_users
+        state['archived_users'] = self.archived_count()
+        state['inactive_days'] = self.inactive_days
+        state['archive_path'] = self.archive_path
+        return state
+
+    def archived_count(self):
+        if not os.path.exists(self.archive_path):
+            return 0
+        conn = sqlite3.connect(self.archive_path)
+        try:
+            return conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0
+        finally:
+            conn.close()
+
+    def _loop(self):
+        while True:
+            try:
+                if self._claim():
+                    started = time.monotonic()
+                    if self._step():
+                        busy = time.monotonic() - started
+                        time.sleep(max(busy * (1 / self.duty_cycle - 1), 0.01))
+                        continue
+            except Exception as e:
+                logger.error("Archiver error: %s", e)
+            time.sleep(self.poll_interval)
+
+    def _claim(self):
+        """Взять или продлить аренду; False - архивацию ведёт другой процесс"""
+        conn = self.connect()
+        try:
+            now = time.time()
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE archive_state SET lease_owner = ?, lease_until = ?
+                WHERE id = 1 AND (lease_until < ? OR lease_owner = ?)
+            ''', (self.owner, now + LEASE_SECONDS, now, self.owner))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def _step(self, now=None):
+        """Перенести одну порцию; False - делать нечего до следующего прохода"""
+        now = now or time.time()
+        cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now - self.inactive_days * 86400))
+        conn = self.connect()
+        try:
+            watermark, last_finished = conn.execute(
+                'SELECT watermark, last_pass_finished_at FROM archive_state WHERE id = 1'
+            ).fetchone()
+            if watermark == 0 and now - last_finished < self.pass_interval:
+                return False
+            if watermark == 0:
+                self.schema_ready = False
+                conn.execute('UPDATE archive_state SET pass_started_at = ? WHERE id = 1', (now,))
+                conn.commit()
+
+            rows = conn.execute('''
+                SELECT id, COALESCE(updated_at, created_at) < ? FROM users
+                WHERE id > ? ORDER BY id LIMIT ?
+            ''', (cutoff, watermark, self.chunk_size)).fetchall()
+            if not rows:
+                conn.execute('''
+                    UPDATE archive_state SET watermark = 0, last_pass_finished_at = ? WHERE id = 1
+                ''', (now,))
+                conn.commit()
+                logger.info("Archive pass finished")
+                return True
+
+            candidates = [row[0] for row in rows if row[1]]
+            archived = self._move(conn, candidates, cutoff, now) if candidates else []
+            conn.execute('''
+                UPDATE archive_state SET watermark = ?, archived_total = archived_total + ? WHERE id = 1
+            ''', (rows[-1][0], len(archived)))
+            conn.commit()
+        finally:
+            conn.close()
+
+        if archived:
+            logger.info("Archived %s inactive users", len(archived))
+            if self.on_archived:
+                self.on_archived(archived)
+        return True
+
+    def _move(self, conn, user_ids, cutoff, now):
+        """Скопировать игроков в архив, затем удалить из горячей базы тех, кто всё ещё неактивен"""
+        self._attach(conn)
+        try:
+            marks = ','.join('?' * len(user_ids))
+            # 1. Копия в архив: пишется только архивный файл
+            conn.execute('BEGIN')
+            for table, key in ARCHIVED_TABLES:
+                columns = ', '.join(_columns(conn, 'main', table))
+                if table == 'users':
+                    conn.execute(f'''
+                        INSERT OR REPLACE INTO archive.users ({columns}, archived_at)
+                        SELECT {columns}, ? FROM main.users WHERE id IN ({marks})
+                    ''', (now, *user_ids))
+                elif key == 'user_id':
+                    conn.execute(f'''
+                        INSERT OR REPLACE INTO archive.{table} ({columns})
+                        SELECT {columns} FROM main.{table} WHERE user_id IN ({marks})
+                    ''', user_ids)
+                else:
+                    conn.execute(f'''
+                        INSERT OR REPLACE INTO archive.{table} ({columns})
+                        SELECT {columns} FROM main.{table}
+                        WHERE telegram_id IN (SELECT telegram_id FROM main.users WHERE id IN ({marks}))
+                    ''', user_ids)
+            conn.commit()
+
+            # 2. Удаление из горячей базы; кто успел вернуться - остаётся (его копию в архиве
+            # заменит следующий перенос, а горячая строка главнее)
+            conn.execute('BEGIN IMMEDIATE')
+            moved = conn.execute(f'''
+                SELECT id, telegram_id, points FROM main.users
+                WHERE id IN ({marks}) AND COALESCE(updated_at, created_at) < ?
+            ''', (*user_ids, cutoff)).fetchall()
+            if moved:
+                ids = [row[0] for row in moved]
+                telegram_ids = [row[1] for row in moved]
+                marks = ','.join('?' * len(ids))
+                conn.execute(f'DELETE FROM main.sync_state WHERE telegram_id IN ({marks})', telegram_ids)
+                conn.execute(f'DELETE FROM main.transactions WHERE user_id IN ({marks})', ids)
+                conn.execute(f'DELETE FROM main.ledger_rollups WHERE user_id IN ({marks})', ids)
+                conn.execute(f'DELETE FROM main.users WHERE id IN ({marks})', ids)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute('DETACH DATABASE archive')
+        return [(telegram_id, points or 0) for _, telegram_id, points in moved]
+
+    def restore(self, telegram_id):
+        """Вернуть игрока из архива: (баланс горячей строки до возврата или None, баланс после)
+        или None, если в архиве его нет. Ошибки не глушатся - без возврата нельзя заводить игрока заново"""
+        if not os.path.exists(self.archive_path):
+            return None
+        probe = sqlite3.connect(self.archive_path)
+        try:
+            if not probe.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'users'").fetchone():
+                return None
+            found = probe.execute('SELECT id, points FROM users WHERE telegram_id = ?', (telegram_id,)).fetchone()
+        finally:
+            probe.close()
+        if not found:
+            return None
+
+        user_id, archived_points = found
+        conn = self.connect()
+        try:
+            self._attach(conn)
+            # 1. Возврат в горячую базу: пишется только она
+            conn.execute('BEGIN IMMEDIATE')
+            hot = conn.execute('SELECT id, points FROM main.users WHERE telegram_id = ?', (telegram_id,)).fetchone()
+            if hot is None:
+                for table, key in ARCHIVED_TABLES:
+                    columns = ', '.join(_columns(conn, 'main', table))
+                    value = telegram_id if key == 'telegram_id' else user_id
+                    conn.execute(f'''
+                        INSERT OR IGNORE INTO main.{table} ({columns})
+                        SELECT {columns} FROM archive.{table} WHERE {key} = ?
+                    ''', (value,))
+                # Возвращение - это активность: иначе следующий проход сразу унесёт игрока обратно
+                conn.execute('UPDATE main.users SET updated_at = CURRENT_TIMESTAMP WHERE telegram_id = ?',
+                             (telegram_id,))
+                old_balance = None
+            elif hot[0] == user_id:
+                # Та же строка: перенос прервался до удаления из горячей базы. Горячая копия новее
+                # и уже содержит архивную - добираем только то, чего в ней нет
+                self._copy_children(conn, telegram_id, user_id, user_id)
+                old_balance = hot[1] or 0
+            else:
+                # Игрока завели заново, пока старая запись лежала в архиве: сливаем баланс и журнал
+                self._copy_children(conn, telegram_id, user_id, hot[0])
+                conn.execute('''
+                    UPDATE main.users SET points = points + ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?
+                ''', (archived_points or 0, hot[0]))
+                # Архивные транзакции легли ниже last_tx_id свёртки - сверка должна пересчитать сумму
+                conn.execute('DELETE FROM main.ledger_rollups WHERE user_id = ?', (hot[0],))
+                old_balance = hot[1] or 0
+                logger.warning("User %s was re-registered while archived: merged %s archived points into id %s",
+                               telegram_id, archived_points, hot[0])
+            conn.execute('UPDATE main.archive_state SET restored_total = restored_total + 1 WHERE id = 1')
+            points = conn.execute('SELECT points FROM main.users WHERE telegram_id = ?', (telegram_id,)).fetchone()
+            conn.commit()
+
+            # 2. Удаление из архива - только после того, как этот вызов скопировал строки обратно
+            conn.execute('BEGIN')
+            conn.execute('DELETE FROM archive.sync_state WHERE telegram_id = ?', (telegram_id,))
+            conn.execute('DELETE FROM archive.transactions WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM archive.users WHERE id = ?', (user_id,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        logger.info("Restored user %s from archive", telegram_id)
+        return old_balance, points[0] or 0
+
+    def _copy_children(self, conn, telegram_id, archived_id, hot_id):
+        """Скопировать архивные transactions и sync_state к горячей строке hot_id, не трогая существующие"""
+        columns = _columns(conn, 'main', 'transactions')
+        selected = ', '.join('?' if column == 'user_id' else column for column in columns)
+        conn.execute(f'''
+            INSERT OR IGNORE INTO main.transactions ({', '.join(columns)})
+            SELECT {selected} FROM archive.transactions WHERE user_id = ?
+        ''', (hot_id, archived_id))
+        columns = ', '.join(_columns(conn, 'main', 'sync_state'))
+        conn.execute(f'''
+            INSERT OR IGNORE INTO main.sync_state ({columns})
+            SELECT {columns} FROM archive.sync_state WHERE telegram_id = ?
+        ''', (telegram_id,))
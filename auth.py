@@ -0,0 +1,106 @@
+"""Аутентификация игроков мини-приложения Telegram.
+
+initData, которую Telegram передаёт в WebApp, подписана HMAC-SHA256 от
+токена бота; сервер проверяет её один раз и выдаёт короткоживущий JWT
+сессии. Дальше запросы несут Authorization: Bearer <token>. Проверенные
+токены кешируются в памяти: повторная проверка - поиск в dict по подписанной
+части и hmac.compare_digest подписи, без декодирования JWT и без базы.
+"""
+import time
+import json
+import hmac
+import hashlib
+import threading
+from urllib.parse import parse_qsl
+
+import jwt
+
+
+class AuthError(Exception):
+    """initData не прошла проверку"""
+
+
+class InitDataValidator:
+    """Проверка подписи initData по алгоритму Telegram WebApp"""
+
+    def __init__(self, bot_token, max_age=86400):
+        # secret_key = HMAC_SHA256("WebAppData", bot_token) - считаем один раз
+        self.secret = hmac.new(b'WebAppData', bot_token.encode(), hashlib.sha256).digest()
+        self.max_age = max_age
+
+    def validate(self, init_data, now=None):
+        """Вернуть пользователя из initData или бросить AuthError"""
+        try:
+            fields = dict(parse_qsl(init_data or '', keep_blank_values=True, strict_parsing=True))
+        except ValueError:
+            raise AuthError("Malformed initData")
+        received = fields.pop('hash', None)
+        if not received:
+            raise AuthError("initData hash is missing")
+
+        check_string = '\n'.join(f"{key}={value}" for key, value in sorted(fields.items()))
+        expected = hmac.new(self.secret, check_string.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, received):
+            raise AuthError("initData signature mismatch")
+
+        try:
+            auth_date = int(fields.get('auth_date', 0))
+        except ValueError:
+            raise AuthError("Bad auth_date")
+        if self.max_age and (now or time.time()) - auth_date > self.max_age:
+            raise AuthError("initData expired")
+
+        try:
+            user = json.loads(fields['user'])
+            user['id'] = int(user['id'])
+        except (KeyError, ValueError, TypeError):
+            raise AuthError("initData has no user")
+        return user
+
+
+class SessionTokens:
+    """JWT сессий (HS256) с кешем уже проверенных токенов; без секрета токены не выдаются и не принимаются"""
+
+    def __init__(self, secret, ttl=3600, cache_size=100000):
+        self.secret = secret
+        self.enabled = bool(secret)
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def issue(self, telegram_id):
+        """Выдать токен сессии; возвращает (token, expires_in)"""
+        if not self.enabled:
+            raise AuthError("Session secret is not configured")
+        now = int(time.time())
+        token = jwt.encode({"sub": str(telegram_id), "iat": now, "exp": now + self.ttl},
+                           self.secret, algorithm='HS256')
+        return token, self.ttl
+
+    def verify(self, token):
+        """telegram_id владельца токена или None, если токен недействителен"""
+        if not self.enabled:
+            return None
+        signing_input, _, signature = token.rpartition('.')
+        entry = self.cache.get(signing_input)
+        if entry is not None:
+            expected, telegram_id, expires_at = entry
+            if expires_at > time.time() and hmac.compare_digest(signature, expected):
+                return telegram_id
+            if expires_at <= time.time():
+                with self.lock:
+                    self.cache.pop(signing_input, None)
+            return None
+
+        try:
+            payload = jwt.decode(token, self.secret, algorithms=['HS256'], options={"require": ["exp", "sub"]})
+            telegram_id = int(payload['sub'])
+        except (jwt.InvalidTokenError, ValueError):
+            return None
+        with self.lock:
+            if len(self.cache) >= self.cache_size:
+                # Вытесняем самый старый - dict хранит порядок вставки
+                self.cache.pop(next(iter(self.cache)), None)
+            self.cache[signing_input] = (signature, telegram_id, payload['exp'])
+        return telegram_id
@@ -0,0 +1,373 @@
+"""Онлайн-снапшоты SQLite через backup API.
+
+Копирование идёт порциями страниц с паузой между шагами, чтобы не мешать
+запросам. Вместе с основной базой копируется архив неактивных игроков
+(archive.py) - в файл-спутник <снапшот>.archive.db.gz. Обе базы копируются с
+одного соединения внутри одной транзакции чтения, открытой на обеих сразу:
+чужие записи во время копирования не перезапускают backup, а снимки файлов
+согласованы с точностью до переноса игрока, попавшего между двумя первыми
+чтениями. Готовые копии проверяются quick_check, сжимаются gzip и
+ротируются вместе.
+
+Расписание, аренда и статус последнего снапшота хранятся в backup_state: снапшот
+снимает тот воркер, который первым увидел, что интервал с последнего успешного
+прошёл, - и после пересоздания воркеров (max_requests), и при воркерах,
+запущенных в разное время, снапшот идёт раз в интервал. Неудачный снапшот
+повторяется через RETRY_SECONDS.
+
+Использование:
+    python backup.py snapshot [--db veln_game.db] [--dir backups]
+    python backup.py restore backups/veln_game-20240101-120000.db.gz [--db veln_game.db] [--archive-db ...]
+"""
+import os
+import sys
+import gzip
+import glob
+import time
+import shutil
+import sqlite3
+import fcntl
+import uuid
+import argparse
+import tempfile
+import threading
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Аренда на всё время снапшота: продлевать её записью в базу нельзя - запись перезапускает backup
+LEASE_SECONDS = 3600
+RETRY_SECONDS = 300
+STATUS_FIELDS = ('last_snapshot', 'last_snapshot_at', 'last_duration_seconds', 'last_size_bytes', 'last_error')
+
+
+def init_tables(cursor):
+    """Создать строку расписания и статуса снапшотов"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backup_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            last_attempt_at REAL NOT NULL DEFAULT 0,
+            last_success_at REAL NOT NULL DEFAULT 0,
+            last_snapshot TEXT,
+            last_snapshot_at TEXT,
+            last_duration_seconds REAL,
+            last_size_bytes INTEGER,
+            last_error TEXT,
+            lease_owner TEXT,
+            lease_until REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO backup_state (id) VALUES (1)')
+
+
+class Snapshotter:
+    """Фоновые снапшоты базы с ротацией"""
+
+    def __init__(self, db_path, backup_dir='backups', interval=3600, keep=24,
+                 pages_per_step=256, step_sleep=0.05, connect=None, poll_interval=60, archive_path=None):
+        # keep=0 удалял бы не всё, а ничего: snapshots[:-0] - пустой срез
+        if keep < 1:
+            raise ValueError(f"keep must be at least 1, got {keep}")
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.backup_dir = backup_dir
+        self.interval = interval
+        self.keep = keep
+        self.pages_per_step = pages_per_step
+        self.step_sleep = step_sleep
+        # connect() - соединение с базой, где лежит backup_state; без него расписание и статус только в памяти
+        self.connect = connect
+        self.poll_interval = poll_interval
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.status = {
+            "running": False,
+            "last_snapshot": None,
+            "last_snapshot_at": None,
+            "last_duration_seconds": None,
+            "last_size_bytes": None,
+            "last_error": None
+        }
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        """Запустить периодические снапшоты в фоне"""
+        if self.interval <= 0 or self.thread:
+            return
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.thread = threading.Thread(target=self._loop, daemon=True, name='snapshotter')
+        self.thread.start()
+
+    def _loop(self):
+        while True:
+            if self.connect is None:
+                time.sleep(self.interval)
+                self.snapshot_safely()
+                continue
+            time.sleep(min(self.poll_interval, self.interval))
+            try:
+                if self._claim(due_only=True):
+                    self._run_claimed()
+            except Exception as e:
+                logger.error("Snapshot scheduler error: %s", e)
+
+    def trigger(self):
+        """Снять снапшот в отдельном потоке, если он ещё не идёт"""
+        if self.status["running"]:
+            return False
+        if self.connect is None:
+            threading.Thread(target=self.snapshot_safely, daemon=True).start()
+            return True
+        if not self._claim(due_only=False):
+            return False
+        threading.Thread(target=self._run_claimed, daemon=True).start()
+        return True
+
+    def snapshot_safely(self):
+        try:
+            return self.snapshot()
+        except Exception as e:
+            self.status["last_error"] = str(e)
+            logger.error("Snapshot error: %s", e)
+            return None
+
+    def current_status(self):
+        """Статус последнего снапшота: из backup_state (общий для воркеров) или из памяти"""
+        if self.connect is None:
+            return dict(self.status)
+        conn = self.connect()
+        try:
+            row = conn.execute(f'''
+                SELECT {', '.join(STATUS_FIELDS)}, last_success_at, lease_owner, lease_until
+                FROM backup_state WHERE id = 1
+            ''').fetchone()
+        finally:
+            conn.close()
+        status = dict(zip(STATUS_FIELDS, row))
+        status["running"] = row[-1] > time.time()
+        status["running_owner"] = row[-2] if status["running"] else None
+        status["next_snapshot_at"] = row[-3] + self.interval if self.interval > 0 else None
+        return status
+
+    def _claim(self, due_only):
+        """Взять аренду на снапшот; due_only - только если с последнего успешного прошёл интервал"""
+        conn = self.connect()
+        try:
+            now = time.time()
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE backup_state SET lease_owner = ?, lease_until = ?, last_attempt_at = ?
+                WHERE id = 1 AND lease_until < ?
+                  AND (? = 0 OR (last_success_at + ? <= ? AND last_attempt_at + ? <= ?))
+            ''', (self.owner, now + LEASE_SECONDS, now, now,
+                  1 if due_only else 0, self.interval, now, RETRY_SECONDS, now))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def _run_claimed(self):
+        """Снять снапшот под аренду и записать результат в backup_state"""
+        path = self.snapshot_safely()
+        # Неудача меняет только ошибку: прошлый снапшот мог снять другой воркер
+        fields = STATUS_FIELDS if path else ('last_error',)
+        conn = self.connect()
+        try:
+            conn.execute(f'''
+                UPDATE backup_state SET {', '.join(f"{field} = ?" for field in fields)},
+                    last_success_at = CASE WHEN ? THEN ? ELSE last_success_at END,
+                    lease_owner = NULL, lease_until = 0
+                WHERE id = 1 AND lease_owner = ?
+            ''', (*(self.status[field] for field in fields), path is not None, time.time(), self.owner))
+            conn.commit()
+        finally:
+            conn.close()
+        return path
+
+    def snapshot(self):
+        """Снять, проверить, сжать и ротировать снапшот; вернуть путь к архиву"""
+        if not self.lock.acquire(blocking=False):
+            return None
+        os.makedirs(self.backup_dir, exist_ok=True)
+        # Межпроцессная блокировка: при нескольких воркерах снапшот снимает один
+        lock_file = open(os.path.join(self.backup_dir, '.snapshot.lock'), 'w')
+        try:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+
+            self.status["running"] = True
+            started = time.monotonic()
+            name = os.path.splitext(os.path.basename(self.db_path))[0]
+            stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+            target = os.path.join(self.backup_dir, f"{name}-{stamp}.db.gz")
+            # (схема на исходном соединении, временная копия, архив)
+            parts = [('main', os.path.join(self.backup_dir, f".{name}-{stamp}.db.tmp"), target)]
+            if self.archive_path and os.path.exists(self.archive_path):
+                parts.append(('archive', os.path.join(self.backup_dir, f".{name}-{stamp}.archive.db.tmp"),
+                              archive_companion(target)))
+
+            try:
+                self._copy(parts)
+                for _, tmp_path, _ in parts:
+                    check = sqlite3.connect(tmp_path)
+                    try:
+                        result = check.execute('PRAGMA quick_check').fetchone()[0]
+                    finally:
+                        check.close()
+                    if result != 'ok':
+                        raise sqlite3.DatabaseError(f"Snapshot of {tmp_path} failed quick_check: {result}")
+
+                # Спутник архива - раньше основного файла: по основному ротация считает снапшот готовым
+                for _, tmp_path, path in reversed(parts):
+                    with open(tmp_path, 'rb') as src, gzip.open(path + '.part', 'wb', compresslevel=6) as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+                    os.replace(path + '.part', path)
+            except Exception:
+                for _, _, path in parts:
+                    if os.path.exists(path):
+                        os.remove(path)
+                raise
+            finally:
+                for _, tmp_path, path in parts:
+                    for leftover in (tmp_path, path + '.part'):
+                        if os.path.exists(leftover):
+                            os.remove(leftover)
+
+            self._rotate(name)
+            duration = time.monotonic() - started
+            self.status.update({
+                "last_snapshot": target,
+                "last_snapshot_at": datetime.now().isoformat(),
+                "last_duration_seconds": round(duration, 3),
+                "last_size_bytes": sum(os.path.getsize(path) for _, _, path in parts),
+                "last_error": None
+            })
+            logger.info("Snapshot %s written in %.2fs", target, duration)
+            return target
+        finally:
+            self.status["running"] = False
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+            self.lock.release()
+
+    def _copy(self, parts):
+        """Скопировать базы [(схема, путь копии, ...)] из одной транзакции чтения"""
+        source = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            schemas = [schema for schema, _, _ in parts]
+            if 'archive' in schemas:
+                source.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+            # Снимок WAL каждого файла фиксируется первым чтением из него; основная база раньше
+            # архива: перенос в архив сначала пишет архив, поэтому игрок не пропадёт из обоих
+            source.execute('BEGIN')
+            for schema in schemas:
+                source.execute(f'SELECT COUNT(*) FROM {schema}.sqlite_master').fetchone()
+            try:
+                for schema, tmp_path, _ in parts:
+                    dest = sqlite3.connect(tmp_path)
+                    try:
+                        source.backup(dest, pages=self.pages_per_step, progress=self._throttle, name=schema)
+                    finally:
+                        dest.close()
+            finally:
+                source.execute('COMMIT')
+        finally:
+            source.close()
+
+    def _throttle(self, status, remaining, total):
+        time.sleep(self.step_sleep)
+
+    def _rotate(self, name):
+        snapshots = sorted(path for path in glob.glob(os.path.join(self.backup_dir, f"{name}-*.db.gz"))
+                           if not path.endswith('.archive.db.gz'))
+        for path in snapshots[:-self.keep]:
+            os.remove(path)
+            if os.path.exists(archive_companion(path)):
+                os.remove(archive_companion(path))
+
+
+def archive_companion(snapshot_path):
+    """Путь к снапшоту архива, снятому вместе с основной базой"""
+    return snapshot_path[:-len('.db.gz')] + '.archive.db.gz'
+
+
+def _unpack(snapshot_path, directory):
+    """Распаковать снапшот во временный файл и проверить его целостность"""
+    fd, tmp_path = tempfile.mkstemp(suffix='.db', dir=directory)
+    os.close(fd)
+    try:
+        with gzip.open(snapshot_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        check = sqlite3.connect(tmp_path)
+        try:
+            result = check.execute('PRAGMA integrity_check').fetchone()[0]
+        finally:
+            check.close()
+        if result != 'ok':
+            raise sqlite3.DatabaseError(f"Snapshot {snapshot_path} failed integrity_check: {result}")
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+
+def restore(snapshot_path, db_path, archive_path=None):
+    """Восстановить базу и архив из сжатого снапшота (приложение должно быть остановлено).
+    Обе копии проверяются до того, как перезаписан первый файл"""
+    targets = [(snapshot_path, db_path)]
+    companion = archive_companion(snapshot_path)
+    if archive_path and os.path.exists(companion):
+        targets.append((companion, archive_path))
+    elif archive_path:
+        logger.warning("Snapshot %s has no archive; %s left as is", snapshot_path, archive_path)
+
+    unpacked = []
+    try:
+        for path, target_path in targets:
+            unpacked.append((_unpack(path, os.path.dirname(os.path.abspath(target_path))), target_path))
+        for tmp_path, target_path in unpacked:
+            source = sqlite3.connect(tmp_path)
+            try:
+                target = sqlite3.connect(target_path)
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+            finally:
+                source.close()
+    finally:
+        for tmp_path, _ in unpacked:
+            os.remove(tmp_path)
+    logger.info("Database %s restored from %s", db_path, snapshot_path)
+    if len(targets) > 1:
+        logger.info("Archive %s restored from %s", archive_path, companion)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Снапшоты и восстановление базы VELN')
+    parser.add_argument('command', choices=['snapshot', 'restore'])
+    parser.add_argument('snapshot', nargs='?', help='Путь к .db.gz для restore')
+    parser.add_argument('--db', default=os.environ.get('DATABASE_PATH', 'veln_game.db'))
+    parser.add_argument('--archive-db', default=os.environ.get('ARCHIVE_DATABASE_PATH'),
+                        help='Архив неактивных игроков (по умолчанию <db>-archive.db, как у сервера)')
+    parser.add_argument('--dir', default=os.environ.get('BACKUP_DIR', 'backups'))
+    parser.add_argument('--keep', type=int, default=int(os.environ.get('BACKUP_KEEP', 24)))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    archive_path = args.archive_db or os.path.splitext(args.db)[0] + '-archive.db'
+    if args.command == 'snapshot':
+        path = Snapshotter(args.db, args.dir, keep=args.keep, step_sleep=0, archive_path=archive_path).snapshot()
+        print(path)
+        return 0 if path else 1
+    if not args.snapshot:
+        parser.error('restore requires a snapshot path')
+    restore(args.snapshot, args.db, archive_path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
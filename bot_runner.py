@@ -0,0 +1,152 @@
+"""Отдельный процесс бота: long polling getUpdates вместо /webhook.
+
+Обновления забираются пачками до 100 штук и обрабатываются параллельно теми же
+handle_*_command, что и webhook. Обновления одного чата идут последовательно,
+разные чаты - одновременно. Смещение подтверждается (следующим getUpdates с
+offset) только после обработки всей пачки, поэтому при падении процесса пачка
+придёт снова.
+
+Запуск: python bot_runner.py (PUBLIC_URL - адрес веб-сервера для кнопки игры,
+TELEGRAM_API_URL - можно указать локальный фейк Bot API).
+
+Бот меняет то же, что кешируют веб-воркеры (регистрации, друзья, возврат из
+архива), поэтому ему нужна общая с ними шина CLUSTER_BUS_URL. Локальную шину
+gunicorn поднимает на случайном порту, и её адрес знает только мастер - без
+явного CLUSTER_BUS_URL процесс бота не запускается.
+"""
+import os
+import sys
+import time
+import signal
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Снапшоты, сверку балансов и архивацию делает веб-процесс
+os.environ.setdefault('BACKUP_INTERVAL_SECONDS', '0')
+os.environ.setdefault('RECONCILE_INTERVAL_SECONDS', '0')
+os.environ.setdefault('ARCHIVE_INTERVAL_SECONDS', '0')
+
+import requests
+import server
+from tracing import tracer
+
+logger = logging.getLogger('bot_runner')
+
+BOT_POLL_TIMEOUT = int(os.environ.get('BOT_POLL_TIMEOUT', 30))
+BOT_BATCH_SIZE = min(int(os.environ.get('BOT_BATCH_SIZE', 100)), 100)
+BOT_WORKERS = int(os.environ.get('BOT_WORKERS', 8))
+
+
+def update_chat_id(update):
+    """Чат, к которому относится обновление (для порядка внутри чата)"""
+    if 'message' in update:
+        return update['message'].get('chat', {}).get('id')
+    if 'callback_query' in update:
+        return update['callback_query'].get('message', {}).get('chat', {}).get('id')
+    return None
+
+
+class BotRunner:
+    """Цикл getUpdates с пакетной параллельной обработкой"""
+
+    def __init__(self, token, api_url, workers=BOT_WORKERS, batch_size=BOT_BATCH_SIZE,
+                 poll_timeout=BOT_POLL_TIMEOUT):
+        self.api = f"{api_url}/bot{token}"
+        self.batch_size = batch_size
+        self.poll_timeout = poll_timeout
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bot')
+        self.offset = None
+        self.running = True
+
+    def call(self, method, http_timeout=10, **params):
+        response = self.session.post(f"{self.api}/{method}", json=params, timeout=http_timeout)
+        data = response.json()
+        if not data.get('ok'):
+            raise RuntimeError(f"{method} failed: {data.get('description')}")
+        return data['result']
+
+    def fetch_updates(self):
+        params = {
+            'limit': self.batch_size,
+            'timeout': self.poll_timeout,
+            'allowed_updates': ['message', 'callback_query']
+        }
+        if self.offset is not None:
+            params['offset'] = self.offset
+        return self.call('getUpdates', http_timeout=self.poll_timeout + 10, **params)
+
+    def handle_chat_updates(self, updates):
+        for update in updates:
+            command = update.get('message', {}).get('text', '').split(' ', 1)[0] or 'update'
+            token = tracer.start_trace(f"BOT {command}", f"update-{update['update_id']}")
+            try:
+                server.process_update(update)
+            except Exception as e:
+                # Ошибочное обновление не должно блокировать смещение
+                logger.error("Update %s failed: %s", update.get('update_id'), e)
+            finally:
+                tracer.finish_trace(token)
+
+    def process_batch(self, updates):
+        """Обработать пачку и вернуть следующее смещение"""
+        by_chat = OrderedDict()
+        for update in updates:
+            by_chat.setdefault(update_chat_id(update), []).append(update)
+        futures = [self.executor.submit(self.handle_chat_updates, chat_updates)
+                   for chat_updates in by_chat.values()]
+        wait(futures)
+        return max(update['update_id'] for update in updates) + 1
+
+    def run_once(self):
+        updates = self.fetch_updates()
+        if updates:
+            self.offset = self.process_batch(updates)
+            logger.info("Processed %s updates, next offset %s", len(updates), self.offset)
+        return len(updates)
+
+    def run(self):
+        # getUpdates не работает, пока установлен webhook
+        self.call('deleteWebhook')
+        logger.info("Bot long polling started")
+        backoff = 1
+        while self.running:
+            try:
+                self.run_once()
+                backoff = 1
+            except Exception as e:
+                logger.error("getUpdates error: %s", e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 60)
+        # Подтверждаем последнюю обработанную пачку перед выходом
+        if self.offset is not None:
+            try:
+                self.call('getUpdates', offset=self.offset, limit=1, timeout=0)
+            except Exception as e:
+                logger.error("Offset commit on shutdown failed: %s", e)
+        self.executor.shutdown(wait=True)
+
+    def stop(self, *args):
+        self.running = False
+
+
+def main():
+    if not server.BOT_TOKEN or server.BOT_TOKEN == 'your_bot_token_here':
+        logger.error("BOT_TOKEN not configured")
+        return 1
+    if not server.CLUSTER_BUS_URL:
+        logger.error("CLUSTER_BUS_URL not configured: the bot process must share the bus with the web "
+                     "workers, otherwise their caches never see its changes")
+        return 1
+    if not server.PUBLIC_URL:
+        logger.warning("PUBLIC_URL not set, game buttons will have relative links")
+    runner = BotRunner(server.BOT_TOKEN, server.TELEGRAM_API_URL)
+    signal.signal(signal.SIGTERM, runner.stop)
+    signal.signal(signal.SIGINT, runner.stop)
+    runner.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""Сообщения бота: шаблоны разбираются один раз, клавиатуры сериализуются один раз.
+
+Тексты команд - Template с полями {name}: строка разбирается при импорте, а
+на каждое обновление остаётся только подставить значения и склеить части.
+Значения-строки экранируются для parse_mode=HTML (имена игроков приходят от
+пользователей); готовые HTML-фрагменты передаются обёрнутыми в Raw.
+
+Разметка inline-клавиатуры зависит только от адреса сервера, поэтому
+KeyboardCache хранит уже сериализованный reply_markup на каждый адрес и
+send_message отправляет его как есть, без json.dumps на каждое сообщение.
+
+Замер стоимости обработчиков на одно обновление:
+
+    python botmessages.py bench --updates 20000
+"""
+import os
+import sys
+import html
+import json
+import time
+import string
+import argparse
+import tempfile
+
+MAX_CACHED_HOSTS = 64
+
+
+class Raw(str):
+    """Готовый HTML-фрагмент - подставляется без экранирования"""
+
+
+class Template:
+    """Текст с полями {name} или {name:spec}; static - текст без полей"""
+
+    __slots__ = ('source', 'parts', 'fields', 'static')
+
+    def __init__(self, source):
+        self.source = source
+        self.parts = []
+        self.fields = []
+        for literal, name, spec, conversion in string.Formatter().parse(source):
+            if literal:
+                self.parts.append(literal)
+            if name is not None:
+                self.fields.append((len(self.parts), name, spec or ''))
+                self.parts.append(None)
+        self.static = None if self.fields else ''.join(self.parts)
+
+    def render(self, **values):
+        if self.static is not None:
+            return self.static
+        parts = self.parts[:]
+        for i, name, spec in self.fields:
+            value = values[name]
+            if type(value) is str and ('<' in value or '>' in value or '&' in value):
+                value = html.escape(value, quote=False)
+            parts[i] = format(value, spec)
+        return ''.join(parts)
+
+
+class KeyboardCache:
+    """Сериализованный reply_markup на каждый адрес сервера"""
+
+    def __init__(self, build):
+        # build(base_url) -> dict клавиатуры
+        self.build = build
+        self.cache = {}
+
+    def get(self, base_url):
+        markup = self.cache.get(base_url)
+        if markup is None:
+            markup = json.dumps(self.build(base_url), ensure_ascii=False, separators=(',', ':'))
+            # Host приходит из запроса - не даём раздуть кеш чужими адресами
+            if len(self.cache) < MAX_CACHED_HOSTS:
+                self.cache[base_url] = markup
+        return markup
+
+
+def bench(updates):
+    """Время обработчиков на обновление: разбор шаблона и json.dumps каждый раз против кеша"""
+    workdir = tempfile.mkdtemp(prefix='veln-bench-')
+    os.environ['DATABASE_PATH'] = os.path.join(workdir, 'bench.db')
+    os.environ['BOT_TOKEN'] = ''
+    for name in ('BACKUP_INTERVAL_SECONDS', 'RECONCILE_INTERVAL_SECONDS', 'ARCHIVE_INTERVAL_SECONDS'):
+        os.environ[name] = '0'
+    import logging
+    logging.disable(logging.CRITICAL)
+    import server
+
+    base_url = 'https://veln.example.com'
+    names = ['Алиса', 'Bob <script>', 'Игрок', 'Tom & Jerry']
+    board = [(i, f"user{i}", names[i % len(names)], 1000000 - i * 777) for i in range(10)]
+    cases = {
+        'start': (server.START_TEXT, {'first_name': 'Алиса', 'referral_note': Raw('')}),
+        'help': (server.HELP_TEXT, {}),
+        'stats': (server.STATS_TEXT, {'first_name': 'Алиса', 'points': 123456, 'rank_prefix': '~',
+                                      'rank': 1234, 'total_players': 56789, 'top_percent': 2.17,
+                                      'played_since': '2024-05-01'}),
+    }
+
+    def legacy_leaderboard():
+        text = "🏆 <b>Таблица лидеров</b>\n\n"
+        for i, player in enumerate(board, 1):
+            values = {'emoji': server.PLACE_EMOJI[min(i, 4) - 1], 'place': i, 'highlight': '',
+                      'name': player[2], 'points': player[3]}
+            text += server.LEADERBOARD_ROW.source.format(**values)
+        return text + server.LEADERBOARD_FOOTER.source
+
+    print(f"{'handler':<13}{'legacy us':>11}{'compiled us':>13}{'speedup':>9}")
+    for name in list(cases) + ['leaderboard']:
+        if name == 'leaderboard':
+            def legacy():
+                legacy_leaderboard()
+                json.dumps(server.build_game_keyboard(base_url))
+
+            def compiled():
+                server.render_leaderboard("🏆 <b>Таблица лидеров</b>", board, None)
+                server.game_keyboards.get(base_url)
+        else:
+            template, values = cases[name]
+
+            def legacy(template=template, values=values):
+                template.source.format(**values)
+                json.dumps(server.build_game_keyboard(base_url))
+
+            def compiled(template=template, values=values):
+                template.render(**values)
+                server.game_keyboards.get(base_url)
+
+        timings = []
+        for func in (legacy, compiled):
+            start = time.process_time()
+            for _ in range(updates):
+                func()
+            timings.append((time.process_time() - start) / updates * 1e6)
+        print(f"{name:<13}{timings[0]:>11.2f}{timings[1]:>13.2f}{timings[0] / timings[1]:>8.1f}x")
+
+    # Полный путь обновления через process_update (без сети: BOT_TOKEN пуст)
+    server.register_user_from_telegram({'id': 1, 'first_name': 'Алиса', 'username': 'alice'})
+    for text in ('/help', '/stats', '/leaderboard'):
+        update = {'message': {'chat': {'id': 1}, 'from': {'id': 1}, 'text': text}}
+        start = time.process_time()
+        for _ in range(updates // 10):
+            server.process_update(update)
+        per_update = (time.process_time() - start) / (updates // 10) * 1e6
+        print(f"process_update {text:<13}{per_update:>9.1f} us CPU")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Шаблоны сообщений бота')
+    parser.add_argument('command', choices=['bench'])
+    parser.add_argument('--updates', type=int, default=20000)
+    args = parser.parse_args(argv)
+    bench(args.updates)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
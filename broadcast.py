@@ -0,0 +1,354 @@
+"""Массовые рассылки всем зарегистрированным пользователям.
+
+Задача рассылки живёт в broadcast_jobs, получатели - в broadcast_recipients.
+Получатели переносятся из users порциями по id (keyset paging), курсор
+сохраняется в задаче, поэтому и постановка в очередь, и отправка продолжаются
+после падения процесса. Отправка идёт в несколько соединений под общим
+ограничителем скорости; 429 от Telegram приостанавливает ограничитель на
+retry_after, 403 помечает пользователя заблокировавшим бота.
+
+Задачу одновременно обрабатывает только один процесс: он держит аренду
+(lease_owner/lease_until) и продлевает её после каждой порции.
+"""
+import os
+import time
+import uuid
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+ENQUEUE_CHUNK = 1000
+SEND_PAGE = 200
+MAX_ATTEMPTS = 3
+LEASE_SECONDS = 60
+
+
+def init_tables(cursor):
+    """Создать таблицы рассылок и колонку is_blocked в users"""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(users)')]
+    if 'is_blocked' not in columns:
+        cursor.execute('ALTER TABLE users ADD COLUMN is_blocked INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'enqueuing',
+            enqueue_cursor INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_until REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (job_id, telegram_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_status
+        ON broadcast_recipients (job_id, status, telegram_id)
+    ''')
+
+
+class RateLimiter:
+    """Равномерный ограничитель скорости, общий для всех соединений"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(self.next_at, now)
+            self.next_at = at + self.interval
+        if at > now:
+            time.sleep(at - now)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.next_at = max(self.next_at, time.monotonic() + seconds)
+
+
+class BroadcastEngine:
+    """Фоновая отправка рассылок с возобновлением после сбоя"""
+
+    def __init__(self, connect, bot_token, api_url='https://api.telegram.org',
+                 rate=25, connections=8, poll_interval=5):
+        self.connect = connect
+        self.send_url = f"{api_url}/bot{bot_token}/sendMessage"
+        self.limiter = RateLimiter(rate)
+        self.connections = connections
+        self.poll_interval = poll_interval
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.local = threading.local()
+        self.thread = None
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self._loop, daemon=True, name='broadcast')
+        self.thread.start()
+
+    def create_job(self, text):
+        """Создать рассылку; получатели добавятся в очередь фоновым потоком"""
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('INSERT INTO broadcast_jobs (text) VALUES (?)', (text,))
+            conn.commit()
+            return cursor.lastrowid
+        finally:
+            conn.close()
+
+    def cancel_job(self, job_id):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE broadcast_jobs SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND status IN ('enqueuing', 'sending')
+            ''', (job_id,))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def progress(self, job_id):
+        """Счётчики задачи для отчёта о прогрессе"""
+        conn = self.connect()
+        try:
+            row = conn.execute('''
+                SELECT id, status, total, sent, failed, blocked, created_at, finished_at
+                FROM broadcast_jobs WHERE id = ?
+            ''', (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        job = dict(zip(('id', 'status', 'total', 'sent', 'failed', 'blocked', 'created_at', 'finished_at'), row))
+        done = job['sent'] + job['failed'] + job['blocked']
+        job['pending'] = max(job['total'] - done, 0)
+        job['percent'] = round(done * 100 / job['total'], 1) if job['total'] else 0.0
+        return job
+
+    def backlog(self):
+        """Неотправленные сообщения активных рассылок и задачи, которые никто не ведёт"""
+        conn = self.connect()
+        try:
+            rows = conn.execute('''
+                SELECT total - sent - failed - blocked, lease_until, CAST(strftime('%s', created_at) AS REAL)
+                FROM broadcast_jobs WHERE status IN ('enqueuing', 'sending')
+            ''').fetchall()
+        finally:
+            conn.close()
+        stale = time.time() - LEASE_SECONDS
+        return {
+            "active_jobs": len(rows),
+            "pending": sum(max(pending, 0) for pending, _, _ in rows),
+            # Аренда давно истекла (или задачу так и не взяли) - отправляющий процесс завис или не запущен
+            "stalled_jobs": sum(1 for _, lease_until, created_at in rows if max(lease_until, created_at or 0) < stale)
+        }
+
+    def _loop(self):
+        executor = ThreadPoolExecutor(max_workers=self.connections, thread_name_prefix='broadcast-send')
+        while True:
+            try:
+                job = self._claim_job()
+                if job:
+                    self._process(job, executor)
+                    continue
+            except Exception as e:
+                logger.error("Broadcast engine error: %s", e)
+            time.sleep(self.poll_interval)
+
+    def _claim_job(self):
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            now = time.time()
+            cursor.execute('''
+                UPDATE broadcast_jobs SET lease_owner = ?, lease_until = ?
+                WHERE id = (
+                    SELECT id FROM broadcast_jobs
+                    WHERE status IN ('enqueuing', 'sending')
+                      AND (lease_until < ? OR lease_owner = ?)
+                    ORDER BY id LIMIT 1
+                )
+            ''', (self.owner, now + LEASE_SECONDS, now, self.owner))
+            conn.commit()
+            if cursor.rowcount == 0:
+                return None
+            return cursor.execute('''
+                SELECT id, text, status, enqueue_cursor FROM broadcast_jobs
+                WHERE lease_owner = ? AND status IN ('enqueuing', 'sending')
+                ORDER BY id LIMIT 1
+            ''', (self.owner,)).fetchone()
+        finally:
+            conn.close()
+
+    def _renew(self, cursor, job_id):
+        """Продлить аренду; False, если задачу отменили или забрали"""
+        cursor.execute('''
+            UPDATE broadcast_jobs SET lease_until = ?
+            WHERE id = ? AND lease_owner = ? AND status IN ('enqueuing', 'sending')
+        ''', (time.time() + LEASE_SECONDS, job_id, self.owner))
+        return cursor.rowcount > 0
+
+    def _process(self, job, executor):
+        job_id, text, status, enqueue_cursor = job
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            if status == 'enqueuing' and not self._enqueue(conn, cursor, job_id, enqueue_cursor):
+                return
+            self._send_pending(conn, cursor, job_id, text, executor)
+        finally:
+            conn.close()
+
+    def _enqueue(self, conn, cursor, job_id, last_id):
+        while True:
+            rows = cursor.execute('''
+                SELECT id, telegram_id FROM users
+                WHERE id > ? AND is_blocked = 0
+                ORDER BY id LIMIT ?
+            ''', (last_id, ENQUEUE_CHUNK)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            cursor.executemany(
+                'INSERT OR IGNORE INTO broadcast_recipients (job_id, telegram_id) VALUES (?, ?)',
+                [(job_id, row[1]) for row in rows]
+            )
+            cursor.execute('''
+                UPDATE broadcast_jobs SET enqueue_cursor = ?, total = total + ?
+                WHERE id = ?
+            ''', (last_id, cursor.rowcount, job_id))
+            if not self._renew(cursor, job_id):
+                conn.commit()
+                return False
+            conn.commit()
+        cursor.execute("UPDATE broadcast_jobs SET status = 'sending' WHERE id = ? AND status = 'enqueuing'", (job_id,))
+        conn.commit()
+        logger.info("Broadcast %s enqueued", job_id)
+        return True
+
+    def _send_pending(self, conn, cursor, job_id, text, executor):
+        while True:
+            # Каждый проход идёт по pending keyset-страницами; неудачные отправки остаются pending
+            after, seen = 0, 0
+            while True:
+                recipients = [row[0] for row in cursor.execute('''
+                    SELECT telegram_id FROM broadcast_recipients
+                    WHERE job_id = ? AND status = 'pending' AND telegram_id > ?
+                    ORDER BY telegram_id LIMIT ?
+                ''', (job_id, after, SEND_PAGE))]
+                if not recipients:
+                    break
+                after = recipients[-1]
+                seen += len(recipients)
+                results = list(executor.map(lambda chat_id: self._send(chat_id, text), recipients))
+                self._record(cursor, job_id, recipients, results)
+                alive = self._renew(cursor, job_id)
+                conn.commit()
+                if not alive:
+                    logger.info("Broadcast %s cancelled or lease lost", job_id)
+                    return
+            if not seen:
+                break
+
+        cursor.execute('''
+            UPDATE broadcast_jobs SET status = 'done', finished_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status = 'sending'
+        ''', (job_id,))
+        conn.commit()
+        logger.info("Broadcast %s finished", job_id)
+
+    def _record(self, cursor, job_id, recipients, results):
+        """Записать статусы получателей и счётчики задачи"""
+        counts = {'sent': 0, 'failed': 0, 'blocked': 0}
+        updates, retries, blocked_users = [], [], []
+        for chat_id, (status, error) in zip(recipients, results):
+            if status == 'throttled':
+                # Ограничение Telegram - не вина получателя, попытку не засчитываем
+                continue
+            if status == 'retry':
+                retries.append((error, job_id, chat_id))
+                continue
+            counts[status] += 1
+            updates.append((status, error, job_id, chat_id))
+            if status == 'blocked':
+                blocked_users.append((chat_id,))
+
+        # Временные ошибки: после MAX_ATTEMPTS попыток получатель считается failed
+        for error, _, chat_id in retries:
+            row = cursor.execute(
+                'SELECT attempts FROM broadcast_recipients WHERE job_id = ? AND telegram_id = ?',
+                (job_id, chat_id)
+            ).fetchone()
+            if row and row[0] + 1 >= MAX_ATTEMPTS:
+                counts['failed'] += 1
+                updates.append(('failed', error, job_id, chat_id))
+        cursor.executemany('''
+            UPDATE broadcast_recipients
+            SET attempts = attempts + 1, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND telegram_id = ?
+        ''', retries)
+        cursor.executemany('''
+            UPDATE broadcast_recipients
+            SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND telegram_id = ?
+        ''', updates)
+        # Заблокировавших бота больше не ставим в рассылки
+        cursor.executemany('UPDATE users SET is_blocked = 1 WHERE telegram_id = ?', blocked_users)
+        cursor.execute('''
+            UPDATE broadcast_jobs SET sent = sent + ?, failed = failed + ?, blocked = blocked + ?
+            WHERE id = ?
+        ''', (counts['sent'], counts['failed'], counts['blocked'], job_id))
+
+    def _session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def _send(self, chat_id, text):
+        """Отправить одно сообщение; вернуть (статус, ошибка)"""
+        self.limiter.acquire()
+        try:
+            response = self._session().post(self.send_url, data={
+                'chat_id': chat_id,
+                'text': text,
+                'parse_mode': 'HTML'
+            }, timeout=10)
+            data = response.json()
+        except Exception as e:
+            return 'retry', str(e)[:200]
+
+        if data.get('ok'):
+            return 'sent', None
+        error = data.get('description', '')[:200]
+        code = data.get('error_code')
+        if code == 429:
+            self.limiter.pause(data.get('parameters', {}).get('retry_after', 1))
+            return 'throttled', error
+        if code == 403:
+            return 'blocked', error
+        if code == 400:
+            return 'failed', error
+        return 'retry', error
@@ -0,0 +1,269 @@
+"""Шина инвалидации между узлами и воркерами (протокол Redis pub/sub).
+
+Каждый процесс публикует изменения (новый пользователь, новый баланс) в канал
+и подписан на него же: чужие сообщения обновляют локальные производные
+структуры - гистограмму мест, версии ETag - так, будто запись была сделана
+здесь. Публикация идёт из фонового потока и не задерживает запрос. После
+обрыва связи вызывается on_resync: пропущенные сообщения не восстановить,
+поэтому состояние перечитывается целиком.
+
+Вместо Redis локально можно запустить заглушку:
+    python cluster.py serve --port 6380
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import socket
+import argparse
+import threading
+import socketserver
+import logging
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'veln:invalidate'
+
+
+def encode_command(*args):
+    """Команда в формате RESP (массив bulk-строк)"""
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b''.join(parts)
+
+
+def read_reply(reader):
+    """Прочитать один ответ RESP из файлового объекта сокета"""
+    line = reader.readline()
+    if not line:
+        raise ConnectionError("Connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest.decode()
+    if kind == b'-':
+        raise RuntimeError(rest.decode())
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = reader.read(length + 2)
+        return data[:-2]
+    if kind == b'*':
+        return [read_reply(reader) for _ in range(int(rest))]
+    raise ConnectionError(f"Bad RESP reply: {line!r}")
+
+
+class RespConnection:
+    """Одно соединение с Redis-совместимым сервером"""
+
+    def __init__(self, url, timeout=None):
+        parsed = urlparse(url)
+        self.sock = socket.create_connection((parsed.hostname or 'localhost', parsed.port or 6379), timeout=5)
+        self.sock.settimeout(timeout)
+        self.reader = self.sock.makefile('rb')
+        if parsed.password:
+            self.command('AUTH', parsed.password)
+
+    def send(self, *args):
+        self.sock.sendall(encode_command(*args))
+
+    def command(self, *args):
+        self.send(*args)
+        return read_reply(self.reader)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ClusterBus:
+    """Публикация и приём сообщений об изменениях между процессами"""
+
+    def __init__(self, url, on_message, on_resync=None, channel=CHANNEL):
+        self.url = url
+        self.on_message = on_message
+        self.on_resync = on_resync
+        self.channel = channel
+        self.node_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.outbox = queue.Queue(maxsize=10000)
+        self.connected = False
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+
+    def start(self):
+        # Объект мог быть создан в мастере gunicorn до fork - id узла берём по pid воркера
+        self.node_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        threading.Thread(target=self._publish_loop, daemon=True, name='cluster-publish').start()
+        threading.Thread(target=self._subscribe_loop, daemon=True, name='cluster-subscribe').start()
+
+    def publish(self, message):
+        """Поставить сообщение в очередь на публикацию"""
+        message = dict(message, node=self.node_id)
+        try:
+            self.outbox.put_nowait(json.dumps(message, separators=(',', ':')))
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {
+            "node_id": self.node_id,
+            "connected": self.connected,
+            "published": self.published,
+            "received": self.received,
+            "dropped": self.dropped,
+            "outbox": self.outbox.qsize()
+        }
+
+    def _publish_loop(self):
+        conn = None
+        while True:
+            payload = self.outbox.get()
+            while True:
+                try:
+                    if conn is None:
+                        conn = RespConnection(self.url, timeout=5)
+                    conn.command('PUBLISH', self.channel, payload)
+                    self.published += 1
+                    break
+                except Exception as e:
+                    logger.error("Cluster publish error: %s", e)
+                    if conn:
+                        conn.close()
+                    conn = None
+                    time.sleep(1)
+
+    def _subscribe_loop(self):
+        first = True
+        while True:
+            conn = None
+            try:
+                conn = RespConnection(self.url)
+                conn.command('SUBSCRIBE', self.channel)
+                self.connected = True
+                if not first and self.on_resync:
+                    self.on_resync()
+                first = False
+                while True:
+                    reply = read_reply(conn.reader)
+                    if isinstance(reply, list) and len(reply) == 3 and reply[0] == b'message':
+                        self._dispatch(reply[2])
+            except Exception as e:
+                logger.error("Cluster subscribe error: %s", e)
+            finally:
+                self.connected = False
+                if conn:
+                    conn.close()
+            time.sleep(1)
+
+    def _dispatch(self, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            return
+        if message.get('node') == self.node_id:
+            return
+        self.received += 1
+        try:
+            self.on_message(message)
+        except Exception as e:
+            logger.error("Cluster message error: %s", e)
+
+
+class MiniBusServer(socketserver.ThreadingTCPServer):
+    """Локальная заглушка Redis: PING, PUBLISH, SUBSCRIBE"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, MiniBusHandler)
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def publish(self, channel, data):
+        with self.lock:
+            targets = list(self.subscribers.get(channel, ()))
+        message = encode_command('message', channel, data)
+        delivered = 0
+        for handler in targets:
+            try:
+                with handler.write_lock:
+                    handler.request.sendall(message)
+                delivered += 1
+            except OSError:
+                pass
+        return delivered
+
+
+class MiniBusHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.write_lock = threading.Lock()
+        channels = []
+        try:
+            while True:
+                args = read_reply(self.rfile)
+                if not isinstance(args, list) or not args:
+                    break
+                name = args[0].upper()
+                if name == b'PING':
+                    self._write(b'+PONG\r\n')
+                elif name == b'PUBLISH':
+                    count = self.server.publish(args[1].decode(), args[2])
+                    self._write(b':%d\r\n' % count)
+                elif name == b'SUBSCRIBE':
+                    for i, channel in enumerate(args[1:], 1):
+                        channel = channel.decode()
+                        with self.server.lock:
+                            self.server.subscribers.setdefault(channel, set()).add(self)
+                        channels.append(channel)
+                        # Ответ: *3 ["subscribe", channel, число подписок]
+                        self._write(b'*3\r\n' + encode_command('subscribe', channel)[4:] + b':%d\r\n' % i)
+                else:
+                    self._write(b'-ERR unknown command\r\n')
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.server.lock:
+                for channel in channels:
+                    self.server.subscribers.get(channel, set()).discard(self)
+
+    def _write(self, data):
+        with self.write_lock:
+            self.request.sendall(data)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Локальная заглушка шины инвалидации')
+    parser.add_argument('command', choices=['serve'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6380)
+    parser.add_argument('--exit-with-parent', action='store_true',
+                        help='Завершиться вместе с запустившим процессом (мастером gunicorn)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    server = MiniBusServer((args.host, args.port))
+    if args.exit_with_parent:
+        parent = os.getppid()
+        
+        def watch_parent():
+            while os.getppid() == parent:
+                time.sleep(1)
+            server.shutdown()
+        threading.Thread(target=watch_parent, daemon=True).start()
+    logger.info("Mini bus listening on %s:%s", args.host, args.port)
+    server.serve_forever()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
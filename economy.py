@@ -0,0 +1,320 @@
+"""Экономика очков: скорость начисления считается на сервере.
+
+Клиент по-прежнему тикает раз в секунду и присылает в /v1/sync число
+секунд игры; сервер переводит их в очки по эффективной скорости игрока на
+момент, когда эти секунды сыграны (price), а не на момент запроса:
+
+    rate = min((base_rate + upgrade_levels[уровень]) * множитель событий
+               * произведение активных бустов игрока, max_rate)
+
+Правила (базовая скорость, уровни улучшений, глобальные события с окнами
+времени) лежат в JSON-файле и компилируются в RuleTable: события
+превращаются в отрезки времени с готовым множителем, текущий отрезок
+кешируется, так что расчёт на каждый sync - O(1) без запросов к базе. Файл
+перечитывается на лету при изменении mtime (проверка не чаще reload_interval).
+
+Персональные бусты и уровни улучшений хранятся в базе и держатся в памяти
+словарём; выдача через /admin/economy/* рассылает инвалидацию по шине.
+
+Пример файла правил:
+
+    {"base_rate": 1, "max_rate": 20, "upgrade_levels": [0, 0.25, 0.5, 1],
+     "events": [{"name": "weekend", "multiplier": 2,
+                 "start": "2024-06-01T00:00:00Z", "end": "2024-06-03T00:00:00Z"}]}
+"""
+import os
+import time
+import json
+import bisect
+import threading
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RULES = {"base_rate": 1, "max_rate": 20, "upgrade_levels": [0], "events": []}
+# Истёкший буст держится в памяти ещё сутки: секунды, сыгранные под ним, могут прийти в sync позже
+BOOST_GRACE_SECONDS = 86400
+
+
+class RulesError(ValueError):
+    """Файл правил не разобрать или значения вне допустимых"""
+
+
+def init_tables(cursor):
+    """Создать таблицы бустов и улучшений, колонку rate в журнале транзакций"""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(transactions)')]
+    if 'rate' not in columns:
+        # Скорость, по которой секунды игры переведены в очки (NULL - прямое начисление)
+        cursor.execute('ALTER TABLE transactions ADD COLUMN rate REAL')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS economy_boosts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            multiplier REAL NOT NULL,
+            starts_at INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            source TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_economy_boosts_user ON economy_boosts (telegram_id, expires_at)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS economy_upgrades (
+            telegram_id INTEGER PRIMARY KEY,
+            level INTEGER NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _parse_time(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        raise RulesError(f"Bad event time: {value!r}")
+
+
+def _positive(rules, key):
+    value = rules.get(key, DEFAULT_RULES[key])
+    if not isinstance(value, (int, float)) or value <= 0:
+        raise RulesError(f"{key} must be a positive number")
+    return float(value)
+
+
+class RuleTable:
+    """Скомпилированные правила: отрезки событий и таблица бонусов уровней"""
+
+    def __init__(self, rules, version=''):
+        if not isinstance(rules, dict):
+            raise RulesError("Rules must be a JSON object")
+        self.version = version
+        self.base_rate = _positive(rules, 'base_rate')
+        self.max_rate = _positive(rules, 'max_rate')
+        levels = rules.get('upgrade_levels', DEFAULT_RULES['upgrade_levels'])
+        if not isinstance(levels, list) or not levels or not all(isinstance(x, (int, float)) and x >= 0
+                                                                   for x in levels):
+            raise RulesError("upgrade_levels must be a non-empty list of non-negative numbers")
+        self.upgrade_levels = tuple(float(x) for x in levels)
+
+        events = []
+        for event in rules.get('events', []):
+            try:
+                name, multiplier = str(event['name']), float(event['multiplier'])
+                start, end = _parse_time(event['start']), _parse_time(event['end'])
+            except (KeyError, TypeError, ValueError) as e:
+                raise RulesError(f"Bad event {event!r}: {e}")
+            if multiplier <= 0 or end <= start:
+                raise RulesError(f"Event {name}: multiplier must be > 0 and end after start")
+            events.append((name, multiplier, start, end))
+        self.events = events
+
+        # Границы всех окон делят время на отрезки с постоянным набором событий;
+        # boundaries[i] - начало отрезка i, multipliers[i] и names[i] - его значения
+        points = sorted({t for _, _, start, end in events for t in (start, end)})
+        self.boundaries = [float('-inf')] + points
+        self.multipliers = []
+        self.active_names = []
+        for i, segment_start in enumerate(self.boundaries):
+            probe = points[0] - 1 if i == 0 and points else segment_start
+            active = [(name, m) for name, m, start, end in events if start <= probe < end]
+            multiplier = 1.0
+            for _, m in active:
+                multiplier *= m
+            self.multipliers.append(multiplier)
+            self.active_names.append(tuple(name for name, _ in active))
+        self.current = 0
+
+    def segment(self, now):
+        """Номер отрезка времени; обычно тот же, что в прошлый раз"""
+        i = self.current
+        boundaries = self.boundaries
+        if boundaries[i] <= now and (i + 1 == len(boundaries) or now < boundaries[i + 1]):
+            return i
+        i = bisect.bisect_right(boundaries, now) - 1
+        self.current = i
+        return i
+
+    def valid_until(self, segment):
+        return self.boundaries[segment + 1] if segment + 1 < len(self.boundaries) else None
+
+
+class EconomyEngine:
+    """Эффективная скорость начисления игрока и горячая перезагрузка правил"""
+
+    def __init__(self, rules_path=None, reload_interval=5):
+        self.rules_path = rules_path
+        self.reload_interval = reload_interval
+        self.table = RuleTable(DEFAULT_RULES, version='default')
+        self.rules_mtime = None
+        self.next_check = 0
+        self.last_error = None
+        # игрок -> уровень улучшения; игрок -> [(множитель, начало, конец), ...]
+        self.upgrades = {}
+        self.boosts = {}
+        self.lock = threading.Lock()
+        # Битый файл при старте не должен ронять сервер: остаются правила по умолчанию и last_error
+        self._check_reload()
+
+    def reload(self, force=False):
+        """Перечитать файл правил, если он изменился; при ошибке остаются прежние правила"""
+        self.next_check = time.monotonic() + self.reload_interval
+        if not self.rules_path:
+            return False
+        try:
+            mtime = os.stat(self.rules_path).st_mtime
+        except FileNotFoundError:
+            return False
+        if mtime == self.rules_mtime and not force:
+            return False
+        try:
+            with open(self.rules_path) as f:
+                table = RuleTable(json.load(f), version=f"{int(mtime)}")
+        except (OSError, ValueError) as e:
+            self.last_error = str(e)
+            self.rules_mtime = mtime
+            logger.error("Economy rules not loaded, keeping version %s: %s", self.table.version, e)
+            raise RulesError(str(e))
+        self.table = table
+        self.rules_mtime = mtime
+        self.last_error = None
+        logger.info("Economy rules loaded: version %s, %s events", table.version, len(table.events))
+        return True
+
+    def _check_reload(self):
+        if time.monotonic() >= self.next_check:
+            try:
+                self.reload()
+            except RulesError:
+                pass
+
+    def load(self, conn, now=None):
+        """Загрузить уровни и бусты всех игроков (истёкшие не раньше BOOST_GRACE_SECONDS назад)"""
+        now = int(now or time.time()) - BOOST_GRACE_SECONDS
+        upgrades = dict(conn.execute('SELECT telegram_id, level FROM economy_upgrades WHERE level > 0'))
+        boosts = {}
+        for telegram_id, multiplier, starts_at, expires_at in conn.execute(
+                'SELECT telegram_id, multiplier, starts_at, expires_at FROM economy_boosts WHERE expires_at > ?',
+                (now,)):
+            boosts.setdefault(telegram_id, []).append((multiplier, starts_at, expires_at))
+        with self.lock:
+            self.upgrades, self.boosts = upgrades, boosts
+        logger.info("Economy loaded: %s upgrades, %s players with boosts", len(upgrades), len(boosts))
+
+    def refresh_user(self, conn, telegram_id, now=None):
+        """Перечитать уровень и бусты одного игрока (после выдачи здесь или в другом процессе)"""
+        now = int(now or time.time()) - BOOST_GRACE_SECONDS
+        row = conn.execute('SELECT level FROM economy_upgrades WHERE telegram_id = ?', (telegram_id,)).fetchone()
+        boosts = conn.execute(
+            'SELECT multiplier, starts_at, expires_at FROM economy_boosts WHERE telegram_id = ? AND expires_at > ?',
+            (telegram_id, now)).fetchall()
+        with self.lock:
+            if row and row[0] > 0:
+                self.upgrades[telegram_id] = row[0]
+            else:
+                self.upgrades.pop(telegram_id, None)
+            if boosts:
+                self.boosts[telegram_id] = [tuple(boost) for boost in boosts]
+            else:
+                self.boosts.pop(telegram_id, None)
+
+    def grant_boost(self, cursor, telegram_id, multiplier, duration, source=None, now=None):
+        now = int(now or time.time())
+        cursor.execute('''
+            INSERT INTO economy_boosts (telegram_id, multiplier, starts_at, expires_at, source)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (telegram_id, multiplier, now, now + duration, source))
+        return now + duration
+
+    def set_upgrade(self, cursor, telegram_id, level):
+        if not 0 <= level < len(self.table.upgrade_levels):
+            raise RulesError(f"level must be between 0 and {len(self.table.upgrade_levels) - 1}")
+        cursor.execute('''
+            INSERT INTO economy_upgrades (telegram_id, level) VALUES (?, ?)
+            ON CONFLICT(telegram_id) DO UPDATE SET level = excluded.level, updated_at = CURRENT_TIMESTAMP
+        ''', (telegram_id, level))
+
+    def rate(self, telegram_id, now=None):
+        """Эффективная скорость игрока (очков в секунду)"""
+        return self.explain(telegram_id, now)["rate"]
+
+    def explain(self, telegram_id, now=None):
+        """Скорость и из чего она сложилась"""
+        self._check_reload()
+        now = now or time.time()
+        table = self.table
+        segment = table.segment(now)
+        level = min(self.upgrades.get(telegram_id, 0), len(table.upgrade_levels) - 1)
+        boost = 1.0
+        boost_until = None
+        boosts = self.boosts.get(telegram_id)
+        if boosts:
+            active = [b for b in boosts if b[1] <= now < b[2]]
+            # Чистим по часам, а не по now: цена ранних дельт пакета считается после поздних
+            horizon = time.time() - BOOST_GRACE_SECONDS
+            if any(b[2] <= horizon for b in boosts):
+                with self.lock:
+                    pending = [b for b in boosts if b[2] > horizon]
+                    if pending:
+                        self.boosts[telegram_id] = pending
+                    else:
+                        self.boosts.pop(telegram_id, None)
+            for multiplier, _, expires_at in active:
+                boost *= multiplier
+                boost_until = expires_at if boost_until is None else min(boost_until, expires_at)
+
+        rate = min((table.base_rate + table.upgrade_levels[level]) * table.multipliers[segment] * boost,
+                   table.max_rate)
+        valid_until = table.valid_until(segment)
+        if boost_until is not None:
+            valid_until = boost_until if valid_until is None else min(valid_until, boost_until)
+        return {
+            "rate": round(rate, 4),
+            "base_rate": table.base_rate,
+            "upgrade_level": level,
+            "upgrade_bonus": table.upgrade_levels[level],
+            "event_multiplier": table.multipliers[segment],
+            "events": list(table.active_names[segment]),
+            "boost_multiplier": round(boost, 4),
+            "valid_until": valid_until,
+            "rules_version": table.version
+        }
+
+    def credit(self, seconds, rate):
+        """Очки за секунды игры по скорости (дробная часть отбрасывается)"""
+        return int(seconds * rate)
+
+    def price(self, telegram_id, deltas, window_start, now=None):
+        """Скорость каждой дельты синхронизации на момент, когда её секунды сыграны, а не на момент
+        запроса: буст не должен задним числом умножать накопленную очередь. deltas - [(seq, секунды,
+        время клиента или None)] по возрастанию seq; время ограничивается окном [window_start, now],
+        дельты без времени укладываются встык, заканчиваясь в now. Возвращает {seq: (секунды, скорость)}"""
+        now = now or time.time()
+        priced = {}
+        end = now
+        for seq, seconds, played_at in reversed(deltas):
+            played_at = max(end if played_at is None else min(played_at, end), window_start)
+            priced[seq] = (seconds, self.rate(telegram_id, played_at))
+            end = played_at - seconds
+        return priced
+
+    def credit_priced(self, priced):
+        """Очки за дельты с разной скоростью [(секунды, скорость)] (дробная часть - от суммы)"""
+        return int(sum(seconds * rate for seconds, rate in priced))
+
+    def stats(self):
+        table = self.table
+        return {
+            "rules_path": self.rules_path,
+            "rules_version": table.version,
+            "last_error": self.last_error,
+            "base_rate": table.base_rate,
+            "max_rate": table.max_rate,
+            "upgrade_levels": list(table.upgrade_levels),
+            "events": [{"name": name, "multiplier": m, "start": start, "end": end}
+                       for name, m, start, end in table.events],
+            "players_with_upgrades": len(self.upgrades),
+            "players_with_boosts": len(self.boosts)
+        }
@@ -0,0 +1,354 @@
+"""Журнал событий начисления поинтов с применением в SQLite.
+
+Событие сначала дописывается в сегментированный бинарный журнал и
+подтверждается клиенту после fsync (групповой коммит: одна запись на диск на
+пачку событий), а в users/transactions его переносит фоновый поток.
+
+Каждый процесс пишет в свой поток stream-<pid>-<id>/ и держит на нём flock,
+поэтому воркеры gunicorn не мешают друг другу. Номер последнего применённого
+события потока хранится в базе в той же транзакции, что и само применение,
+так что повторное применение невозможно. При старте потоки умерших процессов
+доигрываются до конца и переименовываются в applied-*; журнал целиком
+сохраняется, и из него можно пересобрать базу:
+
+    python eventlog.py rebuild --dir eventlog --db rebuilt.db
+
+В журнал попадают регистрации, /add_points и /v1/sync (вместе с last_seq
+клиента), и применяются они со временем события. Друзья, рассылки и прочее
+состояние в журнал не пишутся, а пересборка отказывается работать, если
+встречает игрока, зарегистрированного до включения журнала.
+
+Синхронизация ждёт применения своего события (append_applied): отсев повторов
+по last_seq должен видеть предыдущие пакеты клиента, даже если их принял
+другой воркер.
+
+Занятая или недоступная база (sqlite3.OperationalError) - повод повторить
+пачку позже. Любая другая ошибка значит, что в пачке есть событие, которое не
+применится никогда (например, без нужного поля): пачка применяется по одному
+событию, и событие, упавшее MAX_APPLY_ATTEMPTS раз, уходит в reject() - в
+eventlog_rejected, - а поток идёт дальше.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import uuid
+import zlib
+import fcntl
+import struct
+import sqlite3
+import argparse
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Заголовок записи: длина payload, crc32(seq + payload), seq
+RECORD_HEADER = struct.Struct('<IIQ')
+SEQ = struct.Struct('<Q')
+APPLY_BATCH = 500
+MAX_APPLY_ATTEMPTS = 3
+_PENDING = object()
+_REJECTED = object()
+
+
+class EventRejected(Exception):
+    """Событие не удалось применить, и оно отложено в reject()"""
+
+
+def _crc(seq, payload):
+    return zlib.crc32(payload, zlib.crc32(SEQ.pack(seq)))
+
+
+def read_stream(stream_dir):
+    """Прочитать события потока по порядку; оборванный хвост после сбоя пропускается"""
+    for path in sorted(glob.glob(os.path.join(stream_dir, '*.log'))):
+        with open(path, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc, seq = RECORD_HEADER.unpack(header)
+                payload = f.read(length)
+                if len(payload) < length or _crc(seq, payload) != crc:
+                    logger.warning("Torn record in %s at seq %s, stopping", path, seq)
+                    break
+                yield seq, json.loads(payload)
+
+
+class EventLog:
+    """Журнал событий текущего процесса: запись с групповым fsync и фоновое применение"""
+
+    def __init__(self, directory, apply_batch, segment_bytes=64 * 1024 * 1024, fsync_window=0.002,
+                 reject=None):
+        self.directory = directory
+        self.apply_batch = apply_batch
+        # reject(stream, seq, event, reason) - отложить неприменимое событие и сдвинуть checkpoint за него
+        self.reject = reject
+        self.rejected = 0
+        self.segment_bytes = segment_bytes
+        self.fsync_window = fsync_window
+        self.stream = None
+        self.stream_dir = None
+        self.cond = threading.Condition()
+        self.pending = []
+        self.next_seq = 1
+        self.durable_seq = 0
+        self.applied_seq = 0
+        self.apply_queue = []
+        self.apply_cond = threading.Condition()
+        # seq -> результат применения для тех, кто ждёт его в append_applied
+        self.waiting = {}
+        self.segment = None
+        self.segment_size = 0
+        self.lock_file = None
+        self.error = None
+
+    def open(self):
+        """Доиграть потоки умерших процессов и начать свой поток"""
+        # Имя потока - при открытии: под gunicorn --preload объект создан в мастере, а пишет воркер
+        self.stream = f"stream-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.stream_dir = os.path.join(self.directory, self.stream)
+        os.makedirs(self.directory, exist_ok=True)
+        self.recover()
+        # Поток появляется под своим именем уже заблокированным, иначе его мог бы забрать recover() соседа
+        tmp_dir = os.path.join(self.directory, 'tmp-' + self.stream)
+        os.makedirs(tmp_dir)
+        self.lock_file = open(os.path.join(tmp_dir, 'LOCK'), 'w')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        os.rename(tmp_dir, self.stream_dir)
+        self._fsync_dir(self.directory)
+        threading.Thread(target=self._flush_loop, daemon=True, name='eventlog-flush').start()
+        threading.Thread(target=self._apply_loop, daemon=True, name='eventlog-apply').start()
+        logger.info("Event log stream %s opened", self.stream)
+
+    def recover(self):
+        """Применить хвосты потоков, чьи владельцы больше не живы"""
+        for stream_dir in sorted(glob.glob(os.path.join(self.directory, 'stream-*'))):
+            with open(os.path.join(stream_dir, 'LOCK'), 'a') as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # владелец жив и применяет сам
+                stream = os.path.basename(stream_dir)
+                batch, replayed = [], 0
+                for record in read_stream(stream_dir):
+                    batch.append(record)
+                    if len(batch) >= APPLY_BATCH:
+                        self._apply(stream, batch)
+                        replayed += len(batch)
+                        batch = []
+                if batch:
+                    self._apply(stream, batch)
+                    replayed += len(batch)
+                os.rename(stream_dir, os.path.join(self.directory, 'applied-' + stream[len('stream-'):]))
+                logger.info("Event log stream %s replayed (%s records checked)", stream, replayed)
+
+    def append(self, event, timeout=5.0):
+        """Записать событие и вернуть его seq после fsync"""
+        return self._append(event, timeout, False)
+
+    def append_applied(self, event, timeout=5.0):
+        """Записать событие и дождаться его применения; (seq, что вернул для него apply_batch).
+        По таймауту событие остаётся в журнале и будет применено позже; EventRejected - не применится"""
+        deadline = time.monotonic() + timeout
+        seq = self._append(event, timeout, True)
+        with self.apply_cond:
+            try:
+                while self.waiting[seq] is _PENDING:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("Event log apply timed out")
+                    self.apply_cond.wait(remaining)
+                if self.waiting[seq] is _REJECTED:
+                    raise EventRejected(f"Event {seq} could not be applied")
+                return seq, self.waiting[seq]
+            finally:
+                del self.waiting[seq]
+
+    def _append(self, event, timeout, wait_applied):
+        payload = json.dumps(event, separators=(',', ':'), ensure_ascii=False).encode()
+        with self.cond:
+            if self.error:
+                raise IOError(f"Event log unavailable: {self.error}")
+            seq = self.next_seq
+            self.next_seq += 1
+            if wait_applied:
+                # До постановки в очередь: применение может закончиться раньше, чем append вернётся
+                with self.apply_cond:
+                    self.waiting[seq] = _PENDING
+            self.pending.append((seq, payload, event))
+            self.cond.notify_all()
+            deadline = time.monotonic() + timeout
+            try:
+                while self.durable_seq < seq:
+                    if self.error:
+                        raise IOError(f"Event log unavailable: {self.error}")
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("Event log fsync timed out")
+                    self.cond.wait(remaining)
+            except Exception:
+                if wait_applied:
+                    with self.apply_cond:
+                        self.waiting.pop(seq, None)
+                raise
+        return seq
+
+    def stats(self):
+        return {
+            "stream": self.stream,
+            "durable_seq": self.durable_seq,
+            "applied_seq": self.applied_seq,
+            "apply_backlog": self.durable_seq - self.applied_seq,
+            "rejected": self.rejected,
+            "error": self.error
+        }
+
+    def _open_segment(self, first_seq):
+        if self.segment:
+            self.segment.close()
+        path = os.path.join(self.stream_dir, f"{first_seq:020d}.log")
+        self.segment = open(path, 'ab')
+        self.segment_size = 0
+        self._fsync_dir(self.stream_dir)
+
+    def _fsync_dir(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _flush_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            # Короткое окно, чтобы собрать в одну запись события параллельных запросов
+            time.sleep(self.fsync_window)
+            with self.cond:
+                batch, self.pending = self.pending, []
+            try:
+                if self.segment is None or self.segment_size >= self.segment_bytes:
+                    self._open_segment(batch[0][0])
+                data = b''.join(
+                    RECORD_HEADER.pack(len(payload), _crc(seq, payload), seq) + payload
+                    for seq, payload, _ in batch
+                )
+                self.segment.write(data)
+                self.segment.flush()
+                os.fsync(self.segment.fileno())
+                self.segment_size += len(data)
+            except Exception as e:
+                logger.error("Event log write error: %s", e)
+                with self.cond:
+                    self.error = str(e)
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                self.durable_seq = batch[-1][0]
+                self.cond.notify_all()
+            with self.apply_cond:
+                self.apply_queue.extend((seq, event) for seq, _, event in batch)
+                self.apply_cond.notify_all()
+
+    def _apply_loop(self):
+        while True:
+            with self.apply_cond:
+                while not self.apply_queue:
+                    self.apply_cond.wait()
+                batch = self.apply_queue[:APPLY_BATCH]
+                del self.apply_queue[:APPLY_BATCH]
+            while True:
+                try:
+                    results = self._apply(self.stream, batch)
+                    with self.apply_cond:
+                        self.applied_seq = batch[-1][0]
+                        for seq, _ in batch:
+                            if seq in self.waiting:
+                                self.waiting[seq] = results.get(seq)
+                        self.apply_cond.notify_all()
+                    break
+                except Exception as e:
+                    # База занята или недоступна - событие уже в журнале, повторяем позже
+                    logger.error("Event log apply error, retrying: %s", e)
+                    time.sleep(1)
+
+    def _apply(self, stream, batch):
+        """Применить пачку; {seq: результат}, у отложенных в reject() событий - _REJECTED.
+        OperationalError пробрасывается: пачку нужно повторить целиком"""
+        try:
+            return self.apply_batch(stream, batch) or {}
+        except sqlite3.OperationalError:
+            raise
+        except Exception as e:
+            if self.reject is None:
+                raise
+            logger.error("Event log batch %s:%s-%s failed, applying one by one: %s",
+                         stream, batch[0][0], batch[-1][0], e)
+        results = {}
+        for seq, event in batch:
+            for attempt in range(1, MAX_APPLY_ATTEMPTS + 1):
+                try:
+                    results.update(self.apply_batch(stream, [(seq, event)]) or {})
+                    break
+                except sqlite3.OperationalError:
+                    raise
+                except Exception as e:
+                    if attempt < MAX_APPLY_ATTEMPTS:
+                        continue
+                    reason = f"{type(e).__name__}: {e}"
+                    self.reject(stream, seq, event, reason)
+                    self.rejected += 1
+                    results[seq] = _REJECTED
+                    logger.error("Event %s:%s rejected after %s attempts: %s", stream, seq, attempt, reason)
+        return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Журнал событий VELN')
+    parser.add_argument('command', choices=['rebuild'])
+    parser.add_argument('--dir', default=os.environ.get('EVENT_LOG_DIR', 'eventlog'))
+    parser.add_argument('--db', required=True, help='Новый файл базы')
+    args = parser.parse_args(argv)
+
+    if os.path.exists(args.db):
+        parser.error(f"{args.db} already exists")
+    # Сервер создаёт схему в DATABASE_PATH при импорте; журнал при этом не открываем
+    os.environ['DATABASE_PATH'] = args.db
+    os.environ['EVENT_LOG_DIR'] = ''
+    os.environ['BACKUP_INTERVAL_SECONDS'] = '0'
+    os.environ['RECONCILE_INTERVAL_SECONDS'] = '0'
+    os.environ['ARCHIVE_INTERVAL_SECONDS'] = '0'
+    import server
+
+    streams = sorted(glob.glob(os.path.join(args.dir, 'applied-*')) + glob.glob(os.path.join(args.dir, 'stream-*')))
+    records = [(event.get('ts', 0), stream, seq, event)
+               for stream in streams for seq, event in read_stream(stream)]
+    records.sort(key=lambda r: r[0])
+    # Сначала пользователи, затем начисления и синхронизации в порядке времени: sync отбрасывает
+    # уже применённые seq клиента, поэтому его порядок важен и между потоками
+    users = [(seq, event) for _, _, seq, event in records if event['type'] == 'user']
+    changes = [(seq, event) for _, _, seq, event in records if event['type'] != 'user']
+    try:
+        for batch in (users, changes):
+            for i in range(0, len(batch), APPLY_BATCH):
+                server.apply_logged_events('rebuild', batch[i:i + APPLY_BATCH], use_checkpoint=False, strict=True)
+    except server.UnknownUserError as e:
+        # Игрок зарегистрирован до включения журнала: без его регистрации баланс не воспроизвести
+        print(f"Rebuild failed: {e}. The log does not cover this user; rebuild from a snapshot instead",
+              file=sys.stderr)
+        return 1
+    conn = server.get_db_connection()
+    # Об этих достижениях игроки уже получили уведомления из исходной базы
+    conn.execute('DELETE FROM achievement_notifications')
+    conn.commit()
+    conn.close()
+    print(f"Rebuilt {args.db} from {len(records)} events in {len(streams)} streams")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
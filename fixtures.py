@@ -0,0 +1,278 @@
+"""Генератор синтетических данных для нагрузочных тестов и репетиций миграций.
+
+Создаёт пользователей и журнал транзакций в масштабе продакшена: очки
+распределены по Парето (перекос как у Ципфа - немного китов и длинный
+хвост), число транзакций растёт вместе с очками, а сумма транзакций
+пользователя всегда равна его балансу, так что сверка (reconcile.py) на
+таких данных чиста. Схема берётся из server.init_db, поэтому не расходится
+с приложением.
+
+Форматы:
+    sqlite - сразу файл базы (PRAGMA для пакетной загрузки, executemany,
+             вторичные индексы создаются после загрузки)
+    sql    - SQL-дамп для sqlite3 (схема, INSERT пачками, индексы в конце)
+    pgcopy - скрипт для psql: DDL PostgreSQL, COPY ... FROM stdin, индексы
+
+    python fixtures.py --users 1000000 --tx-per-user 100 --out big.db
+    python fixtures.py --users 100000 --format pgcopy --out veln.pgsql
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+
+BATCH_SIZE = 50000
+SQL_ROWS_PER_INSERT = 500
+TIMESTAMP_POOL = 10000
+FIRST_NAMES = ['Alex', 'Maria', 'Ivan', 'Olga', 'Dmitry', 'Anna', 'Sergey', 'Elena', 'Nikita', 'Daria',
+               'Pavel', 'Irina', 'Artem', 'Sofia', 'Maxim', 'Polina', 'Kirill', 'Alina', 'Egor', 'Vera']
+
+USER_COLUMNS = ('id', 'telegram_id', 'username', 'first_name', 'last_name', 'points', 'created_at', 'updated_at')
+TRANSACTION_COLUMNS = ('id', 'user_id', 'points', 'transaction_type', 'description', 'created_at')
+
+PG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    telegram_id BIGINT UNIQUE NOT NULL,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    points BIGINT DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    is_blocked INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    user_id BIGINT,
+    points BIGINT,
+    transaction_type TEXT,
+    description TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+'''
+PG_INDEXES = '''
+ALTER TABLE transactions ADD FOREIGN KEY (user_id) REFERENCES users (id);
+CREATE INDEX IF NOT EXISTS idx_users_points ON users (points);
+CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id, id, points);
+SELECT setval(pg_get_serial_sequence('users', 'id'), COALESCE(MAX(id), 1)) FROM users;
+SELECT setval(pg_get_serial_sequence('transactions', 'id'), COALESCE(MAX(id), 1)) FROM transactions;
+ANALYZE users;
+ANALYZE transactions;
+'''
+
+
+class FixtureSpec:
+    """Параметры генерации; одинаковый seed даёт одинаковые данные"""
+
+    def __init__(self, users, tx_per_user, skew, points_scale, idle_fraction, days, seed):
+        if skew <= 1:
+            raise ValueError("skew must be > 1 (Pareto shape with a finite mean)")
+        self.users = users
+        self.tx_per_user = tx_per_user
+        self.skew = skew
+        self.points_scale = points_scale
+        self.idle_fraction = idle_fraction
+        self.days = days
+        self.seed = seed
+        now = datetime.utcnow().replace(microsecond=0)
+        step = timedelta(days=days) / TIMESTAMP_POOL
+        self.timestamps = [(now - step * i).strftime('%Y-%m-%d %H:%M:%S') for i in range(TIMESTAMP_POOL, 0, -1)]
+
+    def iter_users(self):
+        """(строка users, число транзакций) в порядке id и telegram_id"""
+        rng = random.Random(self.seed)
+        pareto, rand = rng.paretovariate, rng.random
+        mean = self.skew / (self.skew - 1)
+        # Средняя по играющим, чтобы в сумме вышло users * tx_per_user
+        tx_scale = self.tx_per_user / max(1 - self.idle_fraction, 1e-9) / mean
+        timestamps, pool = self.timestamps, TIMESTAMP_POOL
+        telegram_id = 100000000
+        for user_id in range(1, self.users + 1):
+            telegram_id += rng.randint(1, 1000)
+            created_at = timestamps[user_id * pool // (self.users + 1)]
+            if rand() < self.idle_fraction:
+                points, tx_count = 0, 0
+            else:
+                weight = pareto(self.skew)
+                points = int(self.points_scale * weight)
+                tx_count = min(points, max(1, round(tx_scale * weight)))
+            row = (user_id, telegram_id, f"player_{user_id}", FIRST_NAMES[user_id % len(FIRST_NAMES)], '',
+                   points, created_at, created_at)
+            yield row, tx_count
+
+    def iter_transactions(self):
+        """Строки transactions: баланс пользователя разложен на tx_count начислений"""
+        tx_id = 0
+        timestamps, pool = self.timestamps, TIMESTAMP_POOL
+        for row, tx_count in self.iter_users():
+            if not tx_count:
+                continue
+            user_id, points = row[0], row[5]
+            first_ts = user_id * pool // (self.users + 1)
+            amount, remainder = divmod(points, tx_count)
+            span = pool - first_ts
+            for i in range(tx_count):
+                tx_id += 1
+                ts = timestamps[first_ts + i * span // tx_count]
+                yield (tx_id, user_id, amount + (remainder if i == 0 else 0), 'add', 'Game points', ts)
+
+
+def _batches(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def init_schema(db_path):
+    """Создать схему приложения в файле и вернуть вторичные индексы (имя, SQL)"""
+    # Импорт server создаёт схему в DATABASE_PATH; фоновые потоки не нужны
+    os.environ['DATABASE_PATH'] = db_path
+    os.environ['EVENT_LOG_DIR'] = ''
+    os.environ['BACKUP_INTERVAL_SECONDS'] = '0'
+    os.environ['RECONCILE_INTERVAL_SECONDS'] = '0'
+    os.environ['ARCHIVE_INTERVAL_SECONDS'] = '0'
+    os.environ['CLUSTER_BUS_URL'] = ''
+    os.environ['USER_STORE'] = 'sqlite'
+    os.environ.pop('BOT_TOKEN', None)
+    import server
+    if not server.init_db():
+        raise RuntimeError("Schema initialization failed")
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('''
+            SELECT name, sql FROM sqlite_master
+            WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ('users', 'transactions')
+        ''').fetchall()
+    finally:
+        conn.close()
+
+
+def build_sqlite(spec, out):
+    if os.path.exists(out):
+        raise FileExistsError(f"{out} already exists")
+    indexes = init_schema(out)
+    conn = sqlite3.connect(out, isolation_level=None)
+    try:
+        for pragma in ('journal_mode=OFF', 'synchronous=OFF', 'locking_mode=EXCLUSIVE',
+                       'temp_store=MEMORY', 'cache_size=-262144'):
+            conn.execute(f'PRAGMA {pragma}')
+        for name, _ in indexes:
+            conn.execute(f'DROP INDEX {name}')
+
+        conn.execute('BEGIN')
+        insert = f"INSERT INTO users ({', '.join(USER_COLUMNS)}) VALUES ({', '.join('?' * len(USER_COLUMNS))})"
+        for batch in _batches(row for row, _ in spec.iter_users()):
+            conn.executemany(insert, batch)
+        insert = (f"INSERT INTO transactions ({', '.join(TRANSACTION_COLUMNS)}) "
+                  f"VALUES ({', '.join('?' * len(TRANSACTION_COLUMNS))})")
+        for batch in _batches(spec.iter_transactions()):
+            conn.executemany(insert, batch)
+        conn.execute('COMMIT')
+
+        # Индексы строятся одной сортировкой вместо вставки по строке
+        for _, sql in indexes:
+            conn.execute(sql)
+        conn.execute('ANALYZE')
+        conn.execute('PRAGMA locking_mode=NORMAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+    finally:
+        conn.close()
+
+
+def _sql_literal(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, int):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def write_sql(spec, out):
+    """SQL-дамп для sqlite3: схема приложения, вставки пачками, индексы в конце"""
+    with tempfile.TemporaryDirectory() as tmp:
+        schema_db = os.path.join(tmp, 'schema.db')
+        indexes = init_schema(schema_db)
+        conn = sqlite3.connect(schema_db)
+        tables = conn.execute('''
+            SELECT sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid
+        ''').fetchall()
+        conn.close()
+
+    with open(out, 'w', encoding='utf-8') as f:
+        f.write('PRAGMA journal_mode=OFF;\nPRAGMA synchronous=OFF;\nBEGIN;\n')
+        for (sql,) in tables:
+            f.write(sql.replace('CREATE TABLE ', 'CREATE TABLE IF NOT EXISTS ', 1)
+                    if 'IF NOT EXISTS' not in sql else sql)
+            f.write(';\n')
+        for table, columns, rows in (('users', USER_COLUMNS, (row for row, _ in spec.iter_users())),
+                                     ('transactions', TRANSACTION_COLUMNS, spec.iter_transactions())):
+            head = f"INSERT INTO {table} ({', '.join(columns)}) VALUES\n"
+            for batch in _batches(rows, SQL_ROWS_PER_INSERT):
+                values = ',\n'.join('(' + ', '.join(map(_sql_literal, row)) + ')' for row in batch)
+                f.write(head + values + ';\n')
+        for _, sql in indexes:
+            f.write(sql + ';\n')
+        f.write('COMMIT;\nPRAGMA journal_mode=WAL;\nANALYZE;\n')
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def write_pgcopy(spec, out):
+    """Скрипт для psql -f: DDL PostgreSQL, данные через COPY, затем индексы"""
+    with open(out, 'w', encoding='utf-8') as f:
+        f.write('BEGIN;\n' + PG_SCHEMA)
+        for table, columns, rows in (('users', USER_COLUMNS, (row for row, _ in spec.iter_users())),
+                                     ('transactions', TRANSACTION_COLUMNS, spec.iter_transactions())):
+            f.write(f"COPY {table} ({', '.join(columns)}) FROM stdin;\n")
+            for batch in _batches(rows):
+                f.write(''.join('\t'.join(map(_copy_value, row)) + '\n' for row in batch))
+            f.write('\\.\n')
+        f.write('COMMIT;\n' + PG_INDEXES)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Генератор синтетических данных VELN')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--tx-per-user', type=float, default=20, help='Среднее число транзакций на пользователя')
+    parser.add_argument('--skew', type=float, default=1.5, help='Форма Парето (> 1, меньше - сильнее перекос)')
+    parser.add_argument('--points-scale', type=int, default=100, help='Минимальный баланс играющего пользователя')
+    parser.add_argument('--idle-fraction', type=float, default=0.2, help='Доля зарегистрированных без очков')
+    parser.add_argument('--days', type=int, default=180, help='За сколько дней распределить даты')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--format', choices=['sqlite', 'sql', 'pgcopy'], default='sqlite')
+    parser.add_argument('--out', required=True)
+    args = parser.parse_args(argv)
+
+    try:
+        spec = FixtureSpec(args.users, args.tx_per_user, args.skew, args.points_scale,
+                           args.idle_fraction, args.days, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    started = time.monotonic()
+    if args.format == 'sqlite':
+        build_sqlite(spec, args.out)
+    elif args.format == 'sql':
+        write_sql(spec, args.out)
+    else:
+        write_pgcopy(spec, args.out)
+    elapsed = time.monotonic() - started
+    print(f"Wrote {args.users:,} users to {args.out} ({args.format}) in {elapsed:.1f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
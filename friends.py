@@ -0,0 +1,193 @@
+"""Друзья, рефералы и лидерборды среди друзей.
+
+Дружба хранится двумя направленными рёбрами в friendships, первичный ключ
+(telegram_id, friend_id) служит списком смежности, так что друзья игрока
+читаются одним проходом по индексу. Реферал - пригласивший нового игрока по
+ссылке t.me/<бот>?start=ref_<telegram_id>; он же сразу становится другом.
+
+Доска друзей (игрок и его друзья по очкам) строится из базы при первом
+чтении и дальше кешируется. Обратный индекс "игрок -> доски, где он есть"
+позволяет обновлять закешированные доски на изменение очков без запросов:
+это O(друзей) на доску, а число друзей ограничено MAX_FRIENDS. Доска, которую
+в этот момент читают из базы, не попадает в кеш, только если за время чтения
+изменился кто-то из её игроков, - изменения остальных её не касаются.
+"""
+import re
+import threading
+from collections import OrderedDict
+
+MAX_FRIENDS = 500
+START_PAYLOAD = re.compile(r'^ref_(\d{1,20})$')
+
+
+def init_tables(cursor):
+    """Создать таблицы рёбер дружбы и рефералов"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS friendships (
+            telegram_id INTEGER NOT NULL,
+            friend_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (telegram_id, friend_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS referrals (
+            referred_id INTEGER PRIMARY KEY,
+            referrer_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals (referrer_id)')
+
+
+def parse_start_payload(text):
+    """telegram_id пригласившего из "/start ref_<id>" или None"""
+    parts = (text or '').split(maxsplit=1)
+    if len(parts) < 2:
+        return None
+    match = START_PAYLOAD.match(parts[1].strip())
+    return int(match.group(1)) if match else None
+
+
+def invite_link(bot_username, telegram_id):
+    return f"https://t.me/{bot_username}?start=ref_{telegram_id}"
+
+
+class FriendGraph:
+    """Рёбра дружбы в базе и кеш досок друзей в памяти"""
+
+    def __init__(self, max_friends=MAX_FRIENDS, cache_size=10000):
+        self.max_friends = max_friends
+        self.cache_size = cache_size
+        # владелец -> [[points, telegram_id, username, first_name], ...] по убыванию очков
+        self.boards = OrderedDict()
+        # игрок -> владельцы закешированных досок, где он есть
+        self.watchers = {}
+        # доски, которые сейчас читаются из базы: маркер -> игроки, изменившиеся за время чтения
+        self.loading = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def add_friendship(self, cursor, a, b):
+        """Связать двух игроков в текущей транзакции; False - уже друзья, сам себе или лимит"""
+        if a == b:
+            return False
+        for owner in (a, b):
+            count = cursor.execute(
+                'SELECT COUNT(*) FROM friendships WHERE telegram_id = ?', (owner,)
+            ).fetchone()[0]
+            if count >= self.max_friends:
+                return False
+        cursor.execute('INSERT OR IGNORE INTO friendships (telegram_id, friend_id) VALUES (?, ?)', (a, b))
+        if cursor.rowcount == 0:
+            return False
+        cursor.execute('INSERT OR IGNORE INTO friendships (telegram_id, friend_id) VALUES (?, ?)', (b, a))
+        return True
+
+    def record_referral(self, cursor, referrer_id, referred_id):
+        """Записать, кто пригласил нового игрока, и сделать их друзьями"""
+        cursor.execute('INSERT OR IGNORE INTO referrals (referred_id, referrer_id) VALUES (?, ?)',
+                       (referred_id, referrer_id))
+        return self.add_friendship(cursor, referrer_id, referred_id)
+
+    def friend_ids(self, cursor, telegram_id):
+        return [row[0] for row in cursor.execute(
+            'SELECT friend_id FROM friendships WHERE telegram_id = ?', (telegram_id,))]
+
+    def referral_count(self, cursor, telegram_id):
+        return cursor.execute('SELECT COUNT(*) FROM referrals WHERE referrer_id = ?', (telegram_id,)).fetchone()[0]
+
+    def invalidate(self, *owners):
+        """Сбросить доски игроков (после изменения их списка друзей)"""
+        with self.lock:
+            for owner in owners:
+                self._drop(owner)
+            self._mark_loading(owners)
+
+    def forget(self, *players):
+        """Сбросить доски игроков и все доски, где они есть (перенос в архив и возврат)"""
+        with self.lock:
+            for player in players:
+                self._drop(player)
+                for owner in list(self.watchers.get(player, ())):
+                    self._drop(owner)
+            self._mark_loading(players)
+
+    def clear(self):
+        with self.lock:
+            self.boards.clear()
+            self.watchers.clear()
+            self.generation += 1
+
+    def _mark_loading(self, players):
+        for changed in self.loading.values():
+            changed.update(players)
+
+    def _drop(self, owner):
+        board = self.boards.pop(owner, None)
+        if board is None:
+            return
+        for entry in board:
+            owners = self.watchers.get(entry[1])
+            if owners is not None:
+                owners.discard(owner)
+                if not owners:
+                    del self.watchers[entry[1]]
+
+    def on_points_changed(self, telegram_id, points):
+        """Обновить очки игрока во всех закешированных досках, где он есть"""
+        with self.lock:
+            self._mark_loading((telegram_id,))
+            for owner in self.watchers.get(telegram_id, ()):
+                board = self.boards[owner]
+                for entry in board:
+                    if entry[1] == telegram_id:
+                        entry[0] = points
+                        break
+                board.sort(key=lambda entry: -entry[0])
+
+    def board(self, connect, telegram_id, limit=50):
+        """Доска друзей: [(telegram_id, username, first_name, points), ...]; None - игрока нет"""
+        with self.lock:
+            board = self.boards.get(telegram_id)
+            if board is not None:
+                self.boards.move_to_end(telegram_id)
+                return [(e[1], e[2], e[3], e[0]) for e in board[:limit]]
+            generation = self.generation
+            marker = object()
+            changed = self.loading[marker] = set()
+
+        try:
+            conn = connect()
+            try:
+                rows = conn.execute('''
+                    SELECT telegram_id, username, first_name, points FROM users WHERE telegram_id = ?
+                    UNION ALL
+                    SELECT u.telegram_id, u.username, u.first_name, u.points
+                    FROM friendships f JOIN users u ON u.telegram_id = f.friend_id
+                    WHERE f.telegram_id = ?
+                ''', (telegram_id, telegram_id)).fetchall()
+            finally:
+                conn.close()
+        finally:
+            with self.lock:
+                del self.loading[marker]
+        if not rows or rows[0][0] != telegram_id:
+            return None
+        board = sorted(([points or 0, tid, username, first_name] for tid, username, first_name, points in rows),
+                       key=lambda entry: -entry[0])
+
+        with self.lock:
+            # Кто-то с этой доски изменился во время чтения - не кешируем, чтобы не закрепить устаревшее
+            stale = generation != self.generation or any(entry[1] in changed for entry in board) \
+                or telegram_id in changed
+            if not stale and telegram_id not in self.boards:
+                self.boards[telegram_id] = board
+                for entry in board:
+                    self.watchers.setdefault(entry[1], set()).add(telegram_id)
+                while len(self.boards) > self.cache_size:
+                    self._drop(next(iter(self.boards)))
+        return [(e[1], e[2], e[3], e[0]) for e in board[:limit]]
+
+    def stats(self):
+        return {"cached_boards": len(self.boards), "watched_players": len(self.watchers)}
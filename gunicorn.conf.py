@@ -0,0 +1,97 @@
+"""Профиль запуска gunicorn для продакшена.
+
+    gunicorn -c gunicorn.conf.py server:app
+
+Воркеры - процессы gthread: число процессов по ядрам (Python упирается в GIL),
+потоки внутри воркера закрывают ожидание SQLite и Telegram API. Процессов не
+больше GUNICORN_MAX_WORKERS: запись в SQLite всё равно идёт по одной, а лишние
+процессы только спорят за блокировку базы.
+
+Приложение загружается в мастере (preload_app), поэтому неизменяемые данные -
+код, собранная страница /game и её gzip - создаются один раз и делятся
+воркерами через copy-on-write; gc.freeze() перед fork убирает их из обхода
+сборщика мусора, чтобы он не трогал общие страницы. Изменяемые кеши (гистограмма
+мест, хранилище пользователей) и фоновые потоки каждый воркер поднимает сам в
+post_fork через server.start_process().
+
+Кеши воркеров согласуются через шину инвалидации. Если CLUSTER_BUS_URL не
+задан, мастер запускает локальную шину (cluster.py serve) на свободном порту.
+Адмиссия (admission.py) считает запросы внутри процесса: выполняются сразу не
+больше threads, остальные ждут потока в очереди воркера. Лимиты ADMISSION_* выше
+threads работают, только если прокси передаёт время приёма (X-Request-Start,
+например nginx: proxy_set_header X-Request-Start "t=${msec}") - по нему
+оценивается очередь; без заголовка держите их в пределах threads. Ёмкость
+сервиса - workers x threads выполняющихся запросов.
+
+Воркеры пересоздаются после max_requests запросов (с разбросом, чтобы не
+перезапускаться одновременно) - так не копится фрагментация памяти.
+"""
+import os
+import gc
+import sys
+import time
+import socket
+import subprocess
+
+cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+max_workers = int(os.environ.get('GUNICORN_MAX_WORKERS', 8))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', min(max(cpus, 2), max_workers)))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+preload_app = True
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 5000))
+max_requests_jitter = max_requests // 10
+# Heartbeat воркеров в tmpfs: запись в файл на диске может подвиснуть под нагрузкой
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG') or None
+
+# server.py читает настройки при импорте в мастере - до fork воркеров
+if preload_app:
+    os.environ.setdefault('BACKGROUND_START', 'post_fork')
+
+local_bus = None
+local_bus_port = None
+if workers > 1 and not os.environ.get('CLUSTER_BUS_URL') and os.environ.get('GUNICORN_LOCAL_BUS', '1') != '0':
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        local_bus_port = probe.getsockname()[1]
+    os.environ['CLUSTER_BUS_URL'] = f"redis://127.0.0.1:{local_bus_port}"
+
+
+def when_ready(server):
+    # Порт уже занят нами, воркеры ещё не запущены
+    global local_bus
+    if local_bus_port:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cluster.py')
+        local_bus = subprocess.Popen([sys.executable, script, 'serve', '--port', str(local_bus_port), '--exit-with-parent'])
+        # Ждём, пока шина начнёт принимать соединения, чтобы воркеры подписались с первой попытки
+        for _ in range(50):
+            try:
+                socket.create_connection(('127.0.0.1', local_bus_port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        server.log.info(f"Local invalidation bus on port {local_bus_port} (pid {local_bus.pid})")
+
+
+def pre_fork(server, worker):
+    # Всё, что создано в мастере, дальше только читается - не даём gc пачкать страницы
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    app_module = sys.modules.get('server')
+    if app_module is not None and os.environ.get('BACKGROUND_START') == 'post_fork':
+        app_module.start_process()
+
+
+def on_exit(server):
+    if local_bus:
+        local_bus.terminate()
+        local_bus.wait(timeout=5)
@@ -0,0 +1,140 @@
+"""Проверки живости и готовности для балансировщика и платформы.
+
+/livez отвечает, пока процесс обслуживает запросы, и не трогает ни базу, ни
+диск. /readyz и /healthz берут результаты проверок из кеша: зависимости
+опрашиваются не чаще раза в ttl секунд, и только одним запросом - остальные
+в это время получают предыдущий результат, поэтому зонды можно слать хоть
+каждую секунду с каждого узла.
+
+Проверка базы пишет строку в health_probe под BEGIN IMMEDIATE с коротким
+busy_timeout: так видно и ожидание блокировки записи (зависший писатель), и
+время самой записи с fsync. Очереди (рассылки, журнал событий, шина,
+экспорт трасс) и свободное место на диске проверяются по порогам. Проверка с
+critical=False не снимает узел с балансировки, а только переводит /healthz в
+degraded.
+"""
+import os
+import time
+import shutil
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def init_tables(cursor):
+    """Создать строку, которую перезаписывает проверка записи"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS health_probe (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            checked_at REAL NOT NULL
+        )
+    ''')
+
+
+def database_probe(db_path, timeout_ms=1000, slow_ms=500):
+    """Проверка базы: ожидание блокировки записи и время записи с коммитом"""
+    def probe():
+        started = time.perf_counter()
+        # Без TracedConnection: зонды не должны попадать в статистику SQL
+        conn = sqlite3.connect(db_path, timeout=timeout_ms / 1000)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            locked = time.perf_counter()
+            conn.execute('''
+                INSERT INTO health_probe (id, checked_at) VALUES (1, ?)
+                ON CONFLICT(id) DO UPDATE SET checked_at = excluded.checked_at
+            ''', (time.time(),))
+            conn.commit()
+            finished = time.perf_counter()
+        finally:
+            conn.close()
+        lock_wait_ms = (locked - started) * 1000
+        write_ms = (finished - locked) * 1000
+        wal_path = db_path + '-wal'
+        return {
+            "ok": lock_wait_ms + write_ms < slow_ms,
+            "lock_wait_ms": round(lock_wait_ms, 2),
+            "write_ms": round(write_ms, 2),
+            "wal_bytes": os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+        }
+    return probe
+
+
+def disk_probe(paths, min_free_bytes):
+    """Свободное место на разделах с базой, снапшотами и журналом"""
+    def probe():
+        result = {"ok": True, "paths": {}}
+        for path in paths:
+            usage = shutil.disk_usage(path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path)))
+            result["paths"][path] = {
+                "free_mb": usage.free // 2 ** 20,
+                "used_percent": round(usage.used * 100 / usage.total, 1) if usage.total else 0.0
+            }
+            if usage.free < min_free_bytes:
+                result["ok"] = False
+        return result
+    return probe
+
+
+def queue_probe(depth, max_depth):
+    """Глубина очереди в памяти против порога"""
+    def probe():
+        value = depth()
+        return {"ok": value <= max_depth, "depth": value, "max_depth": max_depth}
+    return probe
+
+
+class HealthMonitor:
+    """Набор проверок с кешированием результатов на ttl секунд"""
+
+    def __init__(self, ttl=5):
+        self.ttl = ttl
+        self.checks = []
+        self.report = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def register(self, name, probe, critical=True):
+        self.checks.append((name, probe, critical))
+
+    def current(self):
+        """Последний отчёт; устаревший обновляет один запрос, остальные не ждут"""
+        report = self.report
+        if report is not None and time.monotonic() - self.checked_at < self.ttl:
+            return report
+        if not self.lock.acquire(blocking=report is None):
+            return report
+        try:
+            if self.report is not None and time.monotonic() - self.checked_at < self.ttl:
+                return self.report
+            self.report = self._run()
+            self.checked_at = time.monotonic()
+            return self.report
+        finally:
+            self.lock.release()
+
+    def _run(self):
+        checks = {}
+        ready = healthy = True
+        for name, probe, critical in self.checks:
+            started = time.perf_counter()
+            try:
+                result = probe()
+            except Exception as e:
+                result = {"ok": False, "error": str(e)}
+            result["critical"] = critical
+            result["probe_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            checks[name] = result
+            if not result["ok"]:
+                healthy = False
+                if critical:
+                    ready = False
+                logger.warning("Health check %s failed: %s", name, result)
+        return {
+            "status": "ok" if healthy else ("degraded" if ready else "unavailable"),
+            "ready": ready,
+            "checked_at": time.time(),
+            "checks": checks
+        }
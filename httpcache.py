@@ -0,0 +1,98 @@
+"""ETag и условные GET для читающих эндпоинтов.
+
+ETag строится из счётчиков версий данных, которые увеличиваются на запись,
+поэтому проверка If-None-Match - это сравнение строк без обращения к SQLite.
+Версии пользователей хранятся в массиве фиксированного размера по хешу
+telegram_id: коллизия даёт лишний 200, но никогда не даёт устаревший 304.
+
+Неизменяемые страницы (StaticAsset) кодируются и сжимаются один раз при
+импорте: под gunicorn с preload_app эти байты создаются в мастере и делятся
+воркерами через copy-on-write.
+"""
+import os
+import gzip
+import hashlib
+import threading
+from array import array
+from functools import wraps
+
+from flask import request, make_response, Response
+
+USER_VERSION_SLOTS = 1 << 16
+
+
+class DataVersions:
+    """Счётчики версий: общий (лидерборды) и по пользователям"""
+
+    def __init__(self, slots=USER_VERSION_SLOTS):
+        # Эпоха процесса: после рестарта или в другом воркере ETag не совпадёт
+        self.epoch = os.urandom(4).hex()
+        self.global_version = 0
+        self.user_versions = array('Q', [0]) * slots
+        self.slots = slots
+        self.lock = threading.Lock()
+
+    def bump(self, telegram_id=None):
+        with self.lock:
+            self.global_version += 1
+            if telegram_id is not None:
+                self.user_versions[hash(telegram_id) % self.slots] = self.global_version
+
+    def invalidate_all(self):
+        """Сменить эпоху: все выданные ранее ETag перестают совпадать"""
+        with self.lock:
+            self.epoch = os.urandom(4).hex()
+            self.global_version += 1
+
+    def global_tag(self, *parts):
+        return '-'.join([self.epoch, str(self.global_version), *map(str, parts)])
+
+    def user_tag(self, telegram_id, *parts):
+        version = self.user_versions[hash(telegram_id) % self.slots]
+        return '-'.join([self.epoch, 'u', str(version), str(telegram_id), *map(str, parts)])
+
+
+def conditional(etag_func, cache_control, vary='Accept-Encoding'):
+    """Отдавать 304 по If-None-Match до вызова view, иначе проставлять ETag и Cache-Control"""
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            etag = etag_func(*args, **kwargs)
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = cache_control
+            for header in ([vary] if isinstance(vary, str) else vary):
+                response.vary.add(header)
+            return response
+        return wrapped
+    return decorator
+
+
+class StaticAsset:
+    """Неизменяемый ответ: тело, его gzip-версия и ETag, посчитанные один раз"""
+
+    def __init__(self, body, mimetype, cache_control='public, no-cache'):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.gzipped = gzip.compress(self.body, compresslevel=9, mtime=0)
+        self.etag = hashlib.sha256(self.body).hexdigest()[:20]
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+
+    def response(self):
+        # ETag слабый: gzip и несжатое тело - разные представления одной страницы
+        if request.if_none_match.contains_weak(self.etag):
+            response = Response(status=304)
+        elif 'gzip' in request.accept_encodings:
+            response = Response(self.gzipped, mimetype=self.mimetype)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(self.body, mimetype=self.mimetype)
+        response.set_etag(self.etag, weak=True)
+        response.headers['Cache-Control'] = self.cache_control
+        response.vary.add('Accept-Encoding')
+        return response
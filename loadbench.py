@@ -0,0 +1,169 @@
+"""Замер масштабирования веб-сервера по числу воркеров gunicorn.
+
+Для каждого числа воркеров запускает gunicorn -c gunicorn.conf.py на копии
+тестовой базы и гоняет смешанную нагрузку из нескольких процессов-клиентов с
+keep-alive: профиль и место игрока, лидерборд, страница игры и начисления.
+Печатает запросы в секунду, ускорение относительно первого прогона и задержки.
+
+    python fixtures.py --users 20000 --out bench.db
+    python loadbench.py --db bench.db --workers 1,2,4 --duration 10
+
+Клиенты работают на той же машине и тоже занимают ядра: для честной картины
+оставьте им ядра в запасе (--clients) или ограничьте сервер через taskset.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import http.client
+import multiprocessing
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# (вес, метод, путь) - {tid} заменяется случайным игроком
+MIX = [
+    (30, 'GET', '/user/{tid}'),
+    (20, 'GET', '/rank/{tid}'),
+    (20, 'GET', '/leaderboard?limit=10'),
+    (15, 'GET', '/points/{tid}'),
+    (5, 'GET', '/game'),
+    (10, 'POST', '/add_points'),
+]
+
+
+def client(port, telegram_ids, duration, seed, results):
+    """Один процесс-клиент: запросы по одному keep-alive соединению до истечения времени"""
+    rng = random.Random(seed)
+    weights = [w for w, _, _ in MIX]
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    latencies, errors, shed = [], 0, 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        _, method, path = rng.choices(MIX, weights)[0]
+        tid = rng.choice(telegram_ids)
+        body, headers = None, {'Accept-Encoding': 'gzip'}
+        if method == 'POST':
+            body = json.dumps({"telegram_id": tid, "points": rng.randint(1, 10)})
+            headers['Content-Type'] = 'application/json'
+        started = time.perf_counter()
+        try:
+            conn.request(method, path.format(tid=tid), body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+        if response.status == 503:
+            shed += 1
+        elif response.status >= 400 and response.status != 404:
+            errors += 1
+    conn.close()
+    results.put((latencies, errors, shed))
+
+
+def wait_ready(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("gunicorn exited during startup")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            conn.request('GET', '/readyz')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("gunicorn did not become ready")
+
+
+def run(db, workers, clients, duration, port, telegram_ids):
+    workdir = tempfile.mkdtemp(prefix='veln-loadbench-')
+    db_copy = os.path.join(workdir, 'bench.db')
+    shutil.copy(db, db_copy)
+    env = dict(os.environ,
+               PORT=str(port),
+               WEB_CONCURRENCY=str(workers),
+               DATABASE_PATH=db_copy,
+               BACKUP_INTERVAL_SECONDS='0',
+               RECONCILE_INTERVAL_SECONDS='0',
+               ARCHIVE_INTERVAL_SECONDS='0')
+    env.pop('DATABASE_URL', None)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(HERE, 'gunicorn.conf.py'), 'server:app'],
+        cwd=HERE, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        wait_ready(port, server)
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=client, args=(port, telegram_ids, duration, i, results))
+                 for i in range(clients)]
+        for proc in procs:
+            proc.start()
+        latencies, errors, shed = [], 0, 0
+        for _ in procs:
+            part, part_errors, part_shed = results.get()
+            latencies.extend(part)
+            errors += part_errors
+            shed += part_shed
+        for proc in procs:
+            proc.join()
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies.sort()
+    pick = lambda q: latencies[min(int(len(latencies) * q), len(latencies) - 1)] * 1000 if latencies else 0
+    return {"rps": len(latencies) / duration, "p50": pick(0.5), "p99": pick(0.99), "errors": errors, "shed": shed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Масштабирование gunicorn по числу воркеров')
+    parser.add_argument('--db', required=True, help='База SQLite (например, из fixtures.py)')
+    parser.add_argument('--workers', default=None, help='Список чисел воркеров, по умолчанию 1,2,4..ядер')
+    parser.add_argument('--clients', type=int, default=None, help='Процессов-клиентов (по умолчанию 2 на ядро)')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args(argv)
+
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    if args.workers:
+        counts = [int(n) for n in args.workers.split(',')]
+    else:
+        counts, n = [], 1
+        while n < cpus:
+            counts.append(n)
+            n *= 2
+        counts.append(cpus)
+    clients = args.clients or max(2 * cpus, 2)
+
+    conn = sqlite3.connect(args.db)
+    telegram_ids = [row[0] for row in conn.execute('SELECT telegram_id FROM users ORDER BY RANDOM() LIMIT 10000')]
+    conn.close()
+    if not telegram_ids:
+        print("No users in the database; generate one with fixtures.py", file=sys.stderr)
+        return 1
+
+    print(f"cpus: {cpus}, clients: {clients}, duration: {args.duration}s")
+    print(f"{'workers':>7}{'req/s':>10}{'speedup':>9}{'p50 ms':>9}{'p99 ms':>9}{'shed':>7}{'errors':>8}")
+    baseline = None
+    for workers in counts:
+        result = run(args.db, workers, clients, args.duration, args.port, telegram_ids)
+        baseline = baseline or result["rps"]
+        print(f"{workers:>7}{result['rps']:>10.0f}{result['rps'] / baseline:>8.2f}x"
+              f"{result['p50']:>9.1f}{result['p99']:>9.1f}{result['shed']:>7}{result['errors']:>8}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,279 @@
+"""Асинхронное структурированное логирование.
+
+Запрос только кладёт LogRecord в очередь (QueueHandler): сообщение не
+форматируется и в поток не пишется - это делает фоновый QueueListener, по
+строке JSON на запись. Поэтому аргументы передаются лениво, в стиле
+logger.info("Added %s points", points), и должны быть неизменяемыми
+значениями - подставятся они уже в другом потоке. Если очередь полна, запись
+отбрасывается и считается, запрос не ждёт.
+
+Частые события (начисление на каждый sync каждого игрока) сэмплируются по
+ключу: logger.info(..., extra={"sample": "sync"}) пропускает каждую N-ю
+запись ключа, у пропущенной в JSON есть число отброшенных с прошлой.
+Предупреждения и ошибки не сэмплируются никогда.
+
+Уровни модулей меняются на лету через set_levels() (см. /admin/logging).
+После fork фоновый поток не переживает, поэтому воркер вызывает start()
+и получает свою очередь и свой поток.
+"""
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import argparse
+import threading
+import logging.handlers
+from datetime import datetime, timezone
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+
+
+def parse_mapping(value, convert=str):
+    """'sync=0.01,add_points=0.1' -> {'sync': 0.01, 'add_points': 0.1}"""
+    result = {}
+    for item in (value or '').split(','):
+        name, sep, setting = item.partition('=')
+        if sep and name.strip():
+            result[name.strip()] = convert(setting.strip())
+    return result
+
+
+class JsonFormatter(logging.Formatter):
+    """Запись одной строкой JSON"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "pid": record.process
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            entry["request_id"] = request_id
+        sample = getattr(record, 'sample', None)
+        if sample:
+            entry["sample"] = sample
+            entry["sample_rate"] = record.sample_rate
+            entry["dropped"] = record.sample_dropped
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждую N-ю запись ключа sample (N = 1 / rate), считает отброшенные"""
+
+    def __init__(self, rates=None):
+        super().__init__()
+        self.rates = dict(rates or {})
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def set_rates(self, rates):
+        with self.lock:
+            self.rates = dict(rates)
+
+    def filter(self, record):
+        sample = getattr(record, 'sample', None)
+        if sample is None or record.levelno > logging.INFO:
+            return True
+        rate = self.rates.get(sample, 1.0)
+        with self.lock:
+            counter = self.counters.get(sample)
+            if counter is None:
+                # [увидено, отброшено всего, отброшено с последней пропущенной]
+                counter = self.counters[sample] = [0, 0, 0]
+            counter[0] += 1
+            if rate >= 1 or (rate > 0 and (counter[0] - 1) % round(1 / rate) == 0):
+                record.sample_rate = rate
+                record.sample_dropped = counter[2]
+                counter[2] = 0
+                return True
+            counter[1] += 1
+            counter[2] += 1
+            return False
+
+    def stats(self):
+        with self.lock:
+            return {sample: {"rate": self.rates.get(sample, 1.0), "seen": seen, "dropped": dropped}
+                    for sample, (seen, dropped, _) in self.counters.items()}
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет к записи поля контекста (id запроса) в потоке, где она создана"""
+
+    def __init__(self, fields):
+        super().__init__()
+        self.fields = fields
+
+    def filter(self, record):
+        for name, value in self.fields().items():
+            setattr(record, name, value)
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler без форматирования в вызывающем потоке и без ожидания при полной очереди"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Трассировку исключения - сейчас: фреймы не должны жить до записи в другом потоке
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline:
+    """Очередь, фоновая запись и настройки уровней корневого логгера"""
+
+    def __init__(self, level='INFO', fmt='json', queue_size=10000, sample_rates=None, levels=None,
+                 stream=None):
+        self.fmt = fmt
+        self.queue_size = queue_size
+        self.stream = stream or sys.stderr
+        self.sampler = SamplingFilter(sample_rates)
+        self.output = logging.StreamHandler(self.stream)
+        if fmt == 'json':
+            self.output.setFormatter(JsonFormatter())
+        else:
+            self.output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        self.handler = NonBlockingQueueHandler(queue.Queue(maxsize=queue_size))
+        self.handler.addFilter(self.sampler)
+        self.listener = None
+        self.pid = None
+        self.root = logging.getLogger()
+        self.root.setLevel(level.upper())
+        self.set_levels(levels or {})
+
+    def install(self, context=None):
+        """Заменить обработчики корневого логгера очередью и запустить запись"""
+        for handler in list(self.root.handlers):
+            self.root.removeHandler(handler)
+        self.optimize_records()
+        if context:
+            self.handler.addFilter(ContextFilter(context))
+        self.root.addHandler(self.handler)
+        self.start()
+        atexit.register(self.stop)
+
+    @staticmethod
+    def optimize_records():
+        """Не собирать в LogRecord то, что не попадает в строку лога (раздел Optimization документации logging)"""
+        # Поиск файла и строки вызова обходит стек на каждой записи - самая дорогая часть
+        logging._srcfile = None
+        logging.logThreads = False
+        logging.logMultiprocessing = False
+
+    def start(self):
+        """Запустить фоновую запись; после fork - со своей очередью (записи мастера он допишет сам)"""
+        if self.listener and self.pid == os.getpid():
+            return
+        if self.pid is not None:
+            self.handler.queue = queue.Queue(maxsize=self.queue_size)
+        self.listener = logging.handlers.QueueListener(self.handler.queue, self.output)
+        self.listener.start()
+        self.pid = os.getpid()
+
+    def stop(self):
+        """Дописать очередь (при выходе процесса)"""
+        if self.listener and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+
+    def set_levels(self, levels):
+        """Уровни по именам логгеров; 'root' - корневой, None - сбросить к наследованию"""
+        normalized = {}
+        for name, level in levels.items():
+            if level is not None and (not isinstance(level, str) or level.upper() not in LEVELS):
+                raise ValueError(f"Unknown level {level!r} for {name}")
+            normalized[name] = level.upper() if level else None
+        for name, level in normalized.items():
+            target = self.root if name in ('root', '') else logging.getLogger(name)
+            if level is not None:
+                target.setLevel(level)
+            elif target is not self.root:
+                target.setLevel(logging.NOTSET)
+        return normalized
+
+    def levels(self):
+        """Явно заданные уровни модулей и корневой"""
+        result = {"root": logging.getLevelName(self.root.level)}
+        for name, item in sorted(logging.root.manager.loggerDict.items()):
+            if isinstance(item, logging.Logger) and item.level != logging.NOTSET:
+                result[name] = logging.getLevelName(item.level)
+        return result
+
+    def stats(self):
+        return {
+            "format": self.fmt,
+            "levels": self.levels(),
+            "queue_depth": self.handler.queue.qsize(),
+            "queue_size": self.queue_size,
+            "queue_dropped": self.handler.dropped,
+            "sampling": self.sampler.stats()
+        }
+
+
+def bench(records):
+    """Время на вызов logger.info в потоке запроса: синхронный stderr с f-строкой против очереди"""
+    devnull = open(os.devnull, 'w')
+    logger = logging.getLogger('bench')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    rng = random.Random(1)
+    values = [(rng.randrange(10 ** 9), rng.randrange(100)) for _ in range(records)]
+
+    sync_handler = logging.StreamHandler(devnull)
+    sync_handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+    logger.handlers = [sync_handler]
+    start = time.perf_counter()
+    for telegram_id, points in values:
+        logger.info(f"Added {points} points to user {telegram_id}")
+    sync_us = (time.perf_counter() - start) / records * 1e6
+
+    results = []
+    LogPipeline.optimize_records()
+    for rate in (1.0, 0.01):
+        pipeline = LogPipeline(stream=devnull, sample_rates={"add": rate}, queue_size=records + 1)
+        logger.handlers = [pipeline.handler]
+        start = time.perf_counter()
+        for telegram_id, points in values:
+            logger.info("Added %s points to user %s", points, telegram_id, extra={"sample": "add"})
+        results.append((rate, (time.perf_counter() - start) / records * 1e6))
+        pipeline.start()
+        pipeline.stop()
+    logging.getLogger().handlers = []
+
+    print(f"records:                 {records:,}")
+    print(f"sync stderr, f-string:   {sync_us:.2f} us/call")
+    for rate, us in results:
+        print(f"queue, lazy, rate {rate:<5}: {us:.2f} us/call ({sync_us / us:.1f}x)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Асинхронное логирование')
+    parser.add_argument('command', choices=['bench'])
+    parser.add_argument('--records', type=int, default=100000)
+    args = parser.parse_args(argv)
+    bench(args.records)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
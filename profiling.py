@@ -0,0 +1,69 @@
+"""Сэмплирующий профайлер по запросу администратора.
+
+Поток профайлера раз в interval снимает стеки всех потоков процесса через
+sys._current_frames() и считает одинаковые стеки. Результат - collapsed
+stacks ("поток;функция;функция N" на строку), которые напрямую принимают
+flamegraph.pl, speedscope и inferno. Профилируется только текущий воркер:
+с sync-воркерами gunicorn в нём видны фоновые потоки, с gthread - и
+параллельные запросы.
+"""
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+MAX_SECONDS = 60
+
+
+class ProfilerBusy(Exception):
+    """В процессе уже идёт профилирование"""
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    """Профайлер, снимающий стеки потоков с заданным интервалом"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def profile(self, seconds, interval=0.005, include_idle=False):
+        """Собрать сэмплы за seconds секунд и вернуть (collapsed stacks, число сэмплов)"""
+        seconds = min(max(seconds, 0.1), MAX_SECONDS)
+        if not self.lock.acquire(blocking=False):
+            raise ProfilerBusy("Profiler already running")
+        try:
+            counts = Counter()
+            me = threading.get_ident()
+            samples = 0
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(_frame_label(frame.f_code))
+                        frame = frame.f_back
+                    if not include_idle and stack and self._idle(stack[0]):
+                        continue
+                    stack.append(names.get(ident, f"thread-{ident}"))
+                    counts[';'.join(reversed(stack))] += 1
+                samples += 1
+                time.sleep(interval)
+        finally:
+            self.lock.release()
+        lines = [f"{stack} {count}" for stack, count in counts.most_common()]
+        return '\n'.join(lines) + ('\n' if lines else ''), samples
+
+    @staticmethod
+    def _idle(label):
+        """Поток ждёт (sleep, очередь, сокет) - такие сэмплы обычно шум"""
+        return label.startswith(('wait ', 'select ', 'accept ', 'readinto ', '_wait_for_tstate_lock '))
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,165 @@
+"""Оценка места игрока по компактной гистограмме очков.
+
+Гистограмма лог-линейная (как HDR Histogram): значения до SUB_BUCKETS хранятся
+точно, дальше каждый интервал [2^k, 2^(k+1)) делится на SUB_BUCKETS корзин,
+поэтому относительная ошибка не превышает 1/SUB_BUCKETS. Счётчики корзин лежат
+в дереве Фенвика, так что обновление и запрос стоят O(log корзин) - около
+десятка операций независимо от числа игроков.
+"""
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_POINTS_BITS = 63
+BUCKET_COUNT = SUB_BUCKETS + (MAX_POINTS_BITS - SUB_BUCKET_BITS) * SUB_BUCKETS
+
+
+def bucket_index(value):
+    """Номер корзины для значения очков"""
+    if value < SUB_BUCKETS:
+        return max(value, 0)
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return SUB_BUCKETS + shift * SUB_BUCKETS + ((value >> shift) - SUB_BUCKETS)
+
+
+def bucket_bounds(index):
+    """Границы корзины [low, high)"""
+    if index < SUB_BUCKETS:
+        return index, index + 1
+    shift, offset = divmod(index - SUB_BUCKETS, SUB_BUCKETS)
+    low = (SUB_BUCKETS + offset) << shift
+    return low, low + (1 << shift)
+
+
+class ScoreHistogram:
+    """Гистограмма очков на дереве Фенвика"""
+
+    def __init__(self):
+        self.tree = [0] * (BUCKET_COUNT + 1)
+        self.counts = [0] * BUCKET_COUNT
+        self.total = 0
+
+    def update(self, value, delta):
+        index = bucket_index(value)
+        self.counts[index] += delta
+        self.total += delta
+        i = index + 1
+        while i <= BUCKET_COUNT:
+            self.tree[i] += delta
+            i += i & -i
+
+    def count_through(self, index):
+        """Количество значений в корзинах 0..index включительно"""
+        result = 0
+        i = index + 1
+        while i > 0:
+            result += self.tree[i]
+            i -= i & -i
+        return result
+
+    def count_greater(self, value):
+        """Оценка числа значений строго больше value"""
+        index = bucket_index(value)
+        above = self.total - self.count_through(index)
+        low, high = bucket_bounds(index)
+        # Внутри корзины считаем распределение равномерным
+        inside = self.counts[index] * (high - 1 - value) / (high - low)
+        return above + max(inside, 0)
+
+
+class RankEstimator:
+    """Место и перцентиль игрока: точно для маленьких таблиц, по гистограмме для больших"""
+
+    def __init__(self, connect, mode='auto', exact_max_users=10000, refresh_seconds=300):
+        self.connect = connect
+        self.mode = mode
+        self.exact_max_users = exact_max_users
+        self.refresh_seconds = refresh_seconds
+        self.histogram = ScoreHistogram()
+        self.loaded_at = 0
+        self.lock = threading.Lock()
+        self.reloading = False
+
+    def load(self):
+        """Построить гистограмму по таблице users (один проход при старте и при обновлении)"""
+        histogram = ScoreHistogram()
+        conn = self.connect()
+        try:
+            for (points,) in conn.execute('SELECT points FROM users'):
+                histogram.update(points or 0, 1)
+        finally:
+            conn.close()
+        with self.lock:
+            self.histogram = histogram
+            self.loaded_at = time.monotonic()
+        logger.info("Rank histogram loaded: %s users", histogram.total)
+
+    def _reload_in_background(self):
+        try:
+            self.load()
+        except Exception as e:
+            logger.error("Rank histogram reload error: %s", e)
+        finally:
+            self.reloading = False
+
+    def refresh_if_stale(self):
+        """Периодически пересобирать гистограмму, чтобы учесть записи других воркеров"""
+        if self.reloading or time.monotonic() - self.loaded_at < self.refresh_seconds:
+            return
+        self.reloading = True
+        threading.Thread(target=self._reload_in_background, daemon=True).start()
+
+    def add(self, points):
+        with self.lock:
+            self.histogram.update(points, 1)
+
+    def remove(self, points):
+        with self.lock:
+            self.histogram.update(points, -1)
+
+    def move(self, old_points, new_points):
+        if bucket_index(old_points) == bucket_index(new_points):
+            return
+        with self.lock:
+            self.histogram.update(old_points, -1)
+            self.histogram.update(new_points, 1)
+
+    def use_exact(self):
+        if self.mode == 'exact':
+            return True
+        if self.mode == 'approx':
+            return False
+        return self.histogram.total <= self.exact_max_users
+
+    def estimate(self, points):
+        """Вернуть место, общее число игроков и процент лучших"""
+        self.refresh_if_stale()
+
+        if self.use_exact():
+            conn = self.connect()
+            try:
+                greater = conn.execute(
+                    'SELECT COUNT(*) FROM users WHERE points > ?', (points,)
+                ).fetchone()[0]
+                total = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+            finally:
+                conn.close()
+            exact = True
+        else:
+            with self.lock:
+                greater = round(self.histogram.count_greater(points))
+                total = self.histogram.total
+            exact = False
+
+        total = max(total, 1)
+        rank = min(greater + 1, total)
+        return {
+            "rank": rank,
+            "total_players": total,
+            "top_percent": round(rank * 100 / total, 2),
+            "exact": exact
+        }
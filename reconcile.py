@@ -0,0 +1,303 @@
+"""Сверка балансов users.points с суммой журнала transactions.
+
+Пользователи обходятся порциями по id (keyset paging), водяной знак хранится
+в reconcile_state, так что проход продолжается после рестарта. Сумма журнала
+берётся из ledger_rollups (сумма и последний учтённый id транзакции на
+пользователя) плюс только новые транзакции, поэтому повторные проходы почти
+не читают старый журнал; полный проход (full) пересчитывает суммы с нуля.
+Порция читается в одной транзакции чтения - баланс и журнал пишутся вместе,
+и снимок WAL видит их согласованными, - а результаты пишутся второй короткой
+транзакцией. Между порциями поток спит так, чтобы занимать базу не больше
+duty_cycle времени.
+
+Расхождения попадают в reconcile_mismatches. Режимы исправления: off (только
+отчёт), balance (users.points = сумма журнала), ledger (корректирующая
+транзакция типа 'reconcile'). Проход ведёт один процесс - тот, кто держит
+аренду в reconcile_state.
+"""
+import os
+import time
+import uuid
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 60
+REPAIR_MODES = ('off', 'balance', 'ledger')
+
+
+def init_tables(cursor):
+    """Создать таблицы сверки и индекс журнала по пользователю"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconcile_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            pass_no INTEGER NOT NULL DEFAULT 0,
+            watermark INTEGER NOT NULL DEFAULT 0,
+            full_pass INTEGER NOT NULL DEFAULT 1,
+            checked INTEGER NOT NULL DEFAULT 0,
+            mismatches INTEGER NOT NULL DEFAULT 0,
+            repaired INTEGER NOT NULL DEFAULT 0,
+            pass_started_at REAL,
+            last_pass_finished_at REAL NOT NULL DEFAULT 0,
+            lease_owner TEXT,
+            lease_until REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('INSERT OR IGNORE INTO reconcile_state (id) VALUES (1)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ledger_rollups (
+            user_id INTEGER PRIMARY KEY,
+            points_sum INTEGER NOT NULL,
+            last_tx_id INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reconcile_mismatches (
+            user_id INTEGER PRIMARY KEY,
+            telegram_id INTEGER NOT NULL,
+            balance INTEGER NOT NULL,
+            ledger_sum INTEGER NOT NULL,
+            pass_no INTEGER NOT NULL,
+            repaired INTEGER NOT NULL DEFAULT 0,
+            detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # Покрывающий индекс: сумма по диапазону пользователей без чтения строк журнала
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_transactions_user
+        ON transactions (user_id, id, points)
+    ''')
+
+
+class Reconciler:
+    """Фоновая инкрементальная сверка с ограничением нагрузки"""
+
+    def __init__(self, connect, chunk_size=1000, duty_cycle=0.1, pass_interval=86400,
+                 repair='off', on_repaired=None, poll_interval=30):
+        if repair not in REPAIR_MODES:
+            raise ValueError(f"repair must be one of {REPAIR_MODES}")
+        self.connect = connect
+        self.chunk_size = chunk_size
+        self.duty_cycle = duty_cycle
+        self.pass_interval = pass_interval
+        self.repair = repair
+        self.on_repaired = on_repaired
+        self.poll_interval = poll_interval
+        self.owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.thread = None
+
+    def start(self):
+        if self.thread or self.pass_interval <= 0:
+            return
+        self.thread = threading.Thread(target=self._loop, daemon=True, name='reconcile')
+        self.thread.start()
+
+    def request_pass(self, full=False):
+        """Начать новый проход при следующей проверке, не дожидаясь интервала"""
+        conn = self.connect()
+        try:
+            conn.execute('''
+                UPDATE reconcile_state SET last_pass_finished_at = 0,
+                    full_pass = CASE WHEN watermark = 0 THEN ? ELSE full_pass END
+                WHERE id = 1
+            ''', (1 if full else 0,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def progress(self, mismatch_limit=20):
+        """Состояние прохода и последние найденные расхождения"""
+        conn = self.connect()
+        try:
+            row = conn.execute('''
+                SELECT pass_no, watermark, full_pass, checked, mismatches, repaired,
+                       pass_started_at, last_pass_finished_at
+                FROM reconcile_state WHERE id = 1
+            ''').fetchone()
+            max_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM users').fetchone()[0]
+            mismatches = conn.execute('''
+                SELECT telegram_id, balance, ledger_sum, pass_no, repaired, detected_at
+                FROM reconcile_mismatches ORDER BY detected_at DESC LIMIT ?
+            ''', (mismatch_limit,)).fetchall()
+            open_mismatches = conn.execute(
+                'SELECT COUNT(*) FROM reconcile_mismatches WHERE repaired = 0'
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        state = dict(zip(('pass_no', 'watermark', 'full_pass', 'checked', 'mismatches', 'repaired',
+                          'pass_started_at', 'last_pass_finished_at'), row))
+        state['full_pass'] = bool(state['full_pass'])
+        state['running'] = state['watermark'] > 0
+        if state['running'] and max_id:
+            state['percent'] = round(min(state['watermark'] * 100 / max_id, 100), 1)
+        else:
+            state['percent'] = 100.0
+        state['repair_mode'] = self.repair
+        state['open_mismatches'] = open_mismatches
+        state['recent_mismatches'] = [
+            dict(zip(('telegram_id', 'balance', 'ledger_sum', 'pass_no', 'repaired', 'detected_at'), m))
+            for m in mismatches
+        ]
+        return state
+
+    def _loop(self):
+        while True:
+            try:
+                if self._claim():
+                    started = time.monotonic()
+                    if self._step():
+                        # Спим так, чтобы работа занимала не больше duty_cycle времени
+                        busy = time.monotonic() - started
+                        time.sleep(max(busy * (1 / self.duty_cycle - 1), 0.01))
+                        continue
+            except Exception as e:
+                logger.error("Reconciler error: %s", e)
+            time.sleep(self.poll_interval)
+
+    def _claim(self):
+        """Взять или продлить аренду; False - сверку ведёт другой процесс"""
+        conn = self.connect()
+        try:
+            now = time.time()
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE reconcile_state SET lease_owner = ?, lease_until = ?
+                WHERE id = 1 AND (lease_until < ? OR lease_owner = ?)
+            ''', (self.owner, now + LEASE_SECONDS, now, self.owner))
+            conn.commit()
+            return cursor.rowcount > 0
+        finally:
+            conn.close()
+
+    def _step(self):
+        """Сверить одну порцию; False - делать нечего до следующего прохода"""
+        conn = self.connect()
+        try:
+            cursor = conn.cursor()
+            pass_no, watermark, full_pass, last_finished = cursor.execute('''
+                SELECT pass_no, watermark, full_pass, last_pass_finished_at
+                FROM reconcile_state WHERE id = 1
+            ''').fetchone()
+            if watermark == 0 and time.time() - last_finished < self.pass_interval:
+                return False
+
+            # Снимок: баланс и журнал одной порции видны на один момент
+            cursor.execute('BEGIN')
+            users = cursor.execute('''
+                SELECT u.id, u.telegram_id, u.points, r.points_sum, r.last_tx_id
+                FROM users u LEFT JOIN ledger_rollups r ON r.user_id = u.id
+                WHERE u.id > ? ORDER BY u.id LIMIT ?
+            ''', (watermark, self.chunk_size)).fetchall()
+            if not users:
+                conn.rollback()
+                self._finish_pass(cursor, conn, pass_no)
+                return True
+            low, high = watermark, users[-1][0]
+            if full_pass:
+                deltas = cursor.execute('''
+                    SELECT user_id, SUM(points), MAX(id) FROM transactions
+                    WHERE user_id > ? AND user_id <= ? GROUP BY user_id
+                ''', (low, high)).fetchall()
+            else:
+                deltas = cursor.execute('''
+                    SELECT t.user_id, SUM(t.points), MAX(t.id)
+                    FROM transactions t LEFT JOIN ledger_rollups r ON r.user_id = t.user_id
+                    WHERE t.user_id > ? AND t.user_id <= ? AND t.id > COALESCE(r.last_tx_id, 0)
+                    GROUP BY t.user_id
+                ''', (low, high)).fetchall()
+            conn.rollback()
+
+            deltas = {user_id: (points_sum, last_tx_id) for user_id, points_sum, last_tx_id in deltas}
+            rollups, mismatches, consistent = [], [], []
+            for user_id, telegram_id, balance, points_sum, last_tx_id in users:
+                if full_pass:
+                    points_sum, last_tx_id = 0, 0
+                points_sum, last_tx_id = points_sum or 0, last_tx_id or 0
+                if user_id in deltas:
+                    delta, last_tx_id = deltas[user_id]
+                    points_sum += delta or 0
+                    rollups.append((user_id, points_sum, last_tx_id))
+                if (balance or 0) != points_sum:
+                    mismatches.append((user_id, telegram_id, balance or 0, points_sum))
+                else:
+                    consistent.append((user_id,))
+
+            repaired = self._write_chunk(cursor, conn, watermark == 0, high, len(users),
+                                         rollups, mismatches, consistent, pass_no)
+        finally:
+            conn.close()
+
+        for user_id, telegram_id, balance, points_sum in mismatches:
+            logger.warning("Balance mismatch for user %s: balance %s, ledger %s", telegram_id, balance, points_sum)
+        if self.on_repaired:
+            for telegram_id, old_balance, new_balance in repaired:
+                self.on_repaired(telegram_id, old_balance, new_balance)
+        return True
+
+    def _write_chunk(self, cursor, conn, starting, high, checked, rollups, mismatches, consistent, pass_no):
+        repaired, fixed_count = [], 0
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.executemany('''
+                INSERT INTO ledger_rollups (user_id, points_sum, last_tx_id) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET points_sum = excluded.points_sum, last_tx_id = excluded.last_tx_id
+            ''', rollups)
+            cursor.executemany('DELETE FROM reconcile_mismatches WHERE user_id = ?', consistent)
+            for user_id, telegram_id, balance, points_sum in mismatches:
+                fixed = self._repair(cursor, user_id, balance, points_sum)
+                cursor.execute('''
+                    INSERT OR REPLACE INTO reconcile_mismatches
+                        (user_id, telegram_id, balance, ledger_sum, pass_no, repaired)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', (user_id, telegram_id, balance, points_sum, pass_no, int(fixed)))
+                if fixed:
+                    fixed_count += 1
+                    if self.repair == 'balance':
+                        repaired.append((telegram_id, balance, points_sum))
+            # Счётчики обнуляются в начале прохода, чтобы после него был виден итог
+            cursor.execute('''
+                UPDATE reconcile_state SET watermark = ?,
+                    checked = CASE WHEN ? THEN 0 ELSE checked END + ?,
+                    mismatches = CASE WHEN ? THEN 0 ELSE mismatches END + ?,
+                    repaired = CASE WHEN ? THEN 0 ELSE repaired END + ?,
+                    pass_started_at = CASE WHEN ? THEN ? ELSE pass_started_at END,
+                    lease_until = ?
+                WHERE id = 1 AND lease_owner = ?
+            ''', (high, starting, checked, starting, len(mismatches), starting, fixed_count,
+                  starting, time.time(), time.time() + LEASE_SECONDS, self.owner))
+            if cursor.rowcount == 0:
+                # Аренду забрал другой процесс - его порция главнее
+                conn.rollback()
+                return []
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return repaired
+
+    def _repair(self, cursor, user_id, balance, points_sum):
+        """Исправить расхождение, если баланс не изменился после снимка"""
+        if self.repair == 'balance':
+            cursor.execute('''
+                UPDATE users SET points = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND points = ?
+            ''', (points_sum, user_id, balance))
+            return cursor.rowcount > 0
+        if self.repair == 'ledger':
+            cursor.execute('''
+                INSERT INTO transactions (user_id, points, transaction_type, description)
+                SELECT id, ?, 'reconcile', 'Ledger adjustment' FROM users WHERE id = ? AND points = ?
+            ''', (balance - points_sum, user_id, balance))
+            return cursor.rowcount > 0
+        return False
+
+    def _finish_pass(self, cursor, conn, pass_no):
+        row = cursor.execute('SELECT checked, mismatches, repaired FROM reconcile_state WHERE id = 1').fetchone()
+        cursor.execute('''
+            UPDATE reconcile_state SET pass_no = pass_no + 1, watermark = 0, full_pass = 0,
+                last_pass_finished_at = ?
+            WHERE id = 1 AND lease_owner = ?
+        ''', (time.time(), self.owner))
+        conn.commit()
+        logger.info("Reconcile pass %s finished: %s users checked, %s mismatches, %s repaired", pass_no, row[0], row[1], row[2])
@@ -0,0 +1,164 @@
+"""Сезонные таблицы лидеров (день, неделя, месяц).
+
+Очки за текущий период копятся в season_scores в той же транзакции, что и
+начисление, поэтому чтение сезонного лидерборда - это выборка по индексу без
+агрегации transactions. При смене периода итоговые места прошлого периода
+переносятся в season_archive, а его строки из season_scores удаляются.
+
+Текущий период только растёт. Начисление с прошлым временем (поздняя доставка,
+доигрывание журнала) за уже закрытый период идёт в текущий: архивные места
+закрытого периода не меняются.
+"""
+import threading
+import logging
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+WINDOWS = ('day', 'week', 'month')
+ARCHIVE_SIZE = 100
+
+
+def period_key(window, now=None):
+    """Ключ периода в UTC: 2024-05-17, 2024-W20 или 2024-05"""
+    now = now or datetime.now(timezone.utc)
+    if window == 'day':
+        return now.strftime('%Y-%m-%d')
+    if window == 'week':
+        year, week, _ = now.isocalendar()
+        return f"{year}-W{week:02d}"
+    if window == 'month':
+        return now.strftime('%Y-%m')
+    raise ValueError(f"Unknown leaderboard window: {window}")
+
+
+def init_tables(cursor):
+    """Создать таблицы сезонных лидербордов"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS season_scores (
+            window TEXT NOT NULL,
+            period TEXT NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            points INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (window, period, telegram_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_season_scores_rank
+        ON season_scores (window, period, points DESC)
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS season_archive (
+            window TEXT NOT NULL,
+            period TEXT NOT NULL,
+            rank INTEGER NOT NULL,
+            telegram_id INTEGER NOT NULL,
+            username TEXT,
+            first_name TEXT,
+            points INTEGER NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (window, period, rank)
+        )
+    ''')
+
+
+class SeasonBoards:
+    """Инкрементально поддерживаемые лидерборды по временным окнам"""
+
+    def __init__(self):
+        self.current = {}
+        self.lock = threading.Lock()
+
+    def record_points(self, cursor, telegram_id, points, now=None):
+        """Учесть начисление во всех окнах (вызывается внутри транзакции начисления)"""
+        self.roll_over_if_needed(cursor, now)
+        for window in WINDOWS:
+            # После roll_over текущий период не раньше периода события; более ранний уже закрыт
+            period = max(period_key(window, now), self.current[window])
+            cursor.execute('''
+                INSERT INTO season_scores (window, period, telegram_id, points)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(window, period, telegram_id)
+                DO UPDATE SET points = points + excluded.points
+            ''', (window, period, telegram_id, points))
+
+    def roll_over_if_needed(self, cursor, now=None):
+        """Архивировать завершившиеся периоды в транзакции cursor, вернуть True при смене периода.
+        Начисление с временем раньше текущего периода его не откатывает"""
+        stale = [w for w in WINDOWS if self.current.get(w, '') < period_key(w, now)]
+        if not stale:
+            return False
+        with self.lock:
+            for window in stale:
+                period = period_key(window, now)
+                if window not in self.current:
+                    period = self._latest_period(cursor, window, period)
+                if period > self.current.get(window, ''):
+                    self._archive_finished(cursor, window, period)
+                    self.current[window] = period
+        return True
+
+    def _latest_period(self, cursor, window, period):
+        """Текущий период для процесса, ещё не видевшего начислений: период события, если его
+        не обогнали начисления других процессов и он не закрыт, иначе самый поздний из известных"""
+        live, archived = cursor.execute('''
+            SELECT (SELECT MAX(period) FROM season_scores WHERE window = ?),
+                   (SELECT MAX(period) FROM season_archive WHERE window = ?)
+        ''', (window, window)).fetchone()
+        period = max(period, live or '')
+        if archived is not None and period <= archived:
+            # Период события уже архивирован, а новых начислений ещё нет - текущий по часам
+            period = max(period, period_key(window))
+        return period
+
+    def _archive_finished(self, cursor, window, current_period):
+        finished = [row[0] for row in cursor.execute(
+            'SELECT DISTINCT period FROM season_scores WHERE window = ? AND period < ?',
+            (window, current_period)
+        )]
+        for period in finished:
+            # INSERT OR IGNORE - архивирование идемпотентно, если его начали несколько воркеров
+            rows = cursor.execute('''
+                SELECT s.telegram_id, u.username, u.first_name, s.points
+                FROM season_scores s
+                LEFT JOIN users u ON u.telegram_id = s.telegram_id
+                WHERE s.window = ? AND s.period = ? AND s.points > 0
+                ORDER BY s.points DESC
+                LIMIT ?
+            ''', (window, period, ARCHIVE_SIZE)).fetchall()
+            cursor.executemany('''
+                INSERT OR IGNORE INTO season_archive
+                    (window, period, rank, telegram_id, username, first_name, points)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', [(window, period, i, *row) for i, row in enumerate(rows, 1)])
+            cursor.execute(
+                'DELETE FROM season_scores WHERE window = ? AND period = ?',
+                (window, period)
+            )
+            logger.info("Season %s %s archived: %s players", window, period, len(rows))
+
+    def top(self, cursor, window, limit, period=None):
+        """Вернуть период и строки (telegram_id, username, first_name, points) лидеров окна"""
+        if self.roll_over_if_needed(cursor):
+            cursor.connection.commit()
+        current = period_key(window)
+        period = period or current
+
+        if period == current:
+            cursor.execute('''
+                SELECT s.telegram_id, u.username, u.first_name, s.points
+                FROM season_scores s
+                JOIN users u ON u.telegram_id = s.telegram_id
+                WHERE s.window = ? AND s.period = ? AND s.points > 0
+                ORDER BY s.points DESC
+                LIMIT ?
+            ''', (window, period, limit))
+        else:
+            cursor.execute('''
+                SELECT telegram_id, username, first_name, points
+                FROM season_archive
+                WHERE window = ? AND period = ?
+                ORDER BY rank
+                LIMIT ?
+            ''', (window, period, limit))
+        return period, cursor.fetchall()
@@ -1,34 +1,261 @@
 import os
+import time
 import sqlite3
 # Временно отключаем PostgreSQL из-за проблем совместимости с Python 3.13
 # import psycopg2
 psycopg2 = None
-from flask import Flask, request, jsonify
+import uuid
+from flask import Flask, request, jsonify, g, has_request_context
 from flask_cors import CORS
-import jwt
-from datetime import datetime, timedelta
+import hmac
+from functools import wraps
+from datetime import datetime, timedelta, timezone
 import logging
-
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
+from ranking import RankEstimator
+import seasons
+import backup
+from backup import Snapshotter
+from tracing import tracer, TracedConnection, sql_stats
+from profiling import profiler, ProfilerBusy
+import broadcast
+import reconcile
+import archive
+import friends
+import activity
+import economy
+import health
+import achievements
+from httpcache import DataVersions, conditional, StaticAsset
+from eventlog import EventLog
+from cluster import ClusterBus
+from admission import AdmissionController
+from userstore import UserStore, LOAD_SQL as USER_ROW_SQL
+from auth import InitDataValidator, SessionTokens, AuthError
+from botmessages import Template, Raw, KeyboardCache
+from logpipeline import LogPipeline, parse_mapping
+
+# Настройка логирования: уровень, формат (json или text), уровни отдельных модулей
+# ("werkzeug=WARNING,economy=DEBUG"), доля записываемых частых событий по ключу
+# sample ("sync=0.01") и размер очереди записи
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', 'sync=0.01,add_points=0.01,no_session=0.01')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+
+def request_log_context():
+    """Id текущего запроса для строк лога"""
+    if has_request_context() and 'request_id' in g:
+        return {"request_id": g.request_id}
+    return {}
+
+log_pipeline = LogPipeline(
+    level=LOG_LEVEL,
+    fmt=LOG_FORMAT,
+    queue_size=LOG_QUEUE_SIZE,
+    sample_rates=parse_mapping(LOG_SAMPLE_RATES, float),
+    levels=parse_mapping(LOG_LEVELS)
+)
+log_pipeline.install(context=request_log_context)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-CORS(app)
+# ETag должен быть виден клиенту, preflight для If-None-Match кешируется
+CORS(app, expose_headers=['ETag', 'X-Request-ID'], max_age=600)
 
 # Конфигурация
 SECRET_KEY = os.environ.get('SECRET_KEY', 'veln-super-secret-key-2024')
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
+# Базовый URL Bot API (можно подменить локальным фейком для тестов)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+# Публичный адрес сервера для ссылок в боте вне HTTP-запроса (bot_runner.py)
+PUBLIC_URL = os.environ.get('PUBLIC_URL') or os.environ.get('RENDER_EXTERNAL_URL', '')
 DATABASE_URL = os.environ.get('DATABASE_URL')
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'veln_game.db')
+# Общая база для нескольких инстансов: sqlite:////shared/veln_game.db
+if DATABASE_URL and DATABASE_URL.startswith('sqlite:///'):
+    DATABASE_PATH = DATABASE_URL[len('sqlite:///'):]
+elif DATABASE_URL:
+    logger.warning("DATABASE_URL is not a sqlite:/// URL (PostgreSQL is disabled), using DATABASE_PATH")
+# Шина инвалидации между инстансами и воркерами: redis://host:6379 (пусто - один процесс)
+CLUSTER_BUS_URL = os.environ.get('CLUSTER_BUS_URL', '')
+# Сессии мини-приложения: секрет подписи JWT, время жизни, срок годности initData и обязательность токена.
+# Без своего SESSION_SECRET токены не выдаются и не принимаются (SECRET_KEY лежит в публичном репозитории)
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '')
+AUTH_TOKEN_TTL = int(os.environ.get('AUTH_TOKEN_TTL', 3600))
+AUTH_INIT_DATA_MAX_AGE = int(os.environ.get('AUTH_INIT_DATA_MAX_AGE', 86400))
+AUTH_REQUIRED = os.environ.get('AUTH_REQUIRED', '0') == '1'
+# Имя бота для реферальных ссылок (по умолчанию берётся из getMe)
+BOT_USERNAME = os.environ.get('BOT_USERNAME', '')
+# Токен для /admin/* (без него админские эндпоинты отключены)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+# Фоновые снапшоты базы
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL_SECONDS = int(os.environ.get('BACKUP_INTERVAL_SECONDS', 3600))
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 24))
+# Рассылки: сообщений в секунду (лимит Telegram ~30) и параллельных соединений
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 25))
+BROADCAST_CONNECTIONS = int(os.environ.get('BROADCAST_CONNECTIONS', 8))
+# Сколько секунд CDN/прокси может отдавать лидерборд без ревалидации
+LEADERBOARD_MAX_AGE = int(os.environ.get('LEADERBOARD_MAX_AGE', 5))
+# Журнал событий начислений (пусто - /add_points пишет прямо в базу)
+EVENT_LOG_DIR = os.environ.get('EVENT_LOG_DIR', '')
+EVENT_LOG_FSYNC_WINDOW_MS = float(os.environ.get('EVENT_LOG_FSYNC_WINDOW_MS', 2))
+# Адмиссия: начальный/минимальный/максимальный лимит запросов процесса (выполняющихся и ждущих
+# потока; см. admission.py - без заголовка очереди в процессе не бывает больше GUNICORN_THREADS),
+# целевое время в базе и в очереди, заголовок прокси со временем приёма запроса
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+ADMISSION_INITIAL_LIMIT = int(os.environ.get('ADMISSION_INITIAL_LIMIT', 32))
+ADMISSION_MIN_LIMIT = int(os.environ.get('ADMISSION_MIN_LIMIT', 4))
+ADMISSION_MAX_LIMIT = int(os.environ.get('ADMISSION_MAX_LIMIT', 256))
+ADMISSION_TARGET_DB_MS = float(os.environ.get('ADMISSION_TARGET_DB_MS', 50))
+ADMISSION_TARGET_QUEUE_MS = float(os.environ.get('ADMISSION_TARGET_QUEUE_MS', 100))
+ADMISSION_QUEUE_HEADER = os.environ.get('ADMISSION_QUEUE_HEADER', 'X-Request-Start')
+# Где читать пользователей на горячих путях: sqlite или memory (колоночное хранилище в RAM)
+USER_STORE = os.environ.get('USER_STORE', 'sqlite')
+# Сверка балансов с журналом: интервал между проходами (0 - выключена), размер порции,
+# доля времени работы и режим исправления (off, balance, ledger)
+RECONCILE_INTERVAL_SECONDS = int(os.environ.get('RECONCILE_INTERVAL_SECONDS', 86400))
+RECONCILE_CHUNK = int(os.environ.get('RECONCILE_CHUNK', 1000))
+RECONCILE_DUTY_CYCLE = float(os.environ.get('RECONCILE_DUTY_CYCLE', 0.1))
+RECONCILE_REPAIR = os.environ.get('RECONCILE_REPAIR', 'off')
+# Архив неактивных игроков: файл базы, сколько дней без начислений считается неактивностью,
+# интервал между проходами (0 - выключен), размер порции и доля времени работы
+ARCHIVE_DATABASE_PATH = os.environ.get('ARCHIVE_DATABASE_PATH', os.path.splitext(DATABASE_PATH)[0] + '-archive.db')
+ARCHIVE_INACTIVE_DAYS = int(os.environ.get('ARCHIVE_INACTIVE_DAYS', 90))
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('ARCHIVE_INTERVAL_SECONDS', 86400))
+ARCHIVE_CHUNK = int(os.environ.get('ARCHIVE_CHUNK', 500))
+ARCHIVE_DUTY_CYCLE = float(os.environ.get('ARCHIVE_DUTY_CYCLE', 0.1))
+# Ряды активности: как часто сбрасывать счётчики в базу (0 - не собирать),
+# пауза, после которой начинается новая сессия, и сколько часов хранить минутные точки
+ACTIVITY_FLUSH_SECONDS = int(os.environ.get('ACTIVITY_FLUSH_SECONDS', 10))
+ACTIVITY_SESSION_GAP_SECONDS = int(os.environ.get('ACTIVITY_SESSION_GAP_SECONDS', 1800))
+ACTIVITY_MINUTE_RETENTION_HOURS = int(os.environ.get('ACTIVITY_MINUTE_RETENTION_HOURS', 48))
+# Правила экономики (скорость начисления, события, уровни) и как часто проверять их изменение
+ECONOMY_RULES_FILE = os.environ.get('ECONOMY_RULES_FILE', 'economy.json')
+ECONOMY_RELOAD_SECONDS = int(os.environ.get('ECONOMY_RELOAD_SECONDS', 5))
+# Достижения: файл с порогами и скорость отправки уведомлений (сообщений в секунду)
+ACHIEVEMENTS_FILE = os.environ.get('ACHIEVEMENTS_FILE', 'achievements.json')
+ACHIEVEMENT_NOTIFY_RATE = float(os.environ.get('ACHIEVEMENT_NOTIFY_RATE', 10))
+# Проверки /readyz и /healthz: сколько секунд кешировать результат, busy_timeout и порог
+# записи в базу, минимум свободного места, допустимое отставание применения журнала
+# и возраст самого старого неотправленного уведомления о достижении (секунд)
+HEALTH_CACHE_SECONDS = float(os.environ.get('HEALTH_CACHE_SECONDS', 5))
+HEALTH_DB_TIMEOUT_MS = int(os.environ.get('HEALTH_DB_TIMEOUT_MS', 1000))
+HEALTH_DB_SLOW_MS = float(os.environ.get('HEALTH_DB_SLOW_MS', 500))
+HEALTH_MIN_FREE_MB = int(os.environ.get('HEALTH_MIN_FREE_MB', 200))
+HEALTH_MAX_APPLY_BACKLOG = int(os.environ.get('HEALTH_MAX_APPLY_BACKLOG', 10000))
+HEALTH_MAX_NOTIFICATION_AGE = int(os.environ.get('HEALTH_MAX_NOTIFICATION_AGE', 600))
+# Когда загружать кеши и запускать фоновые потоки: import (сразу) или post_fork
+# (gunicorn с preload_app вызывает start_process() в каждом воркере, см. gunicorn.conf.py)
+BACKGROUND_START = os.environ.get('BACKGROUND_START', 'import')
+# Режим расчёта места: auto (точно для маленьких таблиц), exact или approx
+RANK_MODE = os.environ.get('RANK_MODE', 'auto')
+RANK_EXACT_MAX_USERS = int(os.environ.get('RANK_EXACT_MAX_USERS', 10000))
 
 app.config['SECRET_KEY'] = SECRET_KEY
 
+API_VERSION = "1.0.0"
+
+# Классы маршрутов для адмиссии; не перечисленные (health, admin) не ограничиваются
+ROUTE_CLASSES = {
+    '/add_points': 'critical',
+    '/webhook': 'critical',
+    '/register': 'write',
+    '/v1/sync': 'write',
+    '/user/<int:telegram_id>': 'read',
+    '/points/<int:telegram_id>': 'read',
+    '/rank/<int:telegram_id>': 'read',
+    '/friends/<int:telegram_id>/leaderboard': 'read',
+    '/stats/activity': 'read',
+    '/economy/rate/<int:telegram_id>': 'read',
+    '/achievements/<int:telegram_id>': 'read',
+    '/game': 'read',
+    '/leaderboard': 'poll',
+    '/': 'poll',
+}
+
+admission = AdmissionController(
+    initial_limit=ADMISSION_INITIAL_LIMIT,
+    min_limit=ADMISSION_MIN_LIMIT,
+    max_limit=ADMISSION_MAX_LIMIT,
+    target_db_ms=ADMISSION_TARGET_DB_MS,
+    target_queue_ms=ADMISSION_TARGET_QUEUE_MS
+)
+
+def request_queue_ms():
+    """Сколько запрос ждал потока воркера, по времени приёма от прокси; None - заголовка нет.
+    Форматы: t=1700000000.123 (nginx $msec), t=1700000000123456 (мкс), 1700000000123 (мс)"""
+    value = request.headers.get(ADMISSION_QUEUE_HEADER, '')
+    if not value:
+        return None
+    try:
+        started = float(value.strip().removeprefix('t='))
+    except ValueError:
+        return None
+    # Единицы - по порядку величины
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    queue_ms = (time.time() - started) * 1000
+    # Часы прокси и воркера расходятся - отрицательное и явно абсурдное не учитываем
+    if queue_ms > 60000:
+        return None
+    return max(0.0, queue_ms)
+
+def get_db_connection():
+    """Открыть соединение с базой, запросы которого попадают в трассу"""
+    return sqlite3.connect(DATABASE_PATH, factory=TracedConnection)
+
+@app.before_request
+def start_request_trace():
+    """Открыть корневой спан запроса"""
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    route = request.url_rule.rule if request.url_rule else request.path
+    g.trace_token = tracer.start_trace(f"{request.method} {route}", g.request_id, {
+        "http.method": request.method,
+        "http.route": route
+    })
+    
+    route_class = ROUTE_CLASSES.get(route) if ADMISSION_ENABLED else None
+    if route_class:
+        if not admission.try_acquire(route_class, request_queue_ms()):
+            response = jsonify({"error": "Server overloaded, retry later"})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(admission.retry_after(route_class))
+            return response
+        g.admission_class = route_class
+        g.admission_started = time.perf_counter()
+
+@app.after_request
+def tag_request_id(response):
+    """Вернуть клиенту идентификатор запроса"""
+    g.status_code = response.status_code
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.teardown_request
+def finish_request_trace(error=None):
+    """Закрыть корневой спан и отдать трассу на экспорт"""
+    route_class = g.pop('admission_class', None)
+    if route_class:
+        admission.release(route_class, tracer.db_time_ms(),
+                          (time.perf_counter() - g.pop('admission_started')) * 1000)
+    token = g.pop('trace_token', None)
+    if token is not None:
+        tracer.finish_trace(token, {"http.status_code": g.get('status_code', 500)})
+
 # Инициализация базы данных
 def init_db():
     try:
-        conn = sqlite3.connect('veln_game.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         
+        # WAL: читатели (включая снапшоты) не блокируют писателей
+        cursor.execute('PRAGMA journal_mode=WAL')
+        
         # Создание таблицы пользователей
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
@@ -56,59 +283,543 @@ def init_db():
             )
         ''')
         
+        # Индекс по очкам для лидерборда и точного подсчёта места
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_points ON users (points)')
+        
+        # Состояние синхронизации клиентов: последний применённый seq
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sync_state (
+                telegram_id INTEGER NOT NULL,
+                client_id TEXT NOT NULL,
+                last_seq INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (telegram_id, client_id)
+            )
+        ''')
+        
+        # Сезонные таблицы лидеров
+        seasons.init_tables(cursor)
+        
+        # Очередь рассылок
+        broadcast.init_tables(cursor)
+        reconcile.init_tables(cursor)
+        archive.init_tables(cursor)
+        friends.init_tables(cursor)
+        activity.init_tables(cursor)
+        economy.init_tables(cursor)
+        health.init_tables(cursor)
+        achievements.init_tables(cursor)
+        backup.init_tables(cursor)
+        
+        # Последнее применённое событие каждого потока журнала
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS eventlog_checkpoints (
+                stream TEXT PRIMARY KEY,
+                applied_seq INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # События журнала, которые некуда применить (игрока нет ни в базе, ни в архиве)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS eventlog_rejected (
+                stream TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                event TEXT NOT NULL,
+                reason TEXT NOT NULL,
+                rejected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (stream, seq)
+            )
+        ''')
+        
         conn.commit()
         conn.close()
         logger.info("Database initialized successfully")
         return True
     except Exception as e:
-        logger.error(f"Database initialization error: {e}")
+        logger.error("Database initialization error: %s", e)
         return False
 
 # Инициализация при запуске
 init_db()
 
+rank_estimator = RankEstimator(
+    lambda: get_db_connection(),
+    mode=RANK_MODE,
+    exact_max_users=RANK_EXACT_MAX_USERS
+)
+# Хранилище в памяти загружает start_process(), до этого чтения идут в базу
+user_store = None
+
+season_boards = seasons.SeasonBoards()
+friend_graph = friends.FriendGraph()
+economy_engine = economy.EconomyEngine(ECONOMY_RULES_FILE, reload_interval=ECONOMY_RELOAD_SECONDS)
+achievement_engine = achievements.AchievementEngine(achievements.load_definitions(ACHIEVEMENTS_FILE))
+
+snapshotter = Snapshotter(
+    DATABASE_PATH,
+    backup_dir=BACKUP_DIR,
+    interval=BACKUP_INTERVAL_SECONDS,
+    keep=BACKUP_KEEP,
+    connect=get_db_connection,
+    archive_path=ARCHIVE_DATABASE_PATH
+)
+
+broadcast_engine = broadcast.BroadcastEngine(
+    get_db_connection,
+    BOT_TOKEN,
+    api_url=TELEGRAM_API_URL,
+    rate=BROADCAST_RATE,
+    connections=BROADCAST_CONNECTIONS
+)
+
+achievement_notifier = achievements.AchievementNotifier(
+    get_db_connection,
+    BOT_TOKEN,
+    lambda telegram_id, achievement_id, balance: render_achievement(achievement_id, balance),
+    api_url=TELEGRAM_API_URL,
+    rate=ACHIEVEMENT_NOTIFY_RATE
+)
+
+reconciler = reconcile.Reconciler(
+    get_db_connection,
+    chunk_size=RECONCILE_CHUNK,
+    duty_cycle=RECONCILE_DUTY_CYCLE,
+    pass_interval=RECONCILE_INTERVAL_SECONDS,
+    repair=RECONCILE_REPAIR,
+    on_repaired=lambda telegram_id, old, new: on_points_changed(telegram_id, old, new)
+)
+
+archiver = archive.Archiver(
+    get_db_connection,
+    ARCHIVE_DATABASE_PATH,
+    inactive_days=ARCHIVE_INACTIVE_DAYS,
+    chunk_size=ARCHIVE_CHUNK,
+    duty_cycle=ARCHIVE_DUTY_CYCLE,
+    pass_interval=ARCHIVE_INTERVAL_SECONDS,
+    on_archived=lambda users: on_users_archived(users)
+)
+
+activity_store = activity.ActivityStore(
+    get_db_connection,
+    flush_interval=ACTIVITY_FLUSH_SECONDS,
+    session_gap=ACTIVITY_SESSION_GAP_SECONDS,
+    minute_retention=ACTIVITY_MINUTE_RETENTION_HOURS * 3600
+)
+
+class UnknownUserError(Exception):
+    """Событие журнала ссылается на игрока, которого нет в базе"""
+
+def restore_missing_users(events):
+    """Вернуть из архива игроков, на которых ссылаются события, - до транзакции применения"""
+    telegram_ids = {event['telegram_id'] for _, event in events if event['type'] != 'user'}
+    if not telegram_ids:
+        return
+    conn = get_db_connection()
+    marks = ','.join('?' * len(telegram_ids))
+    present = {row[0] for row in conn.execute(
+        f'SELECT telegram_id FROM users WHERE telegram_id IN ({marks})', tuple(telegram_ids))}
+    conn.close()
+    for telegram_id in telegram_ids - present:
+        restore_archived_user(telegram_id)
+
+def apply_logged_events(stream, events, use_checkpoint=True, strict=False):
+    """Применить пачку событий журнала вместе с checkpoint потока в одной транзакции;
+    вернуть {seq: результат} для событий синхронизации. Событие без игрока при strict
+    (пересборка) - ошибка, иначе оно откладывается в eventlog_rejected, а не теряется молча"""
+    if not strict:
+        restore_missing_users(events)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    changes, created, results = [], [], {}
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        applied_seq = 0
+        if use_checkpoint:
+            cursor.execute('SELECT applied_seq FROM eventlog_checkpoints WHERE stream = ?', (stream,))
+            row = cursor.fetchone()
+            applied_seq = row[0] if row else 0
+        
+        for seq, event in events:
+            if seq <= applied_seq:
+                continue
+            if event['type'] == 'user':
+                # Время регистрации - из события: от него считается окно первой синхронизации
+                cursor.execute('''
+                    INSERT OR IGNORE INTO users (telegram_id, username, first_name, last_name, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, COALESCE(datetime(?, 'unixepoch'), CURRENT_TIMESTAMP),
+                            COALESCE(datetime(?, 'unixepoch'), CURRENT_TIMESTAMP))
+                ''', (event['telegram_id'], event.get('username', ''),
+                      event.get('first_name', ''), event.get('last_name', ''), event.get('ts'), event.get('ts')))
+                if cursor.rowcount:
+                    created.append(event['telegram_id'])
+                continue
+            if event['type'] == 'points':
+                new_balance = apply_points_delta(
+                    cursor, event['telegram_id'], event['points'], event.get('description', 'Points added'),
+                    now=event.get('ts')
+                )
+                points_added = event['points']
+            else:
+                priced = {seq: (seconds, rate) for seq, seconds, rate in event['deltas']}
+                result = apply_sync_batch(cursor, event['telegram_id'], event['client_id'], priced,
+                                          now=event.get('ts'))
+                results[seq] = result
+                new_balance = result and result['new_balance']
+                points_added = result and result['points_added']
+            if new_balance is None:
+                if strict:
+                    raise UnknownUserError(f"event {stream}:{seq} refers to unknown user {event['telegram_id']}")
+                cursor.execute('''
+                    INSERT OR IGNORE INTO eventlog_rejected (stream, seq, event, reason) VALUES (?, ?, ?, ?)
+                ''', (stream, seq, json.dumps(event, ensure_ascii=False), 'user not found'))
+                logger.error("Event %s:%s rejected: user %s not found", stream, seq, event['telegram_id'])
+            elif points_added > 0:
+                changes.append((event['telegram_id'], new_balance - points_added, new_balance))
+        
+        if use_checkpoint and events and events[-1][0] > applied_seq:
+            cursor.execute('''
+                INSERT INTO eventlog_checkpoints (stream, applied_seq) VALUES (?, ?)
+                ON CONFLICT(stream) DO UPDATE SET applied_seq = excluded.applied_seq, updated_at = CURRENT_TIMESTAMP
+            ''', (stream, events[-1][0]))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    for telegram_id in created:
+        on_user_created(telegram_id)
+    for telegram_id, old_balance, new_balance in changes:
+        on_points_changed(telegram_id, old_balance, new_balance)
+    return results
+
+def reject_logged_event(stream, seq, event, reason):
+    """Отложить событие, которое не применяется, в eventlog_rejected и сдвинуть checkpoint потока за него"""
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('''
+            INSERT OR IGNORE INTO eventlog_rejected (stream, seq, event, reason) VALUES (?, ?, ?, ?)
+        ''', (stream, seq, json.dumps(event, ensure_ascii=False, default=str), reason[:500]))
+        conn.execute('''
+            INSERT INTO eventlog_checkpoints (stream, applied_seq) VALUES (?, ?)
+            ON CONFLICT(stream) DO UPDATE SET applied_seq = MAX(applied_seq, excluded.applied_seq),
+                updated_at = CURRENT_TIMESTAMP
+        ''', (stream, seq))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def log_user_event(telegram_id, username='', first_name='', last_name=''):
+    """Записать регистрацию в журнал, чтобы из него можно было пересобрать базу"""
+    if event_log:
+        event_log.append({
+            "type": "user", "telegram_id": telegram_id, "username": username,
+            "first_name": first_name, "last_name": last_name, "ts": time.time()
+        })
+
+def require_admin(view):
+    """Пропускать только запросы с верным X-Admin-Token"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        token = request.headers.get('X-Admin-Token', '')
+        if not ADMIN_TOKEN or not hmac.compare_digest(token, ADMIN_TOKEN):
+            return jsonify({"error": "Forbidden"}), 403
+        return view(*args, **kwargs)
+    return wrapped
+
+# Значения из репозитория публичны - JWT с ними подделает кто угодно
+PUBLIC_SECRETS = ('veln-super-secret-key-2024', 'veln-super-secret-key-2024-render')
+if SESSION_SECRET in PUBLIC_SECRETS:
+    logger.error("SESSION_SECRET is a value published in the repository, session tokens are disabled")
+    SESSION_SECRET = ''
+if AUTH_REQUIRED and not SESSION_SECRET:
+    raise RuntimeError("AUTH_REQUIRED=1 needs SESSION_SECRET: without it no request could authenticate")
+session_tokens = SessionTokens(SESSION_SECRET, ttl=AUTH_TOKEN_TTL)
+init_data_validator = None
+if BOT_TOKEN and BOT_TOKEN != 'your_bot_token_here':
+    init_data_validator = InitDataValidator(BOT_TOKEN, max_age=AUTH_INIT_DATA_MAX_AGE)
+
+def require_session(view):
+    """Сверить Bearer-токен сессии с telegram_id из пути или тела запроса"""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        header = request.headers.get('Authorization', '')
+        if not header.startswith('Bearer '):
+            # Без AUTH_REQUIRED старые клиенты без токена продолжают работать; по логу видно,
+            # сколько их осталось, прежде чем включать AUTH_REQUIRED=1
+            if AUTH_REQUIRED:
+                return jsonify({"error": "Authentication required"}), 401
+            logger.info("Request without session token: %s", request.path, extra={"sample": "no_session"})
+            return view(*args, **kwargs)
+        session_id = session_tokens.verify(header[len('Bearer '):])
+        if session_id is None:
+            return jsonify({"error": "Invalid or expired session"}), 401
+        telegram_id = kwargs.get('telegram_id')
+        if telegram_id is None:
+            telegram_id = (request.get_json(silent=True) or {}).get('telegram_id')
+        if str(telegram_id) != str(session_id):
+            return jsonify({"error": "Forbidden"}), 403
+        g.session_telegram_id = session_id
+        return view(*args, **kwargs)
+    return wrapped
+
+data_versions = DataVersions()
+
+def refresh_stored_user(telegram_id):
+    """Перечитать пользователя из базы в хранилище в памяти"""
+    conn = get_db_connection()
+    try:
+        user_store.refresh(conn, telegram_id)
+    finally:
+        conn.close()
+
+def on_user_created(telegram_id, remote=False):
+    """Обновить производные структуры после регистрации пользователя"""
+    rank_estimator.add(0)
+    data_versions.bump(telegram_id)
+    if user_store is not None:
+        refresh_stored_user(telegram_id)
+    if cluster_bus and not remote:
+        cluster_bus.publish({"type": "user", "telegram_id": telegram_id})
+
+def on_points_changed(telegram_id, old_balance, new_balance, remote=False):
+    """Обновить производные структуры после изменения баланса"""
+    rank_estimator.move(old_balance, new_balance)
+    data_versions.bump(telegram_id)
+    friend_graph.on_points_changed(telegram_id, new_balance)
+    if user_store is not None and not user_store.set_points(telegram_id, new_balance):
+        refresh_stored_user(telegram_id)
+    if not remote and achievement_engine.crossed(old_balance, new_balance):
+        achievement_notifier.wake()
+    if cluster_bus and not remote:
+        cluster_bus.publish({"type": "points", "telegram_id": telegram_id,
+                             "old": old_balance, "new": new_balance})
+
+def on_friends_linked(a, b, remote=False):
+    """Сбросить доски друзей обоих игроков после новой дружбы"""
+    friend_graph.invalidate(a, b)
+    if cluster_bus and not remote:
+        cluster_bus.publish({"type": "friends", "telegram_ids": [a, b]})
+
+def on_economy_changed(telegram_id, remote=False):
+    """Перечитать бусты и уровень игрока после выдачи"""
+    conn = get_db_connection()
+    try:
+        economy_engine.refresh_user(conn, telegram_id)
+    finally:
+        conn.close()
+    if cluster_bus and not remote:
+        cluster_bus.publish({"type": "economy", "telegram_id": telegram_id})
+
+def on_users_archived(users, remote=False):
+    """Убрать перенесённых в архив игроков из гистограммы мест и кешей"""
+    for telegram_id, points in users:
+        rank_estimator.remove(points)
+        data_versions.bump(telegram_id)
+        if user_store is not None:
+            user_store.remove(telegram_id)
+    # Доски друзей с архивными игроками собираются заново
+    friend_graph.forget(*(telegram_id for telegram_id, _ in users))
+    if cluster_bus and not remote:
+        cluster_bus.publish({"type": "archived", "users": users})
+
+def on_user_restored(telegram_id, points, remote=False):
+    """Вернуть игрока из архива в производные структуры"""
+    rank_estimator.add(points)
+    data_versions.bump(telegram_id)
+    # Доски его друзей собраны, пока его не было в users
+    conn = get_db_connection()
+    try:
+        friend_ids = friend_graph.friend_ids(conn, telegram_id)
+    finally:
+        conn.close()
+    friend_graph.invalidate(telegram_id, *friend_ids)
+    if user_store is not None:
+        refresh_stored_user(telegram_id)
+    if cluster_bus and not remote:
+        cluster_bus.publish({"type": "restored", "telegram_id": telegram_id, "points": points})
+
+def restore_archived_user(telegram_id):
+    """Вернуть игрока из архива, если он там; True - вернулся. Ошибка возврата уходит вызывающему:
+    заводить нового игрока с нулём поверх архивного баланса нельзя"""
+    result = archiver.restore(telegram_id)
+    if result is None:
+        return False
+    old_balance, points = result
+    if old_balance is None:
+        on_user_restored(telegram_id, points)
+    elif old_balance != points:
+        on_points_changed(telegram_id, old_balance, points)
+    return True
+
+def on_log_settings_changed(levels, sample_rates, remote=False):
+    """Применить уровни логгеров и доли сэмплирования во всех процессах"""
+    log_pipeline.set_levels(levels)
+    if sample_rates:
+        log_pipeline.sampler.set_rates(dict(log_pipeline.sampler.rates, **sample_rates))
+    if cluster_bus and not remote:
+        cluster_bus.publish({"type": "logging", "levels": levels, "sample_rates": sample_rates})
+
+def on_cluster_message(message):
+    """Применить изменение, сделанное другим инстансом"""
+    if message['type'] == 'user':
+        on_user_created(message['telegram_id'], remote=True)
+    elif message['type'] == 'points':
+        on_points_changed(message['telegram_id'], message['old'], message['new'], remote=True)
+    elif message['type'] == 'friends':
+        on_friends_linked(*message['telegram_ids'], remote=True)
+    elif message['type'] == 'economy':
+        on_economy_changed(message['telegram_id'], remote=True)
+    elif message['type'] == 'logging':
+        on_log_settings_changed(message['levels'], message['sample_rates'], remote=True)
+    elif message['type'] == 'archived':
+        on_users_archived([tuple(user) for user in message['users']], remote=True)
+    elif message['type'] == 'restored':
+        on_user_restored(message['telegram_id'], message['points'], remote=True)
+
+def on_cluster_resync():
+    """После обрыва шины пропущенные сообщения не восстановить - перечитываем всё"""
+    data_versions.invalidate_all()
+    friend_graph.clear()
+    try:
+        rank_estimator.load()
+    except Exception as e:
+        logger.error("Rank histogram reload error: %s", e)
+    # Балансы в колоночном хранилище и бусты/уровни экономики тоже могли пропустить изменения
+    if USER_STORE == 'memory':
+        load_user_store()
+    try:
+        conn = get_db_connection()
+        try:
+            economy_engine.load(conn)
+        finally:
+            conn.close()
+    except Exception as e:
+        logger.error("Economy reload error: %s", e)
+
+cluster_bus = None
+if CLUSTER_BUS_URL:
+    cluster_bus = ClusterBus(CLUSTER_BUS_URL, on_cluster_message, on_resync=on_cluster_resync)
+
+def fetch_user(telegram_id):
+    """Строка пользователя (id, telegram_id, username, first_name, last_name, points, created_at)"""
+    if user_store is not None:
+        return user_store.get(telegram_id)
+    conn = get_db_connection()
+    try:
+        return conn.execute(USER_ROW_SQL + ' WHERE telegram_id = ?', (telegram_id,)).fetchone()
+    finally:
+        conn.close()
+
+def fetch_top_users(limit):
+    """Лидеры за всё время: (telegram_id, username, first_name, points)"""
+    if user_store is not None:
+        return user_store.top(limit)
+    conn = get_db_connection()
+    try:
+        return conn.execute('''
+            SELECT telegram_id, username, first_name, points
+            FROM users 
+            WHERE points > 0 
+            ORDER BY points DESC 
+            LIMIT ?
+        ''', (limit,)).fetchall()
+    finally:
+        conn.close()
+
 @app.route('/')
+@conditional(lambda: f"home-{API_VERSION}", 'public, max-age=300')
 def home():
     """Главная страница с информацией об API"""
     return jsonify({
         "message": "VELN Game API Server",
-        "version": "1.0.0",
+        "version": API_VERSION,
         "status": "running",
         "endpoints": {
             "GET /": "API информация",
             "GET /health": "Проверка здоровья сервера",
+            "GET /livez": "Процесс жив (без обращений к базе)",
+            "GET /readyz": "Готовность принимать трафик",
+            "GET /healthz": "Подробные проверки: база, очереди, диск",
+            "POST /auth/telegram": "Проверка initData и выдача токена сессии",
             "POST /register": "Регистрация пользователя",
             "GET /user/<telegram_id>": "Получить информацию о пользователе",
             "GET /points/<telegram_id>": "Получить баланс поинтов",
             "POST /add_points": "Добавить поинты пользователю",
-            "GET /leaderboard": "Таблица лидеров"
+            "POST /v1/sync": "Пакетная синхронизация поинтов с номерами последовательности",
+            "GET /friends/<telegram_id>/leaderboard": "Таблица лидеров среди друзей",
+            "GET /stats/activity": "Ряды активности: события, очки в минуту, DAU, сессии",
+            "GET /economy/rate/<telegram_id>": "Текущая скорость начисления игрока и её составляющие",
+            "GET /achievements/<telegram_id>": "Достижения игрока и следующий порог",
+            "GET /leaderboard": "Таблица лидеров (?window=day|week|month)",
+            "GET /rank/<telegram_id>": "Место игрока и процент лучших"
         },
         "bot_configured": bool(BOT_TOKEN and BOT_TOKEN != 'your_bot_token_here'),
         "database": "SQLite"
     })
 
 @app.route('/health')
-def health():
-    """Health check для Render.com"""
+def health_check():
+    """Health check для Render.com (результаты проверок из кеша, подробности - /healthz)"""
+    report = health_monitor.current()
+    result = {
+        "status": "healthy" if report["ready"] else "unhealthy",
+        "database": "connected" if report["checks"]["database"]["ok"] else "unavailable",
+        "timestamp": datetime.now().isoformat()
+    }
+    if cluster_bus:
+        result["cluster"] = cluster_bus.stats()
+    return jsonify(result), 200 if report["ready"] else 500
+
+@app.route('/livez')
+def livez():
+    """Процесс жив и обслуживает запросы; без обращений к базе и диску"""
+    return jsonify({"status": "alive"})
+
+@app.route('/readyz')
+def readyz():
+    """Готовность принимать трафик: критичные проверки из кеша"""
+    report = health_monitor.current()
+    failed = [name for name, check in report["checks"].items() if check["critical"] and not check["ok"]]
+    result = {"status": "ready" if report["ready"] else "not ready", "checked_at": report["checked_at"]}
+    if failed:
+        result["failed"] = failed
+    return jsonify(result), 200 if report["ready"] else 503
+
+@app.route('/healthz')
+def healthz():
+    """Подробный отчёт: запись в базу, блокировки, очереди, диск"""
+    report = health_monitor.current()
+    result = dict(report, pid=os.getpid(), admission=admission.stats())
+    return jsonify(result), 200 if report["ready"] else 503
+
+@app.route('/auth/telegram', methods=['POST'])
+def auth_telegram():
+    """Проверить initData мини-приложения и выдать токен сессии"""
+    if not init_data_validator:
+        return jsonify({"error": "Bot token not configured"}), 503
+    if not session_tokens.enabled:
+        return jsonify({"error": "Session secret not configured"}), 503
+    data = request.get_json(silent=True) or {}
     try:
-        # Проверяем подключение к базе данных
-        conn = sqlite3.connect('veln_game.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT 1')
-        conn.close()
-        
-        logger.info("Connected to SQLite database")
-        return jsonify({
-            "status": "healthy",
-            "database": "connected",
-            "timestamp": datetime.now().isoformat()
-        })
-    except Exception as e:
-        logger.error(f"Health check failed: {e}")
-        return jsonify({
-            "status": "unhealthy",
-            "error": str(e)
-        }), 500
+        user = init_data_validator.validate(data.get('init_data', ''))
+    except AuthError as e:
+        logger.warning("Telegram auth rejected: %s", e)
+        return jsonify({"error": "Invalid initData"}), 401
+    
+    token, expires_in = session_tokens.issue(user['id'])
+    return jsonify({
+        "token": token,
+        "token_type": "Bearer",
+        "expires_in": expires_in,
+        "telegram_id": user['id']
+    })
 
 @app.route('/register', methods=['POST'])
 def register_user():
@@ -127,12 +838,15 @@ def register_user():
         if not telegram_id:
             return jsonify({"error": "telegram_id is required"}), 400
         
-        conn = sqlite3.connect('veln_game.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         # Проверяем, существует ли пользователь
         cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
         existing_user = cursor.fetchone()
+        if not existing_user and restore_archived_user(telegram_id):
+            cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
+            existing_user = cursor.fetchone()
         
         if existing_user:
             conn.close()
@@ -155,7 +869,9 @@ def register_user():
         user_id = cursor.lastrowid
         conn.close()
         
-        logger.info(f"New user registered: {telegram_id}")
+        log_user_event(telegram_id, username, first_name, last_name)
+        on_user_created(telegram_id)
+        logger.info("New user registered: %s", telegram_id)
         
         return jsonify({
             "message": "User registered successfully",
@@ -169,19 +885,15 @@ def register_user():
         }), 201
         
     except Exception as e:
-        logger.error(f"Registration error: {e}")
+        logger.error("Registration error: %s", e)
         return jsonify({"error": "Registration failed"}), 500
 
 @app.route('/user/<int:telegram_id>')
+@conditional(lambda telegram_id: data_versions.user_tag(telegram_id, 'user'), 'private, no-cache')
 def get_user(telegram_id):
     """Получить информацию о пользователе"""
     try:
-        conn = sqlite3.connect('veln_game.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (telegram_id,))
-        user = cursor.fetchone()
-        conn.close()
+        user = fetch_user(telegram_id)
         
         if not user:
             return jsonify({"error": "User not found"}), 404
@@ -199,33 +911,109 @@ def get_user(telegram_id):
         })
         
     except Exception as e:
-        logger.error(f"Get user error: {e}")
+        logger.error("Get user error: %s", e)
         return jsonify({"error": "Failed to get user"}), 500
 
 @app.route('/points/<int:telegram_id>')
+@require_session
+@conditional(lambda telegram_id: data_versions.user_tag(telegram_id, 'points'), 'private, no-cache',
+             vary=('Accept-Encoding', 'Authorization'))
 def get_points(telegram_id):
     """Получить баланс поинтов пользователя"""
     try:
-        conn = sqlite3.connect('veln_game.db')
-        cursor = conn.cursor()
+        if user_store is not None:
+            points = user_store.get_points(telegram_id)
+        else:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT points FROM users WHERE telegram_id = ?', (telegram_id,))
+            result = cursor.fetchone()
+            conn.close()
+            points = result[0] if result else None
         
-        cursor.execute('SELECT points FROM users WHERE telegram_id = ?', (telegram_id,))
-        result = cursor.fetchone()
-        conn.close()
+        if points is None and restore_archived_user(telegram_id):
+            conn = get_db_connection()
+            result = conn.execute('SELECT points FROM users WHERE telegram_id = ?', (telegram_id,)).fetchone()
+            conn.close()
+            points = result[0] if result else None
         
-        if not result:
+        if points is None:
             return jsonify({"error": "User not found"}), 404
         
         return jsonify({
             "telegram_id": telegram_id,
-            "points": result[0]
+            "points": points
         })
         
     except Exception as e:
-        logger.error(f"Get points error: {e}")
+        logger.error("Get points error: %s", e)
         return jsonify({"error": "Failed to get points"}), 500
 
+def add_points_via_log(telegram_id, points, description):
+    """Подтвердить начисление после fsync в журнал; в базу его перенесёт фоновый поток"""
+    # Чтение в WAL не ждёт писателя, так что проверка не упирается в блокировку базы
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('SELECT points FROM users WHERE telegram_id = ?', (telegram_id,))
+    user = cursor.fetchone()
+    conn.close()
+    
+    if not user:
+        return jsonify({"error": "User not found"}), 404
+    
+    seq = event_log.append({
+        "type": "points",
+        "telegram_id": telegram_id,
+        "points": points,
+        "description": description,
+        "ts": time.time()
+    })
+    
+    activity_store.record(telegram_id, points)
+    logger.info("Logged %s points for user %s (event %s)", points, telegram_id, seq,
+                extra={"sample": "add_points"})
+    
+    # Баланса в ответе нет: событие применится позже, и прочитанное выше значение к тому времени устареет
+    return jsonify({
+        "message": "Points accepted",
+        "telegram_id": telegram_id,
+        "points_added": points,
+        "event_seq": seq
+    }), 202
+
+def apply_points_delta(cursor, telegram_id, points, description, transaction_type='add', rate=None, now=None):
+    """Начислить поинты в текущей транзакции и вернуть новый баланс (None, если пользователя нет);
+    now - время начисления (секунды эпохи) для событий журнала, по умолчанию текущее"""
+    # Обновляем баланс пользователя
+    cursor.execute('''
+        UPDATE users 
+        SET points = points + ?, updated_at = CURRENT_TIMESTAMP 
+        WHERE telegram_id = ?
+    ''', (points, telegram_id))
+    
+    if cursor.rowcount == 0:
+        return None
+    
+    # Записываем транзакцию (rate - скорость экономики, если очки начислены за время игры)
+    cursor.execute('''
+        INSERT INTO transactions (user_id, points, transaction_type, description, rate)
+        SELECT id, ?, ?, ?, ? FROM users WHERE telegram_id = ?
+    ''', (points, transaction_type, description, rate, telegram_id))
+    
+    # Учитываем очки в сезонных лидербордах
+    season_boards.record_points(cursor, telegram_id, points,
+                                now and datetime.fromtimestamp(now, timezone.utc))
+    
+    # Получаем новый баланс
+    cursor.execute('SELECT points FROM users WHERE telegram_id = ?', (telegram_id,))
+    new_balance = cursor.fetchone()[0]
+    # Достижения за пройденные пороги - в той же транзакции, что и баланс
+    achievement_engine.evaluate(cursor, telegram_id, new_balance - points, new_balance, now)
+    return new_balance
+
 @app.route('/add_points', methods=['POST'])
+@require_session
 def add_points():
     """Добавить поинты пользователю"""
     try:
@@ -244,34 +1032,24 @@ def add_points():
         if not isinstance(points, int) or points <= 0:
             return jsonify({"error": "Points must be a positive integer"}), 400
         
-        conn = sqlite3.connect('veln_game.db')
+        if event_log:
+            return add_points_via_log(telegram_id, points, description)
+        
+        conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Обновляем баланс пользователя
-        cursor.execute('''
-            UPDATE users 
-            SET points = points + ?, updated_at = CURRENT_TIMESTAMP 
-            WHERE telegram_id = ?
-        ''', (points, telegram_id))
+        new_balance = apply_points_delta(cursor, telegram_id, points, description)
         
-        if cursor.rowcount == 0:
+        if new_balance is None:
             conn.close()
             return jsonify({"error": "User not found"}), 404
         
-        # Записываем транзакцию
-        cursor.execute('''
-            INSERT INTO transactions (user_id, points, transaction_type, description)
-            SELECT id, ?, 'add', ? FROM users WHERE telegram_id = ?
-        ''', (points, description, telegram_id))
-        
-        # Получаем новый баланс
-        cursor.execute('SELECT points FROM users WHERE telegram_id = ?', (telegram_id,))
-        new_balance = cursor.fetchone()[0]
-        
         conn.commit()
         conn.close()
         
-        logger.info(f"Added {points} points to user {telegram_id}")
+        on_points_changed(telegram_id, new_balance - points, new_balance)
+        activity_store.record(telegram_id, points)
+        logger.info("Added %s points to user %s", points, telegram_id, extra={"sample": "add_points"})
         
         return jsonify({
             "message": "Points added successfully",
@@ -281,30 +1059,315 @@ def add_points():
         })
         
     except Exception as e:
-        logger.error(f"Add points error: {e}")
+        logger.error("Add points error: %s", e)
         return jsonify({"error": "Failed to add points"}), 500
 
-@app.route('/leaderboard')
-def leaderboard():
-    """Получить таблицу лидеров"""
+# Протокол синхронизации: клиент копит дельты с возрастающими seq и
+# повторяет отправку до подтверждения, сервер применяет только seq > last_seq.
+# points в дельте - секунды игры, в очки их переводит скорость economy_engine
+# на момент игры (необязательный ts дельты - время клиента в секундах эпохи).
+# Секунд нельзя начислить больше, чем прошло с прошлой синхронизации клиента
+SYNC_PROTOCOL_VERSION = 1
+SYNC_MAX_BATCH = 500
+# Запас на округление updated_at до секунды и задержку сети
+SYNC_CLOCK_SLACK_SECONDS = 5
+
+def read_sync_state(cursor, telegram_id, client_id):
+    """(баланс, last_seq клиента, начало окна синхронизации в секундах эпохи) или None, если игрока нет.
+    Окно начинается с прошлой синхронизации этого клиента, а для нового клиента - с регистрации"""
+    row = cursor.execute('''
+        SELECT u.points, COALESCE(s.last_seq, 0),
+               CAST(strftime('%s', COALESCE(s.updated_at, u.created_at)) AS INTEGER)
+        FROM users u LEFT JOIN sync_state s ON s.telegram_id = u.telegram_id AND s.client_id = ?
+        WHERE u.telegram_id = ?
+    ''', (client_id, telegram_id)).fetchone()
+    if row is None:
+        return None
+    return row[0], row[1], row[2] or 0
+
+def apply_sync_batch(cursor, telegram_id, client_id, priced, now=None):
+    """Применить оценённые дельты {seq: (секунды, скорость)} в транзакции, уже заблокировавшей
+    запись: отбросить seq <= last_seq клиента, урезать секунды до прошедшего с прошлой
+    синхронизации времени, начислить очки, сдвинуть last_seq. None - игрока нет"""
+    now = now or time.time()
+    state = read_sync_state(cursor, telegram_id, client_id)
+    if state is None:
+        return None
+    balance, last_seq, window_start = state
+    
+    fresh = sorted(seq for seq in priced if seq > last_seq)
+    allowed = max(0, now - window_start) + SYNC_CLOCK_SLACK_SECONDS
+    credited, seconds, clamped = [], 0, 0
+    for seq in fresh:
+        delta_seconds, rate = priced[seq]
+        granted = min(delta_seconds, max(0, int(allowed - seconds)))
+        clamped += delta_seconds - granted
+        seconds += granted
+        credited.append((granted, rate))
+    points_to_add = economy_engine.credit_priced(credited)
+    # Средняя по секундам скорость пакета - для журнала транзакций и ответа
+    rate = round(sum(s * r for s, r in credited) / seconds, 4) if seconds else None
+    new_balance = balance
+    
+    if fresh:
+        acked_seq = fresh[-1]
+        if points_to_add > 0:
+            new_balance = apply_points_delta(
+                cursor, telegram_id, points_to_add,
+                f"Sync seq {fresh[0]}-{acked_seq} ({client_id}): {seconds}s x{rate:g}", 'sync', rate, now
+            )
+        cursor.execute('''
+            INSERT INTO sync_state (telegram_id, client_id, last_seq, updated_at)
+            VALUES (?, ?, ?, datetime(?, 'unixepoch'))
+            ON CONFLICT(telegram_id, client_id)
+            DO UPDATE SET last_seq = excluded.last_seq, updated_at = excluded.updated_at
+        ''', (telegram_id, client_id, acked_seq, now))
+        if clamped:
+            logger.warning("Sync for user %s (%s) clamped by %ss: more play time than elapsed since last sync",
+                           telegram_id, client_id, clamped)
+    else:
+        acked_seq = last_seq
+    
+    return {
+        "acked_seq": acked_seq,
+        "applied": len(fresh),
+        "duplicates": len(priced) - len(fresh),
+        "seconds": seconds,
+        "clamped_seconds": clamped,
+        "rate": rate,
+        "points_added": points_to_add,
+        "new_balance": new_balance
+    }
+
+def price_sync_deltas(cursor, telegram_id, client_id, batch, now):
+    """Оценить дельты {seq: (секунды, ts)} по скорости на момент игры; None - игрока нет"""
+    state = read_sync_state(cursor, telegram_id, client_id)
+    if state is None:
+        return None
+    deltas = [(seq, seconds, played_at) for seq, (seconds, played_at) in sorted(batch.items())]
+    return economy_engine.price(telegram_id, deltas, state[2], now)
+
+def sync_response(telegram_id, result, **extra):
+    if result['applied']:
+        activity_store.record(telegram_id, result['points_added'])
+        logger.info("Synced %s points (%s deltas) for user %s", result['points_added'], result['applied'],
+                    telegram_id, extra={"sample": "sync"})
+    if result['rate'] is None:
+        # Начислять было нечего - показываем текущую скорость
+        result = dict(result, rate=economy_engine.rate(telegram_id))
+    return jsonify({"protocol": SYNC_PROTOCOL_VERSION, "telegram_id": telegram_id, **result, **extra})
+
+def sync_via_log(telegram_id, client_id, batch):
+    """Синхронизация через журнал: пакет и сдвиг last_seq - одно событие, ответ после его применения.
+    Скорости считаются здесь и пишутся в событие, чтобы пересборка начислила то же самое"""
+    now = time.time()
+    conn = get_db_connection()
     try:
-        limit = request.args.get('limit', 10, type=int)
-        limit = min(limit, 100)  # Максимум 100 записей
+        priced = price_sync_deltas(conn.cursor(), telegram_id, client_id, batch, now)
+    finally:
+        conn.close()
+    if priced is None:
+        return jsonify({"error": "User not found"}), 404
+    
+    seq, result = event_log.append_applied({
+        "type": "sync",
+        "telegram_id": telegram_id,
+        "client_id": client_id,
+        "deltas": [[seq, seconds, rate] for seq, (seconds, rate) in sorted(priced.items())],
+        "ts": now
+    })
+    if result is None:
+        return jsonify({"error": "User not found"}), 404
+    return sync_response(telegram_id, result, event_seq=seq)
+
+@app.route('/v1/sync', methods=['POST'])
+@require_session
+def sync_points():
+    """Пакетная синхронизация поинтов с дедупликацией повторов"""
+    try:
+        data = request.get_json()
+        
+        if not data:
+            return jsonify({"error": "No data provided"}), 400
+        
+        telegram_id = data.get('telegram_id')
+        client_id = data.get('client_id')
+        deltas = data.get('deltas', [])
+        
+        if data.get('protocol', SYNC_PROTOCOL_VERSION) != SYNC_PROTOCOL_VERSION:
+            return jsonify({
+                "error": "Unsupported sync protocol",
+                "protocol": SYNC_PROTOCOL_VERSION
+            }), 400
+        
+        if not telegram_id:
+            return jsonify({"error": "telegram_id is required"}), 400
+        
+        if not isinstance(client_id, str) or not client_id or len(client_id) > 64:
+            return jsonify({"error": "client_id must be a non-empty string"}), 400
+        
+        if not isinstance(deltas, list) or len(deltas) > SYNC_MAX_BATCH:
+            return jsonify({"error": f"deltas must be a list of at most {SYNC_MAX_BATCH} items"}), 400
+        
+        batch = {}
+        for delta in deltas:
+            seq = delta.get('seq') if isinstance(delta, dict) else None
+            points = delta.get('points') if isinstance(delta, dict) else None
+            if not isinstance(seq, int) or seq <= 0 or not isinstance(points, int) or points < 0:
+                return jsonify({"error": "Each delta needs a positive integer seq and non-negative integer points"}), 400
+            played_at = delta.get('ts')
+            if played_at is not None and (isinstance(played_at, bool) or not isinstance(played_at, (int, float))):
+                return jsonify({"error": "Delta ts must be a unix timestamp in seconds"}), 400
+            batch[seq] = (points, played_at)
         
-        conn = sqlite3.connect('veln_game.db')
+        if event_log:
+            return sync_via_log(telegram_id, client_id, batch)
+        
+        conn = get_db_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT telegram_id, username, first_name, points
-            FROM users 
-            WHERE points > 0 
-            ORDER BY points DESC 
-            LIMIT ?
-        ''', (limit,))
+        # Блокируем запись сразу, чтобы параллельные повторы не прочитали один и тот же last_seq
+        cursor.execute('BEGIN IMMEDIATE')
+        now = time.time()
+        priced = price_sync_deltas(cursor, telegram_id, client_id, batch, now)
+        result = None if priced is None else apply_sync_batch(cursor, telegram_id, client_id, priced, now)
         
-        results = cursor.fetchall()
+        if result is None:
+            conn.rollback()
+            conn.close()
+            return jsonify({"error": "User not found"}), 404
+        
+        conn.commit()
         conn.close()
         
+        points_to_add = result['points_added']
+        if points_to_add > 0:
+            on_points_changed(telegram_id, result['new_balance'] - points_to_add, result['new_balance'])
+        return sync_response(telegram_id, result)
+        
+    except Exception as e:
+        logger.error("Sync error: %s", e)
+        return jsonify({"error": "Failed to sync points"}), 500
+
+@app.route('/rank/<int:telegram_id>')
+def get_rank(telegram_id):
+    """Получить место игрока и процент лучших"""
+    try:
+        user = fetch_user(telegram_id)
+        
+        if not user:
+            return jsonify({"error": "User not found"}), 404
+        
+        return jsonify({
+            "telegram_id": telegram_id,
+            "points": user[5],
+            **rank_estimator.estimate(user[5])
+        })
+        
+    except Exception as e:
+        logger.error("Get rank error: %s", e)
+        return jsonify({"error": "Failed to get rank"}), 500
+
+@app.route('/friends/<int:telegram_id>/leaderboard')
+@require_session
+def friends_leaderboard(telegram_id):
+    """Таблица лидеров среди друзей игрока (включая его самого)"""
+    try:
+        limit = max(1, min(request.args.get('limit', 50, type=int), friends.MAX_FRIENDS + 1))
+        board = friend_graph.board(get_db_connection, telegram_id, limit)
+        if board is None:
+            return jsonify({"error": "User not found"}), 404
+        
+        return jsonify({
+            "telegram_id": telegram_id,
+            "leaderboard": [{
+                "rank": i,
+                "telegram_id": row[0],
+                "username": row[1],
+                "first_name": row[2],
+                "points": row[3],
+                "is_self": row[0] == telegram_id
+            } for i, row in enumerate(board, 1)]
+        })
+        
+    except Exception as e:
+        logger.error("Friends leaderboard error: %s", e)
+        return jsonify({"error": "Failed to get friends leaderboard"}), 500
+
+@app.route('/economy/rate/<int:telegram_id>')
+@require_session
+def economy_rate(telegram_id):
+    """Текущая скорость начисления игрока: база, уровень, события, бусты"""
+    try:
+        return jsonify({"telegram_id": telegram_id, **economy_engine.explain(telegram_id)})
+    except Exception as e:
+        logger.error("Economy rate error: %s", e)
+        return jsonify({"error": "Failed to get rate"}), 500
+
+@app.route('/achievements/<int:telegram_id>')
+@require_session
+def get_achievements(telegram_id):
+    """Достижения игрока: полученные, оставшиеся и сколько до следующего"""
+    try:
+        conn = get_db_connection()
+        try:
+            row = conn.execute('SELECT points FROM users WHERE telegram_id = ?', (telegram_id,)).fetchone()
+            if not row:
+                return jsonify({"error": "User not found"}), 404
+            result = achievement_engine.describe(conn, telegram_id, row[0])
+        finally:
+            conn.close()
+        return jsonify({"telegram_id": telegram_id, "points": row[0], **result})
+    except Exception as e:
+        logger.error("Achievements error: %s", e)
+        return jsonify({"error": "Failed to get achievements"}), 500
+
+@app.route('/stats/activity')
+def stats_activity():
+    """Ряд активности за период: ?resolution=minute|hour|day&from=<unix>&to=<unix>"""
+    resolution = request.args.get('resolution', 'hour')
+    if resolution not in activity.RESOLUTIONS:
+        return jsonify({"error": "resolution must be one of: " + ", ".join(activity.RESOLUTIONS)}), 400
+    
+    try:
+        return jsonify(activity_store.series(
+            resolution,
+            start=request.args.get('from', type=int),
+            end=request.args.get('to', type=int)
+        ))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error("Activity stats error: %s", e)
+        return jsonify({"error": "Failed to get activity stats"}), 500
+
+def leaderboard_etag():
+    """ETag лидерборда: версия данных, параметры и текущий период сезона"""
+    window = request.args.get('window', 'all')
+    period = request.args.get('period') or (seasons.period_key(window) if window in seasons.WINDOWS else '')
+    return data_versions.global_tag('lb', window, period, request.args.get('limit', 10, type=int))
+
+@app.route('/leaderboard')
+@conditional(leaderboard_etag, f'public, max-age={LEADERBOARD_MAX_AGE}, stale-while-revalidate=30')
+def leaderboard():
+    """Получить таблицу лидеров за всё время или за сезон"""
+    try:
+        limit = request.args.get('limit', 10, type=int)
+        limit = max(1, min(limit, 100))  # От 1 до 100 записей: отрицательный LIMIT в SQL - без ограничения
+        window = request.args.get('window', 'all')
+        period = request.args.get('period')
+        
+        if window != 'all' and window not in seasons.WINDOWS:
+            return jsonify({"error": "window must be one of: all, " + ", ".join(seasons.WINDOWS)}), 400
+        
+        if window == 'all':
+            results = fetch_top_users(limit)
+        else:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            period, results = season_boards.top(cursor, window, limit, period)
+            conn.close()
+        
         leaderboard_data = []
         for i, row in enumerate(results, 1):
             leaderboard_data.append({
@@ -315,15 +1378,230 @@ def leaderboard():
                 "points": row[3]
             })
         
-        return jsonify({
+        response = {
             "leaderboard": leaderboard_data,
-            "total_players": len(leaderboard_data)
-        })
+            "total_players": len(leaderboard_data),
+            "window": window
+        }
+        if window != 'all':
+            response["period"] = period
+        
+        return jsonify(response)
         
     except Exception as e:
-        logger.error(f"Leaderboard error: {e}")
+        logger.error("Leaderboard error: %s", e)
         return jsonify({"error": "Failed to get leaderboard"}), 500
 
+@app.route('/admin/backup', methods=['GET', 'POST'])
+@require_admin
+def admin_backup():
+    """Статус последнего снапшота; POST запускает снапшот немедленно"""
+    started = snapshotter.trigger() if request.method == 'POST' else False
+    return jsonify({
+        "snapshot_started": started,
+        "interval_seconds": BACKUP_INTERVAL_SECONDS,
+        **snapshotter.current_status()
+    }), 202 if started else 200
+
+@app.route('/admin/admission')
+@require_admin
+def admin_admission():
+    """Текущий лимит параллельности и статистика по классам маршрутов"""
+    return jsonify(admission.stats())
+
+@app.route('/admin/profile', methods=['POST'])
+@require_admin
+def admin_profile():
+    """Профилировать этот воркер seconds секунд и вернуть collapsed stacks для флеймграфа"""
+    seconds = request.args.get('seconds', 10, type=float)
+    interval_ms = request.args.get('interval_ms', 5, type=float)
+    include_idle = request.args.get('idle') == '1'
+    try:
+        stacks, samples = profiler.profile(seconds, max(interval_ms, 1) / 1000, include_idle)
+    except ProfilerBusy:
+        return jsonify({"error": "Profiler already running in this worker"}), 409
+    response = app.response_class(stacks, mimetype='text/plain')
+    response.headers['X-Profile-Samples'] = str(samples)
+    response.headers['X-Profile-PID'] = str(os.getpid())
+    return response
+
+@app.route('/admin/sql_stats', methods=['GET', 'DELETE'])
+@require_admin
+def admin_sql_stats():
+    """Статистика SQL-запросов этого воркера; DELETE сбрасывает её"""
+    if request.method == 'DELETE':
+        sql_stats.reset()
+        return jsonify({"message": "SQL statistics reset"})
+    sort = request.args.get('sort', 'total_ms')
+    if sort not in ('calls', 'total_ms', 'avg_ms', 'max_ms', 'rows'):
+        return jsonify({"error": "sort must be one of: calls, total_ms, avg_ms, max_ms, rows"}), 400
+    return jsonify({
+        "pid": os.getpid(),
+        "since": datetime.fromtimestamp(sql_stats.since).isoformat(),
+        "statements": sql_stats.top(sort, request.args.get('limit', 50, type=int))
+    })
+
+@app.route('/admin/reconcile', methods=['GET', 'POST'])
+@require_admin
+def admin_reconcile():
+    """Прогресс сверки балансов; POST запускает новый проход ({"full": true} - с нуля)"""
+    try:
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            reconciler.request_pass(full=bool(data.get('full')))
+        return jsonify(reconciler.progress())
+    except Exception as e:
+        logger.error("Reconcile status error: %s", e)
+        return jsonify({"error": "Failed to get reconcile status"}), 500
+
+@app.route('/admin/archive', methods=['GET', 'POST'])
+@require_admin
+def admin_archive():
+    """Состояние архива неактивных игроков; POST запускает проход сейчас"""
+    try:
+        if request.method == 'POST':
+            archiver.request_pass()
+        return jsonify(archiver.progress())
+    except Exception as e:
+        logger.error("Archive status error: %s", e)
+        return jsonify({"error": "Failed to get archive status"}), 500
+
+@app.route('/admin/logging', methods=['GET', 'POST'])
+@require_admin
+def admin_logging():
+    """Уровни логгеров, сэмплирование и очередь записи; POST меняет уровни во всех процессах
+    ({"levels": {"economy": "DEBUG", "werkzeug": null}, "sample_rates": {"sync": 0.1}})"""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        levels = data.get('levels') or {}
+        sample_rates = data.get('sample_rates') or {}
+        if not isinstance(levels, dict) or not isinstance(sample_rates, dict):
+            return jsonify({"error": "levels and sample_rates must be objects"}), 400
+        if not all(isinstance(rate, (int, float)) and 0 <= rate <= 1 for rate in sample_rates.values()):
+            return jsonify({"error": "sample rates must be between 0 and 1"}), 400
+        try:
+            on_log_settings_changed(levels, sample_rates)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        logger.warning("Log settings changed: levels %s, sample rates %s", levels, sample_rates)
+    return jsonify(dict(log_pipeline.stats(), pid=os.getpid()))
+
+@app.route('/admin/economy')
+@require_admin
+def admin_economy():
+    """Текущие правила экономики и ошибка последней перезагрузки"""
+    return jsonify(economy_engine.stats())
+
+@app.route('/admin/economy/reload', methods=['POST'])
+@require_admin
+def admin_economy_reload():
+    """Перечитать файл правил сейчас, не дожидаясь проверки mtime"""
+    try:
+        economy_engine.reload(force=True)
+    except economy.RulesError as e:
+        return jsonify({"error": str(e), **economy_engine.stats()}), 400
+    return jsonify(economy_engine.stats())
+
+@app.route('/admin/economy/boost', methods=['POST'])
+@require_admin
+def admin_economy_boost():
+    """Выдать игроку временный множитель: {telegram_id, multiplier, duration_seconds, source}"""
+    data = request.get_json() or {}
+    telegram_id = data.get('telegram_id')
+    multiplier = data.get('multiplier')
+    duration = data.get('duration_seconds')
+    
+    if not isinstance(telegram_id, int):
+        return jsonify({"error": "telegram_id is required"}), 400
+    if not isinstance(multiplier, (int, float)) or multiplier <= 0:
+        return jsonify({"error": "multiplier must be a positive number"}), 400
+    if not isinstance(duration, int) or duration <= 0:
+        return jsonify({"error": "duration_seconds must be a positive integer"}), 400
+    
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1 FROM users WHERE telegram_id = ?', (telegram_id,))
+        if not cursor.fetchone():
+            conn.close()
+            return jsonify({"error": "User not found"}), 404
+        expires_at = economy_engine.grant_boost(cursor, telegram_id, multiplier, duration, data.get('source'))
+        conn.commit()
+        conn.close()
+        
+        on_economy_changed(telegram_id)
+        logger.info("Boost x%s for %ss granted to user %s", multiplier, duration, telegram_id)
+        return jsonify({"telegram_id": telegram_id, "expires_at": expires_at,
+                        **economy_engine.explain(telegram_id)})
+    except Exception as e:
+        logger.error("Economy boost error: %s", e)
+        return jsonify({"error": "Failed to grant boost"}), 500
+
+@app.route('/admin/economy/upgrade', methods=['POST'])
+@require_admin
+def admin_economy_upgrade():
+    """Установить игроку уровень улучшения: {telegram_id, level}"""
+    data = request.get_json() or {}
+    telegram_id = data.get('telegram_id')
+    level = data.get('level')
+    
+    if not isinstance(telegram_id, int) or not isinstance(level, int):
+        return jsonify({"error": "telegram_id and level are required integers"}), 400
+    
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('SELECT 1 FROM users WHERE telegram_id = ?', (telegram_id,))
+        if not cursor.fetchone():
+            conn.close()
+            return jsonify({"error": "User not found"}), 404
+        economy_engine.set_upgrade(cursor, telegram_id, level)
+        conn.commit()
+        conn.close()
+    except economy.RulesError as e:
+        conn.close()
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error("Economy upgrade error: %s", e)
+        return jsonify({"error": "Failed to set upgrade"}), 500
+    
+    on_economy_changed(telegram_id)
+    return jsonify({"telegram_id": telegram_id, **economy_engine.explain(telegram_id)})
+
+@app.route('/admin/broadcast', methods=['POST'])
+@require_admin
+def admin_create_broadcast():
+    """Создать рассылку всем незаблокировавшим бота пользователям"""
+    data = request.get_json() or {}
+    text = data.get('text', '').strip()
+    
+    if not text:
+        return jsonify({"error": "text is required"}), 400
+    
+    if len(text) > 4096:
+        return jsonify({"error": "text must be at most 4096 characters"}), 400
+    
+    job_id = broadcast_engine.create_job(text)
+    logger.info("Broadcast %s created", job_id)
+    return jsonify(broadcast_engine.progress(job_id)), 201
+
+@app.route('/admin/broadcast/<int:job_id>')
+@require_admin
+def admin_broadcast_progress(job_id):
+    """Прогресс рассылки"""
+    job = broadcast_engine.progress(job_id)
+    if not job:
+        return jsonify({"error": "Broadcast not found"}), 404
+    return jsonify(job)
+
+@app.route('/admin/broadcast/<int:job_id>/cancel', methods=['POST'])
+@require_admin
+def admin_cancel_broadcast(job_id):
+    """Отменить рассылку"""
+    if not broadcast_engine.cancel_job(job_id):
+        return jsonify({"error": "Broadcast not found or already finished"}), 404
+    return jsonify(broadcast_engine.progress(job_id))
+
 # Обработка ошибок
 @app.errorhandler(404)
 def not_found(error):
@@ -333,10 +1611,8 @@ def not_found(error):
 def internal_error(error):
     return jsonify({"error": "Internal server error"}), 500
 
-@app.route('/game')
-def game():
-    """Игровая страница для Telegram Web App"""
-    return '''
+# Страница собирается при импорте: при preload_app её байты общие для всех воркеров
+GAME_HTML = '''
 <!DOCTYPE html>
 <html lang="en">
 <head>
@@ -375,7 +1651,7 @@ def game():
     <div id="root"></div>
 
     <script type="text/babel">
-        const { useState, useEffect } = React;
+        const { useState, useEffect, useRef } = React;
 
         // Telegram Web App initialization
         const tg = window.Telegram?.WebApp;
@@ -403,6 +1679,55 @@ def game():
             return [value, setStoredValue];
         };
 
+        // Очередь несинхронизированных дельт: переживает перезагрузку и офлайн
+        const SYNC_PROTOCOL = 1;
+        const SYNC_INTERVAL_MS = 120000;
+        const SYNC_MAX_BATCH = 500;
+
+        const getClientId = () => {
+            let clientId = localStorage.getItem('veln-client-id');
+            if (!clientId) {
+                clientId = Math.random().toString(36).slice(2) + Date.now().toString(36);
+                localStorage.setItem('veln-client-id', clientId);
+            }
+            return clientId;
+        };
+
+        const loadOutbox = () => {
+            try {
+                const item = localStorage.getItem('veln-sync-outbox');
+                return item ? JSON.parse(item) : { seq: 0, pending: 0, deltas: [] };
+            } catch (error) {
+                return { seq: 0, pending: 0, deltas: [] };
+            }
+        };
+
+        const saveOutbox = (outbox) => {
+            localStorage.setItem('veln-sync-outbox', JSON.stringify(outbox));
+        };
+
+        // Токен сессии: initData проверяется сервером один раз, дальше запросы идут с JWT
+        let sessionToken = null;
+        const authHeaders = () => sessionToken ? { 'Authorization': `Bearer ${sessionToken}` } : {};
+
+        // Условные GET: сервер отвечает 304, если данные не менялись
+        const responseCache = new Map();
+
+        const cachedGet = async (url) => {
+            const cached = responseCache.get(url);
+            const headers = cached ? { 'If-None-Match': cached.etag, ...authHeaders() } : authHeaders();
+            const response = await fetch(url, { headers });
+            if (response.status === 304 && cached) {
+                return cached.data;
+            }
+            const data = await response.json();
+            const etag = response.headers.get('ETag');
+            if (response.ok && etag) {
+                responseCache.set(url, { etag, data });
+            }
+            return data;
+        };
+
         const useUser = () => {
             const user = tg?.initDataUnsafe?.user;
             return {
@@ -425,13 +1750,37 @@ def game():
             const [apiStatus, setApiStatus] = useState('connecting');
             const [leaderboard, setLeaderboard] = useState([]);
             const [showLeaderboard, setShowLeaderboard] = useState(false);
-            const [lastSync, setLastSync] = useState(0);
+            const outboxRef = useRef(loadOutbox());
+            // Скорость начисления считает сервер; outbox копит секунды игры
+            const rateRef = useRef(1);
+            const syncInFlightRef = useRef(false);
+            const isRegisteredRef = useRef(false);
             const user = useUser();
 
             // API Configuration
             const API_BASE = 'https://veln-game-server.onrender.com';
 
             // API Functions
+            const authenticate = async () => {
+                if (!tg?.initData) return false;
+                try {
+                    const response = await fetch(`${API_BASE}/auth/telegram`, {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify({ init_data: tg.initData })
+                    });
+                    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+                    const data = await response.json();
+                    sessionToken = data.token;
+                    // Обновляем токен за минуту до истечения
+                    setTimeout(authenticate, Math.max(data.expires_in - 60, 60) * 1000);
+                    return true;
+                } catch (error) {
+                    console.error('Auth error:', error);
+                    return false;
+                }
+            };
+
             const registerUser = async () => {
                 try {
                     const response = await fetch(`${API_BASE}/register`, {
@@ -446,6 +1795,7 @@ def game():
                     });
                     const data = await response.json();
                     console.log('User registered:', data);
+                    isRegisteredRef.current = true;
                     setIsRegistered(true);
                     setApiStatus('connected');
                     return data;
@@ -456,33 +1806,61 @@ def game():
                 }
             };
 
-            const syncPointsToServer = async (currentPoints) => {
-                if (!isRegistered || currentPoints <= lastSync) return;
+            // Отправляем все неподтверждённые дельты; при ошибке они остаются в очереди
+            // и уходят повторно с теми же seq, сервер отбрасывает уже применённые
+            const syncPointsToServer = async (keepalive = false) => {
+                if (!isRegisteredRef.current || syncInFlightRef.current) return;
                 
+                const outbox = outboxRef.current;
+                if (outbox.pending > 0) {
+                    outbox.seq += 1;
+                    outbox.deltas.push({ seq: outbox.seq, points: outbox.pending });
+                    outbox.pending = 0;
+                    saveOutbox(outbox);
+                }
+                if (outbox.deltas.length === 0) return;
+                
+                syncInFlightRef.current = true;
                 try {
-                    const pointsToAdd = currentPoints - lastSync;
-                    const response = await fetch(`${API_BASE}/add_points`, {
+                    const response = await fetch(`${API_BASE}/v1/sync`, {
                         method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
+                        keepalive: keepalive,
+                        headers: { 'Content-Type': 'application/json', ...authHeaders() },
                         body: JSON.stringify({
+                            protocol: SYNC_PROTOCOL,
                             telegram_id: parseInt(user.id),
-                            points: pointsToAdd,
-                            description: 'Game session points'
+                            client_id: getClientId(),
+                            deltas: outbox.deltas.slice(0, SYNC_MAX_BATCH)
                         })
                     });
+                    if (!response.ok) throw new Error(`HTTP ${response.status}`);
                     const data = await response.json();
                     console.log('Points synced:', data);
-                    setServerPoints(data.new_balance || currentPoints);
-                    setLastSync(currentPoints);
+                    outbox.deltas = outbox.deltas.filter(delta => delta.seq > data.acked_seq);
+                    saveOutbox(outbox);
+                    setServerPoints(data.new_balance);
+                    if (data.rate) rateRef.current = data.rate;
                 } catch (error) {
                     console.error('Sync error:', error);
+                } finally {
+                    syncInFlightRef.current = false;
                 }
             };
 
-            const loadLeaderboard = async () => {
+            const loadRate = async () => {
                 try {
-                    const response = await fetch(`${API_BASE}/leaderboard?limit=10`);
+                    const response = await fetch(`${API_BASE}/economy/rate/${user.id}`, { headers: authHeaders() });
+                    if (!response.ok) return;
                     const data = await response.json();
+                    rateRef.current = data.rate;
+                } catch (error) {
+                    console.error('Rate error:', error);
+                }
+            };
+
+            const loadLeaderboard = async () => {
+                try {
+                    const data = await cachedGet(`${API_BASE}/leaderboard?limit=10`);
                     setLeaderboard(data.leaderboard || []);
                     return data;
                 } catch (error) {
@@ -493,8 +1871,7 @@ def game():
 
             const getUserServerPoints = async () => {
                 try {
-                    const response = await fetch(`${API_BASE}/points/${user.id}`);
-                    const data = await response.json();
+                    const data = await cachedGet(`${API_BASE}/points/${user.id}`);
                     setServerPoints(data.points || 0);
                     return data.points || 0;
                 } catch (error) {
@@ -512,7 +1889,8 @@ def game():
                     console.log('Initializing VELN Game...');
                     setApiStatus('connecting');
                     
-                    // Регистрируем пользователя
+                    // Получаем токен сессии и регистрируем пользователя
+                    await authenticate();
                     await registerUser();
                     
                     // Загружаем поинты с сервера
@@ -520,6 +1898,7 @@ def game():
                     if (serverPoints > points) {
                         setPoints(serverPoints);
                     }
+                    await loadRate();
                     
                     // Загружаем таблицу лидеров
                     await loadLeaderboard();
@@ -534,6 +1913,7 @@ def game():
                     if (document.hidden) {
                         setIsAppVisible(false);
                         setLastActiveTime(Date.now());
+                        syncPointsToServer(true);
                     } else {
                         setIsAppVisible(true);
                         setLastActiveTime(Date.now());
@@ -542,6 +1922,7 @@ def game():
 
                 const handleBeforeUnload = () => {
                     setLastActiveTime(Date.now());
+                    syncPointsToServer(true);
                 };
 
                 document.addEventListener('visibilitychange', handleVisibilityChange);
@@ -558,8 +1939,10 @@ def game():
                 if (!isAppVisible) return;
                 
                 const interval = setInterval(() => {
+                    outboxRef.current.pending += 1;
+                    saveOutbox(outboxRef.current);
                     setPoints(prev => {
-                        const newPoints = prev + 1;
+                        const newPoints = prev + rateRef.current;
                         setLastActiveTime(Date.now());
                         return newPoints;
                     });
@@ -568,16 +1951,17 @@ def game():
                 return () => clearInterval(interval);
             }, [isAppVisible]);
 
-            // Синхронизация поинтов с сервером каждые 10 секунд
+            // Синхронизация поинтов с сервером раз в пару минут и при скрытии приложения
             useEffect(() => {
                 if (!isRegistered) return;
                 
+                syncPointsToServer();
                 const syncInterval = setInterval(() => {
-                    syncPointsToServer(points);
-                }, 10000);
+                    syncPointsToServer();
+                }, SYNC_INTERVAL_MS);
                 
                 return () => clearInterval(syncInterval);
-            }, [points, isRegistered, lastSync]);
+            }, [isRegistered]);
 
             // Обновление таблицы лидеров каждые 30 секунд
             useEffect(() => {
@@ -848,11 +2232,11 @@ def game():
                                                         letterSpacing: '0.1em'
                                                     }}
                                                 >
-                                                    {points.toLocaleString()}
+                                                    {Math.floor(points).toLocaleString()}
                                                 </div>
                                                 
                                                 {/* Server Points Display */}
-                                                {serverPoints !== points && (
+                                                {serverPoints !== Math.floor(points) && (
                                                     <div className="text-sm text-blue-300 opacity-75">
                                                         Server: {serverPoints.toLocaleString()}
                                                     </div>
@@ -940,6 +2324,12 @@ def game():
 </body>
 </html>
 '''
+game_page = StaticAsset(GAME_HTML, 'text/html')
+
+@app.route('/game')
+def game():
+    """Игровая страница для Telegram Web App"""
+    return game_page.response()
 
 # Webhook functions for Telegram Bot integration
 import requests
@@ -951,7 +2341,7 @@ def send_message(chat_id, text, reply_markup=None):
         logger.warning("BOT_TOKEN not configured")
         return None
         
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+    url = f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/sendMessage"
     data = {
         'chat_id': chat_id,
         'text': text,
@@ -959,18 +2349,26 @@ def send_message(chat_id, text, reply_markup=None):
     }
     
     if reply_markup:
-        data['reply_markup'] = json.dumps(reply_markup)
+        # Клавиатуры из KeyboardCache уже сериализованы
+        data['reply_markup'] = reply_markup if isinstance(reply_markup, str) else json.dumps(reply_markup)
     
     try:
-        response = requests.post(url, data=data)
+        with tracer.span('telegram.sendMessage', **{"http.url": "sendMessage", "telegram.chat_id": chat_id}):
+            response = requests.post(url, data=data)
         return response.json()
     except Exception as e:
-        logger.error(f"Error sending message: {e}")
+        logger.error("Error sending message: %s", e)
         return None
 
-def create_game_keyboard():
-    """Создать клавиатуру с кнопкой игры"""
-    game_url = request.host_url.rstrip('/') + '/game'
+def get_public_base_url():
+    """Адрес сервера: из текущего запроса или из PUBLIC_URL для отдельного бот-процесса"""
+    if has_request_context():
+        return request.host_url.rstrip('/')
+    return PUBLIC_URL.rstrip('/')
+
+def build_game_keyboard(base_url):
+    """Клавиатура с кнопкой игры для адреса сервера"""
+    game_url = base_url + '/game'
     return {
         'inline_keyboard': [
             [
@@ -992,19 +2390,164 @@ def create_game_keyboard():
         ]
     }
 
-def register_user_from_telegram(user_data):
-    """Зарегистрировать пользователя из Telegram"""
+game_keyboards = KeyboardCache(build_game_keyboard)
+
+def create_game_keyboard():
+    """Клавиатура с кнопкой игры (сериализованная, из кеша по адресу сервера)"""
+    return game_keyboards.get(get_public_base_url())
+
+# Тексты команд разбираются один раз при импорте, на обновление - только подстановка
+START_TEXT = Template("""
+🎮 <b>Добро пожаловать в VELN Game!</b>
+
+Привет, {first_name}! 
+{referral_note}
+
+<b>VELN</b> - это увлекательная игра, где ты:
+• ⏰ Собираешь поинты каждую секунду
+• 🏆 Соревнуешься с другими игроками  
+• 📈 Поднимаешься в таблице лидеров
+• 💰 Накапливаешь Time-Point-VELN COIN
+
+<i>Твой прогресс сохраняется автоматически!</i>
+
+👇 Нажми кнопку ниже, чтобы начать игру:
+""")
+REFERRAL_NOTE = Raw("🤝 Ты пришёл по приглашению друга - вы теперь друзья в игре!")
+
+GAME_TEXT = Template("""
+🎯 <b>Запуск VELN Game</b>
+
+Нажми кнопку ниже, чтобы открыть игру:
+""")
+
+STATS_TEXT = Template("""
+📊 <b>Твоя статистика</b>
+
+👤 <b>Игрок:</b> {first_name}
+💰 <b>Поинты:</b> {points:,}
+🏅 <b>Место:</b> {rank_prefix}{rank:,} из {total_players:,} (топ {top_percent}%)
+📅 <b>Играешь с:</b> {played_since}
+
+🎮 <b>Продолжай играть и собирай больше поинтов!</b>
+""")
+STATS_MISSING_TEXT = Template("""
+❌ <b>Статистика недоступна</b>
+
+Сначала запусти игру командой /game
+""")
+STATS_ERROR_TEXT = Template("""
+❌ <b>Ошибка получения статистики</b>
+
+Попробуй позже или запусти игру заново.
+""")
+
+PLACE_EMOJI = ("👑", "🥈", "🥉", "▫️")
+LEADERBOARD_ROW = Template("{emoji} <b>{place}.</b> {highlight}{name} - {points:,} поинтов\n")
+LEADERBOARD_FOOTER = Template("\n🎮 <b>Играй и поднимайся выше!</b>")
+LEADERBOARD_EMPTY_TEXT = Template("""
+🏆 <b>Таблица лидеров пуста</b>
+
+Стань первым! Запусти игру и начни собирать поинты.
+""")
+LEADERBOARD_ERROR_TEXT = Template("""
+❌ <b>Ошибка загрузки лидеров</b>
+
+Попробуй позже.
+""")
+
+FRIENDS_TITLE = Raw("🤝 <b>Ты и твои друзья</b>\n\n")
+FRIENDS_EMPTY_TITLE = Raw("🤝 <b>У тебя пока нет друзей в игре</b>\n")
+FRIENDS_ROW = Template("<b>{place}.</b> {highlight}{name} - {points:,} поинтов\n")
+FRIENDS_TEXT = Template("{title}{rows}\n📨 Приглашено друзей: {invited}{invite}")
+FRIENDS_INVITE = Template("\n\nОтправь другу ссылку:\n{link}")
+FRIENDS_ERROR_TEXT = Template("""
+❌ <b>Ошибка загрузки друзей</b>
+
+Попробуй позже.
+""")
+
+HELP_TEXT = Template("""
+❓ <b>Помощь по VELN Game</b>
+
+<b>Команды бота:</b>
+/start - 🎮 Начать игру
+/game - 🎯 Открыть игру
+/stats - 📊 Твоя статистика  
+/leaderboard - 🏆 Таблица лидеров
+/leaderboard week - 📅 Лидеры недели (также day, month)
+/friends - 🤝 Друзья и ссылка-приглашение
+/help - ❓ Эта справка
+
+<b>Как играть:</b>
+• Открой игру через Web App
+• Поинты начисляются автоматически
+• Перетаскивай логотип VELN
+• Соревнуйся с другими игроками
+• Прогресс сохраняется навсегда
+
+<b>Поддержка:</b> @dante_moretti
+""")
+
+ACHIEVEMENT_TEXT = Template("""
+🏅 <b>Новое достижение: {title}</b>
+
+У тебя уже {points:,} поинтов. Так держать!
+""")
+
+UNKNOWN_COMMAND_TEXT = Template("❓ Неизвестная команда. Используй /help для справки.")
+
+def render_achievement(achievement_id, balance):
+    """Уведомление о достижении с кнопкой игры"""
+    text = ACHIEVEMENT_TEXT.render(title=achievement_engine.title(achievement_id), points=balance)
+    return text, create_game_keyboard()
+
+def render_leaderboard(title, results, user_id):
+    """Текст таблицы лидеров: title - готовый HTML, results - (telegram_id, username, first_name, points)"""
+    rows = [title, "\n\n"]
+    for i, player in enumerate(results, 1):
+        rows.append(LEADERBOARD_ROW.render(
+            emoji=PLACE_EMOJI[min(i, 4) - 1],
+            place=i,
+            highlight="🔸" if player[0] == user_id else "",
+            name=player[2] or player[1] or 'Player',
+            points=player[3]
+        ))
+    rows.append(LEADERBOARD_FOOTER.render())
+    return ''.join(rows)
+
+def register_user_from_telegram(user_data, referrer_id=None):
+    """Зарегистрировать пользователя из Telegram (и связать с пригласившим);
+    True - по ссылке создана новая дружба, False - нет (или ошибка регистрации)"""
     try:
-        conn = sqlite3.connect('veln_game.db')
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         # Проверяем, существует ли пользователь
         cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (user_data['id'],))
         existing_user = cursor.fetchone()
+        if not existing_user and restore_archived_user(user_data['id']):
+            cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (user_data['id'],))
+            existing_user = cursor.fetchone()
+        
+        if referrer_id is not None:
+            cursor.execute('SELECT 1 FROM users WHERE telegram_id = ?', (referrer_id,))
+            if not cursor.fetchone():
+                referrer_id = None
         
         if existing_user:
+            # Пользователь снова пишет боту - возвращаем его в рассылки
+            cursor.execute(
+                'UPDATE users SET is_blocked = 0 WHERE telegram_id = ? AND is_blocked = 1',
+                (user_data['id'],)
+            )
+            # Уже играющий по ссылке друга - просто становятся друзьями
+            linked = referrer_id is not None and friend_graph.add_friendship(cursor, referrer_id, user_data['id'])
+            conn.commit()
             conn.close()
-            return True
+            if linked:
+                on_friends_linked(referrer_id, user_data['id'])
+            return linked
         
         # Создаем нового пользователя
         cursor.execute('''
@@ -1016,14 +2559,24 @@ def register_user_from_telegram(user_data):
             user_data.get('first_name', ''),
             user_data.get('last_name', '')
         ))
+        linked = referrer_id is not None and friend_graph.record_referral(cursor, referrer_id, user_data['id'])
         
         conn.commit()
         conn.close()
         
-        logger.info(f"New user registered from Telegram: {user_data['id']}")
-        return True
+        log_user_event(
+            user_data['id'],
+            user_data.get('username', ''),
+            user_data.get('first_name', ''),
+            user_data.get('last_name', '')
+        )
+        on_user_created(user_data['id'])
+        if linked:
+            on_friends_linked(referrer_id, user_data['id'])
+        logger.info("New user registered from Telegram: %s", user_data['id'])
+        return linked
     except Exception as e:
-        logger.error(f"Registration from Telegram error: {e}")
+        logger.error("Registration from Telegram error: %s", e)
         return False
 
 def handle_start_command(message):
@@ -1031,24 +2584,15 @@ def handle_start_command(message):
     user = message['from']
     chat_id = message['chat']['id']
     
-    # Регистрируем пользователя
-    register_user_from_telegram(user)
+    # Регистрируем пользователя; /start ref_<id> - пришёл по ссылке друга
+    referrer_id = friends.parse_start_payload(message.get('text'))
+    linked = register_user_from_telegram(user, referrer_id)
     
-    welcome_text = f"""
-🎮 <b>Добро пожаловать в VELN Game!</b>
-
-Привет, {user.get('first_name', 'Игрок')}! 
-
-<b>VELN</b> - это увлекательная игра, где ты:
-• ⏰ Собираешь поинты каждую секунду
-• 🏆 Соревнуешься с другими игроками  
-• 📈 Поднимаешься в таблице лидеров
-• 💰 Накапливаешь Time-Point-VELN COIN
-
-<i>Твой прогресс сохраняется автоматически!</i>
-
-👇 Нажми кнопку ниже, чтобы начать игру:
-"""
+    welcome_text = START_TEXT.render(
+        first_name=user.get('first_name', 'Игрок'),
+        # Только если дружба действительно появилась: не сам себя, не уже друзья, не лимит
+        referral_note=REFERRAL_NOTE if linked else Raw('')
+    )
     
     keyboard = create_game_keyboard()
     send_message(chat_id, welcome_text, keyboard)
@@ -1057,11 +2601,7 @@ def handle_game_command(message):
     """Обработка команды /game"""
     chat_id = message['chat']['id']
     
-    game_text = """
-🎯 <b>Запуск VELN Game</b>
-
-Нажми кнопку ниже, чтобы открыть игру:
-"""
+    game_text = GAME_TEXT.render()
     
     keyboard = create_game_keyboard()
     send_message(chat_id, game_text, keyboard)
@@ -1072,111 +2612,118 @@ def handle_stats_command(message):
     chat_id = message['chat']['id']
     
     try:
-        conn = sqlite3.connect('veln_game.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (user['id'],))
-        user_data = cursor.fetchone()
-        conn.close()
+        user_data = fetch_user(user['id'])
         
         if user_data:
-            stats_text = f"""
-📊 <b>Твоя статистика</b>
-
-👤 <b>Игрок:</b> {user_data[3] or 'Неизвестно'}
-💰 <b>Поинты:</b> {user_data[5]:,}
-📅 <b>Играешь с:</b> {user_data[6][:10]}
-
-🎮 <b>Продолжай играть и собирай больше поинтов!</b>
-"""
+            rank = rank_estimator.estimate(user_data[5])
+            rank_prefix = '' if rank['exact'] else '~'
+            stats_text = STATS_TEXT.render(
+                first_name=user_data[3] or 'Неизвестно',
+                points=user_data[5],
+                rank_prefix=rank_prefix,
+                rank=rank['rank'],
+                total_players=rank['total_players'],
+                top_percent=rank['top_percent'],
+                played_since=(user_data[6] or '')[:10]
+            )
         else:
-            stats_text = """
-❌ <b>Статистика недоступна</b>
-
-Сначала запусти игру командой /game
-"""
+            stats_text = STATS_MISSING_TEXT.render()
     except Exception as e:
-        logger.error(f"Stats error: {e}")
-        stats_text = """
-❌ <b>Ошибка получения статистики</b>
-
-Попробуй позже или запусти игру заново.
-"""
+        logger.error("Stats error: %s", e)
+        stats_text = STATS_ERROR_TEXT.render()
     
     keyboard = create_game_keyboard()
     send_message(chat_id, stats_text, keyboard)
 
+SEASON_TITLES = {
+    'day': 'за день',
+    'week': 'за неделю',
+    'month': 'за месяц'
+}
+
 def handle_leaderboard_command(message):
-    """Обработка команды /leaderboard"""
+    """Обработка команды /leaderboard [day|week|month]"""
     chat_id = message['chat']['id']
     user_id = message['from']['id']
+    args = message.get('text', '').split()[1:]
+    window = args[0].lower() if args else 'all'
+    if window not in SEASON_TITLES:
+        window = 'all'
     
     try:
-        conn = sqlite3.connect('veln_game.db')
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT telegram_id, username, first_name, points
-            FROM users 
-            WHERE points > 0 
-            ORDER BY points DESC 
-            LIMIT 10
-        ''')
-        
-        results = cursor.fetchall()
-        conn.close()
+        if window == 'all':
+            results = fetch_top_users(10)
+            title = "🏆 <b>Таблица лидеров</b>"
+        else:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            period, results = season_boards.top(cursor, window, 10)
+            conn.close()
+            title = f"🏆 <b>Таблица лидеров {SEASON_TITLES[window]}</b> ({period})"
         
         if results:
-            leaderboard_text = "🏆 <b>Таблица лидеров</b>\n\n"
-            
-            for i, player in enumerate(results, 1):
-                emoji = "👑" if i == 1 else "🥈" if i == 2 else "🥉" if i == 3 else "▫️"
-                highlight = "🔸" if player[0] == user_id else ""
-                name = player[2] or player[1] or 'Player'
-                
-                leaderboard_text += f"{emoji} <b>{i}.</b> {highlight}{name} - {player[3]:,} поинтов\n"
-            
-            leaderboard_text += "\n🎮 <b>Играй и поднимайся выше!</b>"
+            leaderboard_text = render_leaderboard(title, results, user_id)
         else:
-            leaderboard_text = """
-🏆 <b>Таблица лидеров пуста</b>
-
-Стань первым! Запусти игру и начни собирать поинты.
-"""
+            leaderboard_text = LEADERBOARD_EMPTY_TEXT.render()
     except Exception as e:
-        logger.error(f"Leaderboard error: {e}")
-        leaderboard_text = """
-❌ <b>Ошибка загрузки лидеров</b>
-
-Попробуй позже.
-"""
+        logger.error("Leaderboard error: %s", e)
+        leaderboard_text = LEADERBOARD_ERROR_TEXT.render()
     
     keyboard = create_game_keyboard()
     send_message(chat_id, leaderboard_text, keyboard)
 
+_bot_username = BOT_USERNAME
+
+def get_bot_username():
+    """Имя бота для ссылок t.me (кешируется после первого getMe)"""
+    global _bot_username
+    if not _bot_username and BOT_TOKEN and BOT_TOKEN != 'your_bot_token_here':
+        try:
+            response = requests.get(f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/getMe", timeout=10)
+            _bot_username = response.json()['result']['username']
+        except Exception as e:
+            logger.error("getMe error: %s", e)
+    return _bot_username
+
+def handle_friends_command(message):
+    """Обработка команды /friends"""
+    chat_id = message['chat']['id']
+    user_id = message['from']['id']
+    
+    try:
+        board = friend_graph.board(get_db_connection, user_id, 10)
+        conn = get_db_connection()
+        invited = friend_graph.referral_count(conn.cursor(), user_id)
+        conn.close()
+        
+        has_friends = board and len(board) > 1
+        rows = ''.join(FRIENDS_ROW.render(
+            place=i,
+            highlight="🔸" if player[0] == user_id else "",
+            name=player[2] or player[1] or 'Player',
+            points=player[3]
+        ) for i, player in enumerate(board, 1)) if has_friends else ''
+        bot_username = get_bot_username()
+        invite = FRIENDS_INVITE.render(link=friends.invite_link(bot_username, user_id)) if bot_username else ''
+        
+        friends_text = FRIENDS_TEXT.render(
+            title=FRIENDS_TITLE if has_friends else FRIENDS_EMPTY_TITLE,
+            # Строки и ссылка уже отрендерены шаблонами с экранированием
+            rows=Raw(rows),
+            invited=invited,
+            invite=Raw(invite)
+        )
+    except Exception as e:
+        logger.error("Friends error: %s", e)
+        friends_text = FRIENDS_ERROR_TEXT.render()
+    
+    send_message(chat_id, friends_text)
+
 def handle_help_command(message):
     """Обработка команды /help"""
     chat_id = message['chat']['id']
     
-    help_text = """
-❓ <b>Помощь по VELN Game</b>
-
-<b>Команды бота:</b>
-/start - 🎮 Начать игру
-/game - 🎯 Открыть игру
-/stats - 📊 Твоя статистика  
-/leaderboard - 🏆 Таблица лидеров
-/help - ❓ Эта справка
-
-<b>Как играть:</b>
-• Открой игру через Web App
-• Поинты начисляются автоматически
-• Перетаскивай логотип VELN
-• Соревнуйся с другими игроками
-• Прогресс сохраняется навсегда
-
-<b>Поддержка:</b> @dante_moretti
-"""
+    help_text = HELP_TEXT.render()
     
     keyboard = create_game_keyboard()
     send_message(chat_id, help_text, keyboard)
@@ -1191,20 +2738,22 @@ def handle_callback_query(callback_query):
     elif data == 'stats':
         handle_stats_command({'chat': message['chat'], 'from': callback_query['from']})
 
-@app.route('/webhook', methods=['POST'])
-def webhook():
-    """Webhook для получения обновлений от Telegram"""
-    if not BOT_TOKEN or BOT_TOKEN == 'your_bot_token_here':
-        return jsonify({'error': 'BOT_TOKEN not configured'}), 400
-        
-    try:
-        update = request.get_json()
-        
+def process_update(update):
+    """Обработать одно обновление Telegram (общая точка для webhook и long polling)"""
+    kind = 'message' if 'message' in update else 'callback_query' if 'callback_query' in update else 'other'
+    
+    sender = (update.get('message') or update.get('callback_query') or {}).get('from')
+    if sender:
+        activity_store.record(sender['id'], bot=True)
+    
+    with tracer.span('bot.update', **{"bot.update_kind": kind}) as span:
         if 'message' in update:
             message = update['message']
             
             if 'text' in message:
                 text = message['text']
+                if span is not None:
+                    span.attributes["bot.command"] = text.split()[0] if text.split() else ''
                 
                 if text.startswith('/start'):
                     handle_start_command(message)
@@ -1214,20 +2763,30 @@ def webhook():
                     handle_stats_command(message)
                 elif text.startswith('/leaderboard'):
                     handle_leaderboard_command(message)
+                elif text.startswith('/friends'):
+                    handle_friends_command(message)
                 elif text.startswith('/help'):
                     handle_help_command(message)
                 else:
                     # Неизвестная команда
                     chat_id = message['chat']['id']
-                    send_message(chat_id, "❓ Неизвестная команда. Используй /help для справки.")
+                    send_message(chat_id, UNKNOWN_COMMAND_TEXT.render())
         
         elif 'callback_query' in update:
             handle_callback_query(update['callback_query'])
+
+@app.route('/webhook', methods=['POST'])
+def webhook():
+    """Webhook для получения обновлений от Telegram"""
+    if not BOT_TOKEN or BOT_TOKEN == 'your_bot_token_here':
+        return jsonify({'error': 'BOT_TOKEN not configured'}), 400
         
+    try:
+        process_update(request.get_json())
         return jsonify({'status': 'ok'})
         
     except Exception as e:
-        logger.error(f"Webhook error: {e}")
+        logger.error("Webhook error: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/set_webhook', methods=['GET', 'POST'])
@@ -1237,7 +2796,7 @@ def set_webhook_route():
         return jsonify({'error': 'BOT_TOKEN not configured'}), 400
         
     webhook_url = request.host_url.rstrip('/') + '/webhook'
-    url = f"https://api.telegram.org/bot{BOT_TOKEN}/setWebhook"
+    url = f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}/setWebhook"
     
     data = {
         'url': webhook_url,
@@ -1245,15 +2804,111 @@ def set_webhook_route():
     }
     
     try:
-        response = requests.post(url, data=data)
+        with tracer.span('telegram.setWebhook', **{"http.url": "setWebhook"}):
+            response = requests.post(url, data=data)
         return jsonify({
             'webhook_url': webhook_url,
             'telegram_response': response.json()
         })
     except Exception as e:
-        logger.error(f"Set webhook error: {e}")
+        logger.error("Set webhook error: %s", e)
         return jsonify({'error': str(e)}), 500
 
+# Журнал открываем в конце модуля: при старте он доигрывает события умерших процессов
+# через apply_logged_events, которому нужны все функции и хуки выше
+event_log = None
+if EVENT_LOG_DIR:
+    event_log = EventLog(EVENT_LOG_DIR, apply_logged_events, fsync_window=EVENT_LOG_FSYNC_WINDOW_MS / 1000,
+                         reject=reject_logged_event)
+
+def check_event_log():
+    stats = event_log.stats()
+    stats["ok"] = not stats["error"] and stats["apply_backlog"] <= HEALTH_MAX_APPLY_BACKLOG
+    return stats
+
+def check_broadcast():
+    backlog = broadcast_engine.backlog()
+    backlog["ok"] = backlog["stalled_jobs"] == 0
+    return backlog
+
+def check_achievement_notifications():
+    backlog = achievement_notifier.backlog()
+    backlog["ok"] = backlog["oldest_age_seconds"] <= HEALTH_MAX_NOTIFICATION_AGE
+    return backlog
+
+def check_cluster():
+    stats = cluster_bus.stats()
+    stats["ok"] = stats["connected"]
+    return stats
+
+health_monitor = health.HealthMonitor(ttl=HEALTH_CACHE_SECONDS)
+health_monitor.register('database', health.database_probe(
+    DATABASE_PATH, timeout_ms=HEALTH_DB_TIMEOUT_MS, slow_ms=HEALTH_DB_SLOW_MS))
+health_monitor.register('disk', health.disk_probe(
+    [path for path in (DATABASE_PATH, BACKUP_DIR if BACKUP_INTERVAL_SECONDS > 0 else None, EVENT_LOG_DIR,
+                       ARCHIVE_DATABASE_PATH if ARCHIVE_INTERVAL_SECONDS > 0 else None) if path],
+    HEALTH_MIN_FREE_MB * 2 ** 20))
+if event_log:
+    # Без журнала /add_points не работает - узел не готов
+    health_monitor.register('event_log', check_event_log)
+if BOT_TOKEN and BOT_TOKEN != 'your_bot_token_here':
+    health_monitor.register('broadcast', check_broadcast, critical=False)
+    health_monitor.register('achievement_notifications', check_achievement_notifications, critical=False)
+if cluster_bus:
+    health_monitor.register('cluster', check_cluster, critical=False)
+health_monitor.register('trace_export', health.queue_probe(
+    tracer.queue.qsize, tracer.queue.maxsize * 9 // 10), critical=False)
+
+def load_user_store():
+    """Загрузить колоночное хранилище пользователей (USER_STORE=memory)"""
+    global user_store
+    store = UserStore()
+    try:
+        conn = get_db_connection()
+        store.load(conn)
+        conn.close()
+        user_store = store
+        logger.info("User store loaded: %s users", len(store))
+    except Exception as e:
+        logger.error("User store load error: %s", e)
+
+def start_process():
+    """Загрузить кеши процесса и запустить фоновые задачи"""
+    # Поток записи лога не переживает fork
+    log_pipeline.start()
+    # После fork у воркера своё состояние: новая эпоха ETag и свежие кеши,
+    # а не снимок мастера (воркер, пересозданный по max_requests, мог отстать на часы)
+    data_versions.invalidate_all()
+    try:
+        rank_estimator.load()
+    except Exception as e:
+        logger.error("Rank histogram load error: %s", e)
+    if USER_STORE == 'memory':
+        load_user_store()
+    try:
+        conn = get_db_connection()
+        economy_engine.load(conn)
+        conn.close()
+    except Exception as e:
+        logger.error("Economy load error: %s", e)
+    
+    # Потоки не переживают fork, а журнал пишет в поток своего pid
+    tracer.start()
+    snapshotter.start()
+    if BOT_TOKEN and BOT_TOKEN != 'your_bot_token_here':
+        broadcast_engine.start()
+        achievement_notifier.start()
+    reconciler.start()
+    archiver.start()
+    activity_store.start()
+    if cluster_bus:
+        cluster_bus.start()
+    if event_log:
+        event_log.open()
+
+if BACKGROUND_START != 'post_fork':
+    start_process()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,27 @@
+import os
+import sys
+import importlib.util
+
+import pytest
+
+# Модули сервера лежат в корне репозитория, без пакета
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """Свежая копия модуля server на временной базе: хранилище в памяти, без фоновых задач и шины"""
+    monkeypatch.setenv('DATABASE_PATH', str(tmp_path / 'game.db'))
+    monkeypatch.setenv('USER_STORE', 'memory')
+    monkeypatch.setenv('ECONOMY_RULES_FILE', '')
+    for name in ('BACKUP_INTERVAL_SECONDS', 'RECONCILE_INTERVAL_SECONDS', 'ARCHIVE_INTERVAL_SECONDS'):
+        monkeypatch.setenv(name, '0')
+    for name in ('BOT_TOKEN', 'EVENT_LOG_DIR', 'CLUSTER_BUS_URL'):
+        monkeypatch.setenv(name, '')
+    spec = importlib.util.spec_from_file_location('server_under_test', os.path.join(ROOT, 'server.py'))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['server_under_test'] = module
+    spec.loader.exec_module(module)
+    yield module
+    sys.modules.pop('server_under_test', None)
@@ -0,0 +1,73 @@
+"""Достижения: пересечение порогов, выдача без повторов и описание для клиента"""
+import sqlite3
+
+import pytest
+
+import achievements
+
+DEFINITIONS = [
+    {"id": "points_1k", "threshold": 1000, "title": "1 000"},
+    {"id": "points_100", "threshold": 100, "title": "Первая сотня"},
+    {"id": "points_10k", "threshold": 10000},
+]
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    achievements.init_tables(conn.cursor())
+    yield conn
+    conn.close()
+
+
+def test_crossed_counts_only_thresholds_passed_upwards():
+    engine = achievements.AchievementEngine(DEFINITIONS)
+
+    assert engine.ids == ['points_100', 'points_1k', 'points_10k']
+    assert list(engine.crossed(0, 99)) == []
+    assert list(engine.crossed(99, 100)) == [0]
+    assert list(engine.crossed(100, 100000)) == [1, 2]
+    assert list(engine.crossed(5000, 50)) == []
+
+
+def test_duplicate_ids_are_rejected():
+    with pytest.raises(ValueError):
+        achievements.AchievementEngine(DEFINITIONS + [{"id": "points_100", "threshold": 5}])
+
+
+def test_evaluate_awards_once_with_event_time(conn):
+    engine = achievements.AchievementEngine(DEFINITIONS)
+    cursor = conn.cursor()
+
+    assert engine.evaluate(cursor, 7, 0, 1500, now=1700000000) == ['points_100', 'points_1k']
+    # Списание и повторное пересечение порога награду не дублирует
+    assert engine.evaluate(cursor, 7, 50, 150) == []
+
+    assert conn.execute('SELECT achievement_id, balance, awarded_at FROM achievement_awards ORDER BY balance, '
+                        'achievement_id').fetchall() == [('points_100', 1500, '2023-11-14 22:13:20'),
+                                                         ('points_1k', 1500, '2023-11-14 22:13:20')]
+    assert conn.execute('SELECT COUNT(*) FROM achievement_notifications').fetchone() == (2,)
+
+
+def test_describe_marks_earned_and_next(conn):
+    engine = achievements.AchievementEngine(DEFINITIONS)
+    engine.evaluate(conn.cursor(), 7, 0, 150)
+
+    result = engine.describe(conn, 7, 150)
+
+    assert [item["unlocked"] for item in result["achievements"]] == [True, False, False]
+    assert result["achievements"][2]["title"] == 'points_10k'
+    assert result["next"] == {"id": "points_1k", "title": "1 000", "threshold": 1000, "remaining": 850}
+    assert engine.describe(conn, 7, 20000)["next"] is None
+    assert engine.title('removed') == 'removed'
+
+
+def test_add_points_awards_achievement(server):
+    client = server.app.test_client()
+    assert client.post('/register', json={'telegram_id': 42}).status_code == 201
+    assert client.post('/add_points', json={'telegram_id': 42, 'points': 150}).status_code == 200
+
+    unlocked = [item["id"] for item in client.get('/achievements/42').get_json()["achievements"]
+                if item["unlocked"]]
+
+    assert unlocked == ['points_100']
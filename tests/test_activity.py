@@ -0,0 +1,71 @@
+"""Ряды активности: сброс буфера, DAU и сессии"""
+import sqlite3
+
+import pytest
+
+import activity
+
+DAY = 19724 * 86400  # полночь UTC
+
+
+@pytest.fixture
+def store(tmp_path):
+    path = str(tmp_path / 'activity.db')
+    conn = sqlite3.connect(path)
+    activity.init_tables(conn.cursor())
+    conn.commit()
+    conn.close()
+    return activity.ActivityStore(lambda: sqlite3.connect(path), session_gap=1800)
+
+
+def test_flush_builds_minute_and_day_series(store):
+    store.record(1, points=10, ts=DAY + 60)
+    store.record(1, points=5, ts=DAY + 90)
+    store.record(2, bot=True, ts=DAY + 180)
+    store.flush(now=DAY + 200)
+
+    minutes = store.series('minute', start=DAY + 60, end=DAY + 239, now=DAY + 200)
+    assert [(p["events"], p["bot_events"], p["points"]) for p in minutes["series"]] == [(2, 0, 15), (0, 0, 0),
+                                                                                         (1, 1, 0)]
+    day = store.series('day', start=DAY, end=DAY, now=DAY + 200)["series"][0]
+    assert (day["events"], day["points"], day["active_users"]) == (3, 15, 2)
+    # Повторный сброс прибавляет, а не перезаписывает; игрок за день считается один раз
+    store.record(1, points=1, ts=DAY + 300)
+    store.flush(now=DAY + 310)
+    day = store.series('day', start=DAY, end=DAY, now=DAY + 310)["series"][0]
+    assert (day["events"], day["points"], day["active_users"]) == (4, 16, 2)
+
+
+def test_session_closes_after_gap(store):
+    store.record(1, ts=DAY + 100)
+    store.record(1, ts=DAY + 700)
+    store.flush(now=DAY + 710)
+    assert store.series('day', start=DAY, end=DAY, now=DAY + 710)["summary"]["open_sessions"] == 1
+
+    # Пауза дольше session_gap: сессия 100..700 закрыта и учтена в своём дне
+    store.record(1, ts=DAY + 700 + 1801)
+    store.flush(now=DAY + 2600)
+    day = store.series('day', start=DAY, end=DAY, now=DAY + 2600)["series"][0]
+    assert (day["sessions"], day["avg_session_seconds"]) == (1, 600)
+
+
+def test_failed_flush_keeps_buffer(store):
+    connect = store.connect
+
+    def broken():
+        raise sqlite3.OperationalError("disk I/O error")
+    store.connect = broken
+    store.record(1, points=7, ts=DAY + 60)
+    with pytest.raises(sqlite3.OperationalError):
+        store.flush(now=DAY + 70)
+
+    store.connect = connect
+    store.flush(now=DAY + 80)
+    assert store.series('day', start=DAY, end=DAY, now=DAY + 80)["summary"]["points"] == 7
+
+
+def test_range_limits(store):
+    with pytest.raises(ValueError):
+        store.series('minute', start=DAY, end=DAY + activity.MAX_POINTS * 60)
+    with pytest.raises(ValueError):
+        store.series('hour', start=DAY + 7200, end=DAY)
@@ -0,0 +1,84 @@
+"""Архив неактивных игроков: перенос из горячей базы и возврат, в том числе со слиянием"""
+import time
+import sqlite3
+
+import pytest
+
+
+@pytest.fixture
+def players(server):
+    """Два игрока с очками: 101 не заходил полгода, 102 активен"""
+    if server.user_store is None:
+        server.load_user_store()
+    client = server.app.test_client()
+    for telegram_id, points in ((101, 40), (102, 5)):
+        assert client.post('/register', json={'telegram_id': telegram_id}).status_code == 201
+        assert client.post('/add_points', json={'telegram_id': telegram_id, 'points': points}).status_code == 200
+    conn = sqlite3.connect(server.DATABASE_PATH)
+    conn.execute("UPDATE users SET created_at = datetime(?, 'unixepoch'), updated_at = datetime(?, 'unixepoch') "
+                 "WHERE telegram_id = 101", (time.time() - 200 * 86400,) * 2)
+    conn.commit()
+    conn.close()
+    return client
+
+
+def run_pass(archiver):
+    archiver.request_pass()
+    while archiver._step():
+        if archiver.progress()['watermark'] == 0:
+            break
+
+
+def rows(path, sql, *args):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute(sql, args).fetchall()
+    finally:
+        conn.close()
+
+
+def test_inactive_user_moves_to_archive(server, players):
+    run_pass(server.archiver)
+
+    assert rows(server.DATABASE_PATH, 'SELECT telegram_id FROM users') == [(102,)]
+    assert rows(server.DATABASE_PATH, 'SELECT COUNT(*) FROM transactions WHERE user_id = 1') == [(0,)]
+    assert rows(server.ARCHIVE_DATABASE_PATH, 'SELECT telegram_id, points FROM users') == [(101, 40)]
+    assert rows(server.ARCHIVE_DATABASE_PATH, 'SELECT SUM(points) FROM transactions') == [(40,)]
+    assert server.user_store.get(101) is None
+    assert server.user_store.get_points(102) == 5
+    assert server.archiver.archived_count() == 1
+
+
+def test_returning_user_is_restored_with_history(server, players):
+    run_pass(server.archiver)
+
+    response = players.post('/register', json={'telegram_id': 101})
+
+    assert response.status_code == 200
+    assert response.get_json()['user']['points'] == 40
+    assert rows(server.DATABASE_PATH, 'SELECT SUM(points) FROM transactions WHERE user_id = 1') == [(40,)]
+    assert rows(server.ARCHIVE_DATABASE_PATH, 'SELECT COUNT(*) FROM users') == [(0,)]
+    assert server.user_store.get_points(101) == 40
+    # Возврат обновил активность - следующий проход игрока не уносит
+    run_pass(server.archiver)
+    assert rows(server.DATABASE_PATH, 'SELECT COUNT(*) FROM users') == [(2,)]
+
+
+def test_re_registered_user_merges_archived_balance(server, players):
+    run_pass(server.archiver)
+    # Игрока завели заново в обход возврата (например, архив был недоступен)
+    conn = sqlite3.connect(server.DATABASE_PATH)
+    conn.execute("INSERT INTO users (telegram_id, points) VALUES (101, 7)")
+    conn.execute("INSERT INTO transactions (user_id, points, description) "
+                 "SELECT id, 7, 'fresh' FROM users WHERE telegram_id = 101")
+    conn.commit()
+    conn.close()
+    server.refresh_stored_user(101)
+
+    assert server.restore_archived_user(101) is True
+
+    (hot_id, points), = rows(server.DATABASE_PATH, 'SELECT id, points FROM users WHERE telegram_id = 101')
+    assert points == 47
+    assert rows(server.DATABASE_PATH, 'SELECT SUM(points) FROM transactions WHERE user_id = ?', hot_id) == [(47,)]
+    assert rows(server.ARCHIVE_DATABASE_PATH, 'SELECT COUNT(*) FROM users') == [(0,)]
+    assert server.user_store.get_points(101) == 47
@@ -0,0 +1,149 @@
+import os
+import sqlite3
+
+import pytest
+
+import backup
+from backup import Snapshotter, restore
+
+
+def populate(path, users=500):
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, telegram_id INTEGER UNIQUE, points INTEGER)')
+    conn.execute('CREATE TABLE transactions (id INTEGER PRIMARY KEY, user_id INTEGER, points INTEGER)')
+    conn.executemany('INSERT INTO users (telegram_id, points) VALUES (?, ?)',
+                     [(1000 + i, i * 10) for i in range(users)])
+    conn.executemany('INSERT INTO transactions (user_id, points) VALUES (?, ?)',
+                     [(i % users + 1, 5) for i in range(users * 3)])
+    conn.commit()
+    return conn
+
+
+def counts(path):
+    conn = sqlite3.connect(path)
+    try:
+        return (conn.execute('SELECT COUNT(*), SUM(points) FROM users').fetchone(),
+                conn.execute('SELECT COUNT(*) FROM transactions').fetchone()[0])
+    finally:
+        conn.close()
+
+
+def test_snapshot_restores_to_new_path(tmp_path):
+    db_path = str(tmp_path / 'game.db')
+    # Соединение остаётся открытым: снапшот снимается с живой базы в WAL
+    conn = populate(db_path)
+    snapshotter = Snapshotter(db_path, str(tmp_path / 'backups'), pages_per_step=4, step_sleep=0)
+
+    snapshot = snapshotter.snapshot()
+    assert snapshot.endswith('.db.gz')
+    assert snapshotter.status["last_error"] is None
+    conn.execute('DELETE FROM transactions')
+    conn.commit()
+    conn.close()
+
+    restored_path = str(tmp_path / 'restored.db')
+    restore(snapshot, restored_path)
+    assert counts(restored_path) == ((500, sum(i * 10 for i in range(500))), 1500)
+
+
+def test_rotation_keeps_newest(tmp_path):
+    db_path = str(tmp_path / 'game.db')
+    populate(db_path, users=10).close()
+    backup_dir = tmp_path / 'backups'
+    backup_dir.mkdir()
+    old = [backup_dir / f"game-2024010{day}-120000.db.gz" for day in range(1, 5)]
+    for path in old:
+        path.write_bytes(b'')
+
+    snapshot = Snapshotter(db_path, str(backup_dir), keep=2, step_sleep=0).snapshot()
+
+    assert sorted(os.listdir(backup_dir)) == sorted([old[-1].name, os.path.basename(snapshot), '.snapshot.lock'])
+
+
+def test_keep_must_be_positive(tmp_path):
+    with pytest.raises(ValueError):
+        Snapshotter(str(tmp_path / 'game.db'), keep=0)
+
+
+def state_connect(path):
+    conn = sqlite3.connect(path)
+    backup.init_tables(conn.cursor())
+    conn.commit()
+    conn.close()
+    return lambda: sqlite3.connect(path)
+
+
+def test_schedule_is_shared_between_workers(tmp_path):
+    db_path = str(tmp_path / 'game.db')
+    populate(db_path, users=10).close()
+    connect = state_connect(db_path)
+    first, second = (Snapshotter(db_path, str(tmp_path / 'backups'), interval=3600, step_sleep=0, connect=connect)
+                     for _ in range(2))
+
+    # Снапшота ещё не было - срок наступил; снимает один воркер
+    assert first._claim(due_only=True)
+    assert not second._claim(due_only=True)
+    snapshot = first._run_claimed()
+    assert snapshot is not None
+
+    # Воркер, поднятый после пересоздания, видит расписание и статус предшественника
+    recycled = Snapshotter(db_path, str(tmp_path / 'backups'), interval=3600, step_sleep=0, connect=connect)
+    assert not recycled._claim(due_only=True)
+    status = recycled.current_status()
+    assert status["last_snapshot"] == snapshot and status["last_error"] is None and not status["running"]
+
+    # Прошёл интервал - снапшот снова нужен
+    conn = connect()
+    conn.execute('UPDATE backup_state SET last_success_at = last_success_at - 3600, last_attempt_at = 0')
+    conn.commit()
+    conn.close()
+    assert recycled._claim(due_only=True)
+
+
+def test_failed_snapshot_keeps_previous_status(tmp_path):
+    db_path = str(tmp_path / 'game.db')
+    populate(db_path, users=10).close()
+    connect = state_connect(db_path)
+    snapshotter = Snapshotter(db_path, str(tmp_path / 'backups'), step_sleep=0, connect=connect)
+    assert snapshotter._claim(due_only=False)
+    snapshot = snapshotter._run_claimed()
+
+    broken = Snapshotter(str(tmp_path / 'missing' / 'game.db'), str(tmp_path / 'backups'), step_sleep=0,
+                         connect=connect)
+    assert broken._claim(due_only=False)
+    assert broken._run_claimed() is None
+
+    status = broken.current_status()
+    assert status["last_snapshot"] == snapshot and status["last_error"]
+    # Повтор - не раньше RETRY_SECONDS
+    assert not broken._claim(due_only=True)
+
+
+def test_archive_is_snapshotted_and_restored_with_main(tmp_path):
+    db_path, archive_path = str(tmp_path / 'game.db'), str(tmp_path / 'game-archive.db')
+    populate(db_path, users=20).close()
+    populate(archive_path, users=30).close()
+    backup_dir = tmp_path / 'backups'
+
+    snapshot = Snapshotter(db_path, str(backup_dir), keep=1, step_sleep=0, archive_path=archive_path).snapshot()
+    assert os.path.exists(backup.archive_companion(snapshot))
+
+    # После снапшота игрок уехал в архив: без общего восстановления базы разошлись бы
+    for path in (db_path, archive_path):
+        conn = sqlite3.connect(path)
+        conn.execute('DELETE FROM users WHERE telegram_id = 1000')
+        conn.commit()
+        conn.close()
+    restore(snapshot, db_path, archive_path)
+    assert counts(db_path)[0] == (20, sum(i * 10 for i in range(20)))
+    assert counts(archive_path)[0] == (30, sum(i * 10 for i in range(30)))
+
+    # Ротация удаляет спутник вместе со снапшотом
+    old = backup_dir / 'game-20000101-000000.db.gz'
+    os.replace(snapshot, old)
+    os.replace(backup.archive_companion(snapshot), backup.archive_companion(str(old)))
+    newest = Snapshotter(db_path, str(backup_dir), keep=1, step_sleep=0, archive_path=archive_path).snapshot()
+    assert sorted(os.listdir(backup_dir)) == sorted([os.path.basename(newest),
+                                                     os.path.basename(backup.archive_companion(newest)),
+                                                     '.snapshot.lock'])
@@ -0,0 +1,129 @@
+"""Цикл getUpdates против заглушки Bot API: смещение растёт, обновления обрабатываются по разу"""
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    """Bot API в памяти: getUpdates с семантикой offset Telegram"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeBotApiHandler)
+        self.updates = []
+        self.offsets = []
+        self.lock = threading.Lock()
+
+    def add(self, *updates):
+        with self.lock:
+            self.updates.extend(updates)
+
+    def get_updates(self, params):
+        offset = params.get('offset')
+        with self.lock:
+            self.offsets.append(offset)
+            if offset is not None:
+                # offset подтверждает все обновления с меньшим id - больше они не придут
+                self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            return self.updates[:params.get('limit', 100)]
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        params = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or b'{}')
+        result = self.server.get_updates(params) if method == 'getUpdates' else True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def message(update_id, chat_id):
+    return {"update_id": update_id,
+            "message": {"chat": {"id": chat_id}, "from": {"id": chat_id}, "text": f"msg {update_id}"}}
+
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_PATH', str(tmp_path / 'bot.db'))
+    monkeypatch.setenv('BOT_TOKEN', '')
+    import bot_runner
+    api = FakeBotApi()
+    threading.Thread(target=api.serve_forever, daemon=True).start()
+    processed = []
+    lock = threading.Lock()
+
+    def process_update(update):
+        with lock:
+            processed.append(update['update_id'])
+        if update['update_id'] == 3:
+            raise ValueError("broken update")
+    monkeypatch.setattr(bot_runner.server, 'process_update', process_update)
+    runner = bot_runner.BotRunner('TOKEN', f"http://127.0.0.1:{api.server_address[1]}", workers=4, poll_timeout=0)
+    yield runner, api, processed
+    runner.executor.shutdown(wait=True)
+    api.shutdown()
+    api.server_close()
+
+
+def test_offset_advances_and_updates_are_processed_once(bot):
+    runner, api, processed = bot
+    api.add(*[message(i, chat_id=100 + i % 2) for i in range(1, 6)])
+
+    assert runner.run_once() == 5
+    assert runner.offset == 6
+    api.add(message(6, 100), message(7, 102))
+    assert runner.run_once() == 2
+    assert runner.offset == 8
+    assert runner.run_once() == 0
+    assert runner.offset == 8
+
+    # Первый запрос без offset, дальше каждый подтверждает предыдущую пачку;
+    # упавшее обновление 3 смещение не задержало и повторно не пришло
+    assert api.offsets == [None, 6, 8]
+    assert sorted(processed) == [1, 2, 3, 4, 5, 6, 7]
+
+
+def test_updates_of_one_chat_keep_order(bot):
+    runner, api, processed = bot
+    api.add(*[message(i, chat_id=100 if i % 3 else 200) for i in range(10, 30)])
+
+    runner.run_once()
+
+    chat_100 = [i for i in processed if i % 3]
+    assert chat_100 == sorted(chat_100)
+    assert sorted(processed) == list(range(10, 30))
+
+
+def test_shutdown_confirms_last_batch(bot):
+    runner, api, processed = bot
+    api.add(message(1, 100), message(2, 101))
+    original = runner.process_batch
+
+    def process_and_stop(updates):
+        runner.stop()
+        return original(updates)
+    runner.process_batch = process_and_stop
+
+    runner.run()
+
+    # Без подтверждения при выходе следующий процесс получил бы пачку снова
+    assert api.offsets[-1] == 3
+    assert api.updates == []
+    assert sorted(processed) == [1, 2]
+
+
+def test_refuses_to_start_without_shared_bus(bot, monkeypatch):
+    import bot_runner
+    monkeypatch.setattr(bot_runner.server, 'BOT_TOKEN', 'TOKEN')
+    monkeypatch.setattr(bot_runner.server, 'CLUSTER_BUS_URL', '')
+    assert bot_runner.main() == 1
@@ -0,0 +1,105 @@
+"""Два инстанса сервера на общей базе и общей шине: изменения одного видны другому"""
+import os
+import sys
+import time
+import socket
+import sqlite3
+import threading
+import importlib.util
+
+import pytest
+
+import cluster
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(cluster.__file__)), 'server.py')
+
+
+def load_instance(name):
+    """Отдельная копия модуля server со своими кешами, хранилищем и подпиской на шину"""
+    spec = importlib.util.spec_from_file_location(name, SERVER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def wait_for(check, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return True
+        time.sleep(0.02)
+    return check()
+
+
+@pytest.fixture
+def bus():
+    server = cluster.MiniBusServer(('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def instances(tmp_path, monkeypatch, bus):
+    monkeypatch.setenv('DATABASE_PATH', str(tmp_path / 'shared.db'))
+    monkeypatch.setenv('CLUSTER_BUS_URL', f"redis://127.0.0.1:{bus.server_address[1]}")
+    # Хранилище в памяти: без шины второй инстанс не узнал бы об изменениях вовсе
+    monkeypatch.setenv('USER_STORE', 'memory')
+    for name in ('BACKUP_INTERVAL_SECONDS', 'RECONCILE_INTERVAL_SECONDS', 'ARCHIVE_INTERVAL_SECONDS'):
+        monkeypatch.setenv(name, '0')
+    monkeypatch.setenv('BOT_TOKEN', '')
+    monkeypatch.setenv('EVENT_LOG_DIR', '')
+    first, second = load_instance('server_a'), load_instance('server_b')
+    assert wait_for(lambda: first.cluster_bus.connected and second.cluster_bus.connected)
+    yield first, second
+    for name in ('server_a', 'server_b'):
+        sys.modules.pop(name, None)
+
+
+def test_changes_on_one_instance_reach_the_other(instances):
+    first, second = instances
+    a, b = first.app.test_client(), second.app.test_client()
+
+    for telegram_id in (101, 102):
+        assert a.post('/register', json={'telegram_id': telegram_id, 'username': f"p{telegram_id}"}).status_code == 201
+    assert wait_for(lambda: b.get('/rank/102').status_code == 200)
+
+    assert a.post('/add_points', json={'telegram_id': 102, 'points': 500}).status_code == 200
+    assert a.post('/add_points', json={'telegram_id': 101, 'points': 200}).status_code == 200
+
+    def leaderboard():
+        return [(row['telegram_id'], row['points']) for row in b.get('/leaderboard').get_json()['leaderboard']]
+    assert wait_for(lambda: leaderboard() == [(102, 500), (101, 200)])
+    assert b.get('/rank/101').get_json()['points'] == 200
+    assert b.get('/points/102').get_json()['points'] == 500
+
+    # И в обратную сторону
+    assert b.post('/add_points', json={'telegram_id': 101, 'points': 1000}).status_code == 200
+    assert wait_for(lambda: [row[0] for row in first.fetch_top_users(2)] == [101, 102])
+    assert second.cluster_bus.stats()["received"] > 0
+
+
+def test_resync_after_bus_outage_reloads_store_and_economy(instances, bus):
+    first, second = instances
+    a, b = first.app.test_client(), second.app.test_client()
+    assert a.post('/register', json={'telegram_id': 301, 'username': 'p301'}).status_code == 201
+    assert wait_for(lambda: b.get('/points/301').status_code == 200)
+
+    # Изменения, о которых второй инстанс не услышал: сообщения потерялись, пока шины не было
+    conn = sqlite3.connect(first.DATABASE_PATH)
+    conn.execute('UPDATE users SET points = 777 WHERE telegram_id = 301')
+    conn.execute('INSERT INTO economy_upgrades (telegram_id, level) VALUES (301, 1)')
+    conn.commit()
+    conn.close()
+    assert b.get('/points/301').get_json()['points'] == 0
+
+    # Обрыв связи с шиной: подписчики переподключаются и перечитывают состояние
+    with bus.lock:
+        handlers = [handler for subscribers in bus.subscribers.values() for handler in subscribers]
+    for handler in handlers:
+        handler.request.shutdown(socket.SHUT_RDWR)
+
+    assert wait_for(lambda: b.get('/points/301').get_json()['points'] == 777)
+    assert wait_for(lambda: second.economy_engine.upgrades.get(301) == 1)
@@ -0,0 +1,66 @@
+"""Правила экономики: загрузка, горячая перезагрузка и цена дельт синхронизации"""
+import os
+import json
+import time
+
+import pytest
+
+import economy
+
+
+def write_rules(path, rules, mtime):
+    path.write_text(rules if isinstance(rules, str) else json.dumps(rules))
+    os.utime(path, (mtime, mtime))
+
+
+def test_bad_rules_on_boot_keep_defaults(tmp_path):
+    path = tmp_path / 'economy.json'
+    write_rules(path, '{"base_rate": ', 1000)
+
+    engine = economy.EconomyEngine(str(path), reload_interval=0)
+
+    assert engine.table.version == 'default'
+    assert engine.last_error
+    assert engine.rate(1) == economy.DEFAULT_RULES["base_rate"]
+
+
+def test_reload_applies_changes_and_rejects_bad_rules(tmp_path):
+    path = tmp_path / 'economy.json'
+    write_rules(path, {"base_rate": 2, "max_rate": 20}, 1000)
+    engine = economy.EconomyEngine(str(path), reload_interval=0)
+    assert engine.rate(1) == 2
+
+    write_rules(path, {"base_rate": 3, "max_rate": 20, "events": [
+        {"name": "weekend", "multiplier": 2, "start": 0, "end": 4102444800}]}, 2000)
+    assert engine.rate(1) == 6
+    assert engine.explain(1)["events"] == ["weekend"]
+
+    # Битые значения: остаются прежние правила, ошибка видна в stats
+    write_rules(path, {"base_rate": -1, "max_rate": 20}, 3000)
+    assert engine.rate(1) == 6
+    assert engine.stats()["last_error"]
+    with pytest.raises(economy.RulesError):
+        engine.reload(force=True)
+
+
+def test_price_uses_rate_at_play_time(tmp_path):
+    engine = economy.EconomyEngine(None)
+    now = int(time.time())
+    # Буст выдан 60 секунд назад: он не должен умножать секунды, сыгранные раньше
+    engine.boosts[7] = [(3.0, now - 60, now + 3600)]
+
+    priced = engine.price(7, [(1, 120, now - 200), (2, 60, None)], window_start=now - 1000, now=now)
+
+    assert priced == {1: (120, 1.0), 2: (60, 3.0)}
+    assert engine.credit_priced(priced.values()) == 120 + 180
+
+
+def test_price_clamps_times_to_window(tmp_path):
+    engine = economy.EconomyEngine(None)
+    now = int(time.time())
+    engine.boosts[7] = [(2.0, now - 500, now - 400)]
+
+    # Время клиента из будущего - не позже now; до начала окна - не раньше окна
+    priced = engine.price(7, [(1, 10, now - 10000), (2, 10, now + 10000)], window_start=now - 450, now=now)
+
+    assert priced == {1: (10, 2.0), 2: (10, 1.0)}
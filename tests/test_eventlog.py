@@ -0,0 +1,81 @@
+"""Пересборка базы из журнала событий"""
+import os
+import sys
+import json
+import sqlite3
+import subprocess
+
+import pytest
+
+import eventlog
+
+ROOT = os.path.dirname(os.path.abspath(eventlog.__file__))
+
+
+def write_stream(directory, events):
+    """Поток журнала в формате EventLog: записи с seq по порядку"""
+    stream_dir = os.path.join(directory, 'applied-1-test')
+    os.makedirs(stream_dir)
+    with open(os.path.join(stream_dir, f"{1:020d}.log"), 'wb') as f:
+        for seq, event in enumerate(events, 1):
+            payload = json.dumps(event).encode()
+            f.write(eventlog.RECORD_HEADER.pack(len(payload), eventlog._crc(seq, payload), seq) + payload)
+
+
+def rebuild(log_dir, db_path):
+    return subprocess.run([sys.executable, os.path.join(ROOT, 'eventlog.py'), 'rebuild',
+                           '--dir', log_dir, '--db', db_path],
+                          cwd=ROOT, capture_output=True, text=True, timeout=60)
+
+
+def test_rebuild_reproduces_sync_balance(tmp_path):
+    registered = 1700000000
+    write_stream(str(tmp_path / 'eventlog'), [
+        {"type": "user", "telegram_id": 501, "username": "p501", "ts": registered},
+        # Первая синхронизация через полчаса после регистрации: 600 с игры укладываются в окно
+        {"type": "sync", "telegram_id": 501, "client_id": "web", "deltas": [[1, 600, 1.0]],
+         "ts": registered + 1800},
+    ])
+    db_path = str(tmp_path / 'rebuilt.db')
+
+    result = rebuild(str(tmp_path / 'eventlog'), db_path)
+
+    assert result.returncode == 0, result.stderr
+    conn = sqlite3.connect(db_path)
+    try:
+        points, created_at = conn.execute(
+            "SELECT points, CAST(strftime('%s', created_at) AS INTEGER) FROM users WHERE telegram_id = 501"
+        ).fetchone()
+        last_seq = conn.execute("SELECT last_seq FROM sync_state WHERE telegram_id = 501").fetchone()[0]
+    finally:
+        conn.close()
+    assert (points, created_at, last_seq) == (600, registered, 1)
+
+
+def test_poison_event_is_rejected_and_stream_moves_on(tmp_path):
+    applied, rejected = [], []
+    failures = {"transient": 1}
+
+    def apply_batch(stream, batch):
+        if failures["transient"]:
+            # База занята - пачку повторяют целиком, событие не отбрасывают
+            failures["transient"] -= 1
+            raise sqlite3.OperationalError("database is locked")
+        results = {}
+        for seq, event in batch:
+            results[seq] = event['points'] * 2
+        applied.extend(seq for seq, _ in batch)
+        return results
+
+    log = eventlog.EventLog(str(tmp_path / 'eventlog'), apply_batch, fsync_window=0,
+                            reject=lambda stream, seq, event, reason: rejected.append((seq, reason)))
+    log.open()
+
+    assert log.append_applied({"points": 1})[1] == 2
+    with pytest.raises(eventlog.EventRejected):
+        log.append_applied({"bad": True})
+    assert log.append_applied({"points": 3})[1] == 6
+
+    assert applied == [1, 3]
+    assert rejected == [(2, "KeyError: 'points'")]
+    assert log.stats()["rejected"] == 1
@@ -0,0 +1,91 @@
+"""Сверка балансов с журналом: поиск расхождений и режимы исправления"""
+import sqlite3
+
+import pytest
+
+import reconcile
+
+
+@pytest.fixture
+def connect(tmp_path):
+    path = str(tmp_path / 'game.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, telegram_id INTEGER, points INTEGER, '
+                 'updated_at TIMESTAMP)')
+    conn.execute('CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, '
+                 'points INTEGER, transaction_type TEXT, description TEXT)')
+    reconcile.init_tables(conn.cursor())
+    # 1 сходится с журналом, у 2 баланс больше журнала на 30, у 3 журнала нет вовсе
+    conn.executemany('INSERT INTO users (id, telegram_id, points) VALUES (?, ?, ?)',
+                     [(1, 101, 50), (2, 102, 100), (3, 103, 0)])
+    conn.executemany('INSERT INTO transactions (user_id, points) VALUES (?, ?)',
+                     [(1, 20), (1, 30), (2, 70)])
+    conn.commit()
+    conn.close()
+    return lambda: sqlite3.connect(path)
+
+
+def run_pass(reconciler):
+    reconciler.request_pass()
+    assert reconciler._claim()
+    while reconciler._step():
+        if reconciler.progress()['watermark'] == 0:
+            break
+    return reconciler.progress()
+
+
+def query(connect, sql, *args):
+    conn = connect()
+    try:
+        return conn.execute(sql, args).fetchall()
+    finally:
+        conn.close()
+
+
+def test_mismatch_is_reported_without_repair(connect):
+    state = run_pass(reconcile.Reconciler(connect, chunk_size=1))
+
+    assert (state['checked'], state['mismatches'], state['repaired']) == (3, 1, 0)
+    assert [(m['telegram_id'], m['balance'], m['ledger_sum'], m['repaired'])
+            for m in state['recent_mismatches']] == [(102, 100, 70, 0)]
+    assert query(connect, 'SELECT points FROM users WHERE id = 2') == [(100,)]
+    assert query(connect, 'SELECT user_id, points_sum FROM ledger_rollups ORDER BY user_id') == [(1, 50), (2, 70)]
+
+
+def test_balance_repair_sets_points_to_ledger_sum(connect):
+    repaired = []
+    reconciler = reconcile.Reconciler(connect, repair='balance',
+                                      on_repaired=lambda *change: repaired.append(change))
+
+    state = run_pass(reconciler)
+
+    assert (state['mismatches'], state['repaired'], state['open_mismatches']) == (1, 1, 0)
+    assert query(connect, 'SELECT points FROM users WHERE id = 2') == [(70,)]
+    assert repaired == [(102, 100, 70)]
+    # Следующий проход расхождения уже не видит и убирает его из отчёта
+    state = run_pass(reconciler)
+    assert (state['mismatches'], state['recent_mismatches']) == (0, [])
+
+
+def test_ledger_repair_adds_adjustment_transaction(connect):
+    reconciler = reconcile.Reconciler(connect, repair='ledger')
+
+    state = run_pass(reconciler)
+
+    assert state['repaired'] == 1
+    assert query(connect, "SELECT user_id, points FROM transactions WHERE transaction_type = 'reconcile'") == [(2, 30)]
+    assert query(connect, 'SELECT points FROM users WHERE id = 2') == [(100,)]
+    # Инкрементальный проход дочитывает только новые транзакции поверх свёртки
+    conn = connect()
+    conn.execute('UPDATE users SET points = points + 5 WHERE id = 1')
+    conn.execute('INSERT INTO transactions (user_id, points) VALUES (1, 5)')
+    conn.commit()
+    conn.close()
+    state = run_pass(reconciler)
+    assert (state['full_pass'], state['mismatches']) == (False, 0)
+    assert query(connect, 'SELECT user_id, points_sum FROM ledger_rollups ORDER BY user_id') == [(1, 55), (2, 100)]
+
+
+def test_unknown_repair_mode_is_rejected(connect):
+    with pytest.raises(ValueError):
+        reconcile.Reconciler(connect, repair='delete')
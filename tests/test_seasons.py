@@ -0,0 +1,60 @@
+"""Сезонные лидерборды: смена периодов и поздние начисления"""
+import sqlite3
+from datetime import datetime, timezone
+
+import seasons
+
+DAY1 = datetime(2024, 5, 13, 12, tzinfo=timezone.utc)
+DAY2 = datetime(2024, 5, 14, 12, tzinfo=timezone.utc)
+DAY3 = datetime(2024, 5, 15, 12, tzinfo=timezone.utc)
+
+
+def make_db():
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE users (telegram_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT)')
+    conn.executemany('INSERT INTO users VALUES (?, ?, ?)', [(1, 'a', 'A'), (2, 'b', 'B')])
+    seasons.init_tables(conn.cursor())
+    return conn
+
+
+def day_scores(conn, period):
+    return conn.execute("SELECT telegram_id, points FROM season_scores WHERE window = 'day' AND period = ? "
+                        "ORDER BY telegram_id", (period,)).fetchall()
+
+
+def day_archive(conn, period):
+    return conn.execute("SELECT rank, telegram_id, points FROM season_archive WHERE window = 'day' AND period = ? "
+                        "ORDER BY rank", (period,)).fetchall()
+
+
+def test_late_event_does_not_reopen_archived_period():
+    conn = make_db()
+    cursor = conn.cursor()
+    boards = seasons.SeasonBoards()
+    boards.record_points(cursor, 1, 10, DAY1)
+    boards.record_points(cursor, 1, 5, DAY2)
+    assert day_archive(conn, '2024-05-13') == [(1, 1, 10)]
+
+    # Событие из закрытого дня (доигрывание журнала) - в текущий день, архив не трогаем
+    boards.record_points(cursor, 2, 50, DAY1)
+    assert boards.current['day'] == '2024-05-14'
+    assert day_scores(conn, '2024-05-13') == []
+    assert day_scores(conn, '2024-05-14') == [(1, 5), (2, 50)]
+
+    boards.record_points(cursor, 1, 1, DAY3)
+    assert day_archive(conn, '2024-05-13') == [(1, 1, 10)]
+    assert day_archive(conn, '2024-05-14') == [(1, 2, 50), (2, 1, 5)]
+
+
+def test_new_process_does_not_start_from_a_closed_period():
+    conn = make_db()
+    cursor = conn.cursor()
+    seasons.SeasonBoards().record_points(cursor, 1, 10, DAY1)
+    seasons.SeasonBoards().record_points(cursor, 1, 5, DAY2)
+
+    # Процесс после рестарта первым получает позднее событие
+    boards = seasons.SeasonBoards()
+    boards.record_points(cursor, 2, 50, DAY1)
+    assert boards.current['day'] == '2024-05-14'
+    assert day_archive(conn, '2024-05-13') == [(1, 1, 10)]
+    assert day_scores(conn, '2024-05-14') == [(1, 5), (2, 50)]
@@ -0,0 +1,51 @@
+"""/v1/sync: цена дельт на момент игры, урезание до прошедшего времени и отсев повторов"""
+import time
+import sqlite3
+
+import pytest
+
+def registered(server, telegram_id, seconds_ago):
+    client = server.app.test_client()
+    assert client.post('/register', json={'telegram_id': telegram_id}).status_code == 201
+    conn = sqlite3.connect(server.DATABASE_PATH)
+    conn.execute("UPDATE users SET created_at = datetime(?, 'unixepoch') WHERE telegram_id = ?",
+                 (time.time() - seconds_ago, telegram_id))
+    conn.commit()
+    conn.close()
+    return client
+
+
+def sync(client, telegram_id, *deltas):
+    response = client.post('/v1/sync', json={'telegram_id': telegram_id, 'client_id': 'web',
+                                             'deltas': [dict(delta) for delta in deltas]})
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def test_sync_is_clamped_to_elapsed_time_and_deduplicated(server):
+    client = registered(server, 11, seconds_ago=100)
+
+    result = sync(client, 11, {'seq': 1, 'points': 60}, {'seq': 2, 'points': 240})
+    # С регистрации прошло 100 с (+ запас на расхождение часов) - остальное отброшено
+    assert result['applied'] == 2
+    assert result['seconds'] == 100 + server.SYNC_CLOCK_SLACK_SECONDS
+    assert result['clamped_seconds'] == 300 - result['seconds']
+    assert result['new_balance'] == result['seconds']
+
+    repeat = sync(client, 11, {'seq': 2, 'points': 240})
+    assert (repeat['applied'], repeat['duplicates'], repeat['points_added']) == (0, 1, 0)
+    assert client.get('/points/11').get_json()['points'] == result['new_balance']
+
+
+def test_boost_applies_only_to_seconds_played_under_it(server):
+    client = registered(server, 12, seconds_ago=1000)
+    now = time.time()
+    server.economy_engine.boosts[12] = [(3.0, int(now) - 60, int(now) + 3600)]
+
+    result = sync(client, 12, {'seq': 1, 'points': 100, 'ts': now - 300}, {'seq': 2, 'points': 50, 'ts': now})
+
+    assert result['points_added'] == 100 * 1 + 50 * 3
+    conn = sqlite3.connect(server.DATABASE_PATH)
+    rate = conn.execute("SELECT rate FROM transactions WHERE transaction_type = 'sync'").fetchone()[0]
+    conn.close()
+    assert rate == pytest.approx(250 / 150, abs=1e-3)
@@ -0,0 +1,343 @@
+"""Лёгкая трассировка запросов с экспортом в формате OTLP JSON.
+
+Спаны пишутся для каждого запроса (это дёшево), а экспортируются только
+сэмплированные трассы и все медленные - их дерево ещё и попадает в лог.
+Экспорт идёт из фонового потока: в файл (по трассе на строку) или POST'ом
+на OTLP/HTTP коллектор, так что запрос не ждёт записи.
+
+Тот же курсор копит статистику по тексту SQL (как pg_stat_statements):
+вызовы, суммарное/максимальное время и строки - выборка fetch*() или
+rowcount для изменений.
+"""
+import os
+import json
+import time
+import queue
+import random
+import sqlite3
+import threading
+import contextvars
+import logging
+from contextlib import contextmanager
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """Один замер: имя, атрибуты, время начала и конца в наносекундах"""
+
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes',
+                 'start_ns', 'end_ns', 'error', 'children')
+
+    def __init__(self, trace, name, parent=None, attributes=None):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.error = None
+        self.children = []
+        if parent:
+            parent.children.append(self)
+
+    @property
+    def duration_ms(self):
+        end = self.end_ns or time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+    def to_otlp(self):
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 2 if self.parent_id is None else 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [
+                {"key": key, "value": _otlp_value(value)}
+                for key, value in self.attributes.items()
+            ],
+            "status": {"code": 2, "message": self.error} if self.error else {"code": 1}
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class Trace:
+    """Дерево спанов одного запроса"""
+
+    def __init__(self, request_id, sampled):
+        self.trace_id = os.urandom(16).hex()
+        self.request_id = request_id
+        self.sampled = sampled
+        self.spans = []
+        self.root = None
+
+
+class Tracer:
+    """Создание трасс, сэмплирование, журнал медленных запросов и экспорт"""
+
+    def __init__(self, service_name='veln-game-server', sample_rate=0.01, slow_ms=500,
+                 export_file=None, otlp_endpoint=None, max_spans=500):
+        self.service_name = service_name
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.export_file = export_file
+        self.otlp_endpoint = otlp_endpoint
+        self.max_spans = max_spans
+        self.queue = queue.Queue(maxsize=1000)
+        self.exporter = None
+        self.start()
+
+    def start(self):
+        """Запустить экспортёр; повторный вызов после fork поднимает его в дочернем процессе"""
+        if not (self.export_file or self.otlp_endpoint) or (self.exporter and self.exporter.is_alive()):
+            return
+        self.exporter = threading.Thread(target=self._export_loop, daemon=True, name='trace-exporter')
+        self.exporter.start()
+
+    def start_trace(self, name, request_id, attributes=None):
+        """Открыть корневой спан запроса и вернуть токен для finish_trace"""
+        trace = Trace(request_id, random.random() < self.sample_rate)
+        root = Span(trace, name, attributes=dict(attributes or {}, **{"http.request_id": request_id}))
+        trace.root = root
+        trace.spans.append(root)
+        return _current_span.set(root)
+
+    def finish_trace(self, token, attributes=None):
+        """Закрыть корневой спан, записать медленный запрос в лог и отдать трассу экспортёру"""
+        root = _current_span.get()
+        _current_span.reset(token)
+        if root is None:
+            return
+        root.end_ns = time.time_ns()
+        if attributes:
+            root.attributes.update(attributes)
+
+        trace = root.trace
+        slow = root.duration_ms >= self.slow_ms
+        if slow:
+            logger.warning("Slow request %s (%.1f ms):\n%s", trace.request_id, root.duration_ms, format_tree(root))
+        if (trace.sampled or slow) and self.exporter:
+            try:
+                self.queue.put_nowait(trace)
+            except queue.Full:
+                pass
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Вложенный спан; вне трассируемого запроса ничего не делает"""
+        parent = _current_span.get()
+        if parent is None or len(parent.trace.spans) >= self.max_spans:
+            yield None
+            return
+        span = Span(parent.trace, name, parent, attributes)
+        parent.trace.spans.append(span)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            _current_span.reset(token)
+
+    def db_time_ms(self):
+        """Суммарное время db.* спанов текущей трассы"""
+        span = _current_span.get()
+        if span is None:
+            return 0.0
+        return sum(s.duration_ms for s in span.trace.spans if s.name.startswith('db.'))
+
+    def current_request_id(self):
+        span = _current_span.get()
+        return span.trace.request_id if span else None
+
+    def to_otlp(self, traces):
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [
+                    {"key": "service.name", "value": {"stringValue": self.service_name}}
+                ]},
+                "scopeSpans": [{
+                    "scope": {"name": "veln.tracing"},
+                    "spans": [span.to_otlp() for trace in traces for span in trace.spans]
+                }]
+            }]
+        }
+
+    def _export_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < 50:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._export(batch)
+            except Exception as e:
+                logger.error("Trace export error: %s", e)
+
+    def _export(self, batch):
+        if self.export_file:
+            with open(self.export_file, 'a') as f:
+                for trace in batch:
+                    f.write(json.dumps(self.to_otlp([trace]), ensure_ascii=False) + '\n')
+        if self.otlp_endpoint:
+            import requests
+            requests.post(self.otlp_endpoint, json=self.to_otlp(batch), timeout=5)
+
+
+def format_tree(span, depth=0):
+    """Дерево спанов с длительностями для журнала медленных запросов"""
+    label = span.attributes.get('db.statement') or span.attributes.get('http.url') or ''
+    line = f"{'  ' * depth}{span.name} {span.duration_ms:.1f} ms {label}".rstrip()
+    if span.error:
+        line += f" [{span.error}]"
+    return '\n'.join([line] + [format_tree(child, depth + 1) for child in span.children])
+
+
+tracer = Tracer(
+    sample_rate=float(os.environ.get('TRACE_SAMPLE_RATE', 0.01)),
+    slow_ms=float(os.environ.get('TRACE_SLOW_MS', 500)),
+    export_file=os.environ.get('TRACE_EXPORT_FILE'),
+    otlp_endpoint=os.environ.get('TRACE_OTLP_ENDPOINT')
+)
+
+
+@lru_cache(maxsize=2048)
+def _normalize(sql):
+    return ' '.join(sql.split())
+
+
+def _statement(sql):
+    return _normalize(sql)[:200]
+
+
+class StatementStats:
+    """Статистика выполнения по нормализованному тексту запроса"""
+
+    FIELDS = ('calls', 'total_ms', 'max_ms', 'rows')
+
+    def __init__(self, max_statements=5000):
+        self.max_statements = max_statements
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.since = time.time()
+
+    def record(self, statement, elapsed_ms, rows=0, call=True):
+        with self.lock:
+            entry = self.stats.get(statement)
+            if entry is None:
+                if len(self.stats) >= self.max_statements:
+                    statement = '<other>'
+                    entry = self.stats.get(statement)
+                if entry is None:
+                    entry = self.stats[statement] = [0, 0.0, 0.0, 0]
+            entry[1] += elapsed_ms
+            if call:
+                # Максимум - по самому вызову execute, без последующих fetch
+                entry[0] += 1
+                entry[2] = max(entry[2], elapsed_ms)
+            entry[3] += max(rows, 0)
+
+    def top(self, sort='total_ms', limit=50):
+        """Самые тяжёлые запросы по полю sort (calls, total_ms, avg_ms, max_ms, rows)"""
+        with self.lock:
+            items = [dict(zip(self.FIELDS, entry), statement=statement)
+                     for statement, entry in self.stats.items()]
+        for item in items:
+            item['avg_ms'] = item['total_ms'] / item['calls'] if item['calls'] else 0.0
+            for key in ('total_ms', 'avg_ms', 'max_ms'):
+                item[key] = round(item[key], 3)
+        items.sort(key=lambda item: item[sort], reverse=True)
+        return items[:limit]
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.since = time.time()
+
+
+sql_stats = StatementStats()
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Курсор, оборачивающий каждый запрос в спан db.execute и учитывающий его в sql_stats"""
+
+    _sql = None
+
+    def execute(self, sql, parameters=()):
+        self._sql = _normalize(sql)
+        started = time.perf_counter()
+        try:
+            with tracer.span('db.execute', **{"db.system": "sqlite", "db.statement": self._sql[:200]}):
+                return super().execute(sql, parameters)
+        finally:
+            sql_stats.record(self._sql, (time.perf_counter() - started) * 1000, self.rowcount)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = _normalize(sql)
+        started = time.perf_counter()
+        try:
+            with tracer.span('db.executemany', **{"db.system": "sqlite", "db.statement": self._sql[:200]}):
+                return super().executemany(sql, seq_of_parameters)
+        finally:
+            sql_stats.record(self._sql, (time.perf_counter() - started) * 1000, self.rowcount)
+
+    # Выборка строк тоже исполняет запрос (шаги SQLite), поэтому время идёт в тот же запрос
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        if self._sql:
+            sql_stats.record(self._sql, (time.perf_counter() - started) * 1000, row is not None, call=False)
+        return row
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if self._sql:
+            sql_stats.record(self._sql, (time.perf_counter() - started) * 1000, len(rows), call=False)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        if self._sql:
+            sql_stats.record(self._sql, (time.perf_counter() - started) * 1000, len(rows), call=False)
+        return rows
+
+
+class TracedConnection(sqlite3.Connection):
+    """Соединение, чьи курсоры и commit попадают в трассу"""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        with tracer.span('db.commit', **{"db.system": "sqlite"}):
+            return super().commit()
@@ -0,0 +1,292 @@
+"""Колоночное хранилище пользователей в памяти для горячих чтений.
+
+Таблица users целиком лежит в массивах array('q') (id, telegram_id, очки,
+время регистрации) и списках интернированных строк (имена повторяются часто).
+Индекс telegram_id -> номер строки - открытая адресация в array('q') с
+линейным пробированием, около 16 байт на пользователя против ~100 у dict.
+Топ лидерборда кешируется и пересчитывается только когда изменение может его
+затронуть.
+
+Запись (рост индекса, перестановка строк при удалении) меняет несколько
+массивов сразу, поэтому чтения тоже идут под lock: под gthread иначе можно
+прочитать строку наполовину от другого игрока. Захват незанятого Lock стоит
+десятки наносекунд - на порядок меньше самого поиска.
+
+Хранилище загружается при старте и обновляется теми же хуками, что и
+гистограмма мест, поэтому база остаётся источником истины. Замер памяти и
+скорости поиска:
+
+    python userstore.py bench --users 1000000
+"""
+import sys
+import time
+import heapq
+import random
+import sqlite3
+import argparse
+import threading
+import tracemalloc
+from array import array
+from datetime import datetime, timezone
+
+TOP_CACHE_SIZE = 100
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+MASK64 = (1 << 64) - 1
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+LOAD_SQL = 'SELECT id, telegram_id, username, first_name, last_name, points, created_at FROM users'
+
+
+def parse_timestamp(value):
+    """CURRENT_TIMESTAMP SQLite (UTC) -> секунды эпохи; 0 если не разобрать"""
+    try:
+        return int(datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def format_timestamp(seconds):
+    if not seconds:
+        return None
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(seconds))
+
+
+class UserStore:
+    """Пользователи в колонках; строки отдаются кортежами в порядке колонок users"""
+
+    def __init__(self, capacity=1024):
+        self.ids = array('q')
+        self.telegram_ids = array('q')
+        self.points = array('q')
+        self.created_at = array('q')
+        self.usernames = []
+        self.first_names = []
+        self.last_names = []
+        self.lock = threading.Lock()
+        self._top = None
+        self.index, self.index_mask, self.index_shift = self._new_index(capacity)
+
+    def __len__(self):
+        return len(self.telegram_ids)
+
+    @staticmethod
+    def _new_index(capacity):
+        """Пустой индекс под capacity строк: (массив, маска, сдвиг хеша)"""
+        size = 1
+        while size < capacity * 2:
+            size <<= 1
+        # Храним номер строки + 1, ноль - пустая ячейка
+        return array('q', [0]) * size, size - 1, 64 - (size.bit_length() - 1)
+
+    def _probe(self, telegram_id, index=None, mask=None, shift=None):
+        """Ячейка индекса с этим telegram_id или первая пустая на его пути"""
+        if index is None:
+            index, mask, shift = self.index, self.index_mask, self.index_shift
+        i = ((telegram_id * HASH_MULTIPLIER) & MASK64) >> shift
+        telegram_ids = self.telegram_ids
+        while True:
+            entry = index[i]
+            if entry == 0 or telegram_ids[entry - 1] == telegram_id:
+                return i
+            i = (i + 1) & mask
+
+    def _grow_index(self):
+        # Новый индекс заполняется целиком и только потом подменяет старый
+        index, mask, shift = self._new_index(len(self.telegram_ids))
+        for slot, telegram_id in enumerate(self.telegram_ids):
+            index[self._probe(telegram_id, index, mask, shift)] = slot + 1
+        self.index, self.index_mask, self.index_shift = index, mask, shift
+
+    def _slot(self, telegram_id):
+        entry = self.index[self._probe(telegram_id)]
+        return entry - 1 if entry else None
+
+    def slot(self, telegram_id):
+        """Номер строки пользователя или None (годен, пока строки не переставлены удалением)"""
+        with self.lock:
+            return self._slot(telegram_id)
+
+    def load(self, conn):
+        """Заполнить хранилище из базы"""
+        with self.lock:
+            for row in conn.execute(LOAD_SQL):
+                self._put(row)
+            self._top = None
+
+    def _put(self, row):
+        user_id, telegram_id, username, first_name, last_name, points, created_at = row
+        position = self._probe(telegram_id)
+        slot = self.index[position] - 1
+        if slot < 0:
+            slot = len(self.telegram_ids)
+            self.ids.append(user_id)
+            self.telegram_ids.append(telegram_id)
+            self.points.append(points or 0)
+            self.created_at.append(parse_timestamp(created_at))
+            self.usernames.append(sys.intern(username or ''))
+            self.first_names.append(sys.intern(first_name or ''))
+            self.last_names.append(sys.intern(last_name or ''))
+            self.index[position] = slot + 1
+            if len(self.telegram_ids) * 2 > len(self.index):
+                self._grow_index()
+        else:
+            self.ids[slot] = user_id
+            self.points[slot] = points or 0
+            self.created_at[slot] = parse_timestamp(created_at)
+            self.usernames[slot] = sys.intern(username or '')
+            self.first_names[slot] = sys.intern(first_name or '')
+            self.last_names[slot] = sys.intern(last_name or '')
+        return slot
+
+    def put(self, row):
+        """Добавить или заменить строку (кортеж в порядке LOAD_SQL)"""
+        with self.lock:
+            slot = self._put(row)
+            self._touch_top(slot)
+
+    def refresh(self, conn, telegram_id):
+        """Перечитать одного пользователя из базы (после регистрации)"""
+        row = conn.execute(LOAD_SQL + ' WHERE telegram_id = ?', (telegram_id,)).fetchone()
+        if row:
+            self.put(row)
+
+    def set_points(self, telegram_id, points):
+        """Обновить баланс; False - пользователя нет в хранилище"""
+        with self.lock:
+            slot = self._slot(telegram_id)
+            if slot is None:
+                return False
+            self.points[slot] = points
+            self._touch_top(slot)
+            return True
+
+    def remove(self, telegram_id):
+        """Убрать пользователя (после переноса в архив); False - его и не было"""
+        with self.lock:
+            position = self._probe(telegram_id)
+            slot = self.index[position] - 1
+            if slot < 0:
+                return False
+            # Последняя строка переезжает на место удалённой, колонки остаются плотными
+            last = len(self.telegram_ids) - 1
+            if slot != last:
+                moved = self.telegram_ids[last]
+                self.index[self._probe(moved)] = slot + 1
+                for column in (self.ids, self.telegram_ids, self.points, self.created_at,
+                               self.usernames, self.first_names, self.last_names):
+                    column[slot] = column[last]
+            for column in (self.ids, self.telegram_ids, self.points, self.created_at,
+                           self.usernames, self.first_names, self.last_names):
+                column.pop()
+            self._delete_index_entry(position)
+            self._top = None
+            return True
+
+    def _delete_index_entry(self, position):
+        """Освободить ячейку без надгробий: сдвинуть назад записи, чей путь пробирования шёл через неё"""
+        index, mask = self.index, self.index_mask
+        index[position] = 0
+        i = position
+        while True:
+            i = (i + 1) & mask
+            entry = index[i]
+            if entry == 0:
+                return
+            home = ((self.telegram_ids[entry - 1] * HASH_MULTIPLIER) & MASK64) >> self.index_shift
+            if ((i - home) & mask) >= ((i - position) & mask):
+                index[position] = entry
+                index[i] = 0
+                position = i
+
+    def _touch_top(self, slot):
+        top = self._top
+        if top is None:
+            return
+        # Топ меняется, только если игрок в нём или обгоняет последнего
+        if slot in top or (len(top) < TOP_CACHE_SIZE and self.points[slot] > 0) \
+                or (top and self.points[slot] > self.points[top[-1]]):
+            self._top = None
+
+    def get(self, telegram_id):
+        """Строка пользователя (id, telegram_id, username, first_name, last_name, points, created_at)"""
+        with self.lock:
+            slot = self._slot(telegram_id)
+            if slot is None:
+                return None
+            row = (self.ids[slot], self.telegram_ids[slot], self.usernames[slot], self.first_names[slot],
+                   self.last_names[slot], self.points[slot], self.created_at[slot])
+        return row[:6] + (format_timestamp(row[6]),)
+
+    def get_points(self, telegram_id):
+        with self.lock:
+            slot = self._slot(telegram_id)
+            return None if slot is None else self.points[slot]
+
+    def top(self, limit):
+        """Лидеры с очками > 0: (telegram_id, username, first_name, points)"""
+        with self.lock:
+            points = self.points
+            top = self._top
+            if top is None:
+                top = heapq.nlargest(TOP_CACHE_SIZE, range(len(points)), key=points.__getitem__)
+                top = [slot for slot in top if points[slot] > 0]
+                self._top = top
+            # Фильтр - и по текущей длине: кеш мог пережить правку, не сбросившую его
+            return [(self.telegram_ids[slot], self.usernames[slot], self.first_names[slot], points[slot])
+                    for slot in top[:limit] if slot < len(points) and points[slot] > 0]
+
+
+def bench(users, lookups):
+    """Память на пользователя и время поиска: хранилище против SQLite"""
+    rng = random.Random(42)
+    names = [f"player{i}" for i in range(1000)]
+    telegram_ids = rng.sample(range(10 ** 6, 10 ** 10), users)
+    rows = [(i + 1, tid, rng.choice(names), rng.choice(names), '', rng.randrange(10 ** 6), '2024-05-01 12:00:00')
+            for i, tid in enumerate(telegram_ids)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = UserStore()
+    for row in rows:
+        store._put(row)
+    store_bytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('''CREATE TABLE users (id INTEGER PRIMARY KEY, telegram_id INTEGER UNIQUE, username TEXT,
+                    first_name TEXT, last_name TEXT, points INTEGER, created_at TIMESTAMP)''')
+    conn.executemany('INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+    del rows
+
+    keys = [rng.choice(telegram_ids) for _ in range(lookups)]
+    start = time.perf_counter()
+    for key in keys:
+        store.get(key)
+    store_us = (time.perf_counter() - start) / lookups * 1e6
+    start = time.perf_counter()
+    for key in keys:
+        conn.execute(LOAD_SQL + ' WHERE telegram_id = ?', (key,)).fetchone()
+    sqlite_us = (time.perf_counter() - start) / lookups * 1e6
+    start = time.perf_counter()
+    store.top(100)
+    top_ms = (time.perf_counter() - start) * 1000
+
+    print(f"users:              {users:,}")
+    print(f"store memory:       {store_bytes / users:.1f} bytes/user ({store_bytes / 2 ** 20:.1f} MiB)")
+    print(f"store lookup:       {store_us:.2f} us")
+    print(f"sqlite lookup:      {sqlite_us:.2f} us (in-memory DB, unique index)")
+    print(f"top-100 rebuild:    {top_ms:.1f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Хранилище пользователей в памяти')
+    parser.add_argument('command', choices=['bench'])
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--lookups', type=int, default=100000)
+    args = parser.parse_args(argv)
+    bench(args.users, args.lookups)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())